@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from typing import Union, Dict, List, Any, Tuple, Optional
+
+# Default number of results held in memory in front of each cache (see _ResultMemo)
+_DEFAULT_MEMO_SIZE = 1000
+# Number of most recent successful results of each function used for the runtime history
+_RUNTIME_HISTORY_SIZE = 100
+
+def _get_cache_backend(cache: Union[str, dict]):
+    """Return the backend for a hither cache configuration
+
+    The cache configuration is either the name of a loggery preset, a dict of
+    loggery configuration options (MongoDB), or a dict with backend='sqlite'
+    and an optional path for a local embedded database, for example:
+
+    hither.config(cache=dict(backend='sqlite', path='/path/to/hither_cache.db'))
+
+    In all cases, memo_size sets the number of results that are held in memory
+    (default 1000, 0 to disable). The backend objects (and their memos) last for
+    the lifetime of the process.
+    """
+    if type(cache) == str:
+        cache = dict(preset=cache)
+    key = json.dumps(cache, sort_keys=True)
+    if key in _cache_backends:
+        return _cache_backends[key]
+    cache = dict(cache)
+    backend = cache.pop('backend', 'loggery')
+    memo_size = cache.pop('memo_size', _DEFAULT_MEMO_SIZE)
+    if backend == 'loggery':
+        ret = _LoggeryCache(cache, memo_size=memo_size)
+    elif backend == 'sqlite':
+        path = cache.get('path', None)
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.hither', 'cache.db')
+        ret = _SQLiteCache(path, memo_size=memo_size)
+    else:
+        raise Exception('Unexpected cache backend: {}'.format(backend))
+    _cache_backends[key] = ret
+    return ret
+
+_cache_backends: Dict[str, Any] = dict()
+
+def create_cache_indexes(cache: Union[str, dict]) -> None:
+    """Create the database indexes used by the lookups of a hither cache
+
+    This is an administrative step, to be run once per MongoDB (loggery)
+    collection with write access. The lookups work without the indexes
+    (e.g., with a read-only preset), but they scan the collection. The
+    sqlite backend creates its indexes itself, so this does nothing there.
+
+    hither.create_cache_indexes(dict(url=..., database=..., collection=..., password=...))
+    """
+    backend = _get_cache_backend(cache)
+    if hasattr(backend, 'create_indexes'):
+        backend.create_indexes()
+
+class _ResultMemo:
+    def __init__(self, max_size: int):
+        """Least-recently-used memo of cached result messages, keyed on (function name, hash)
+
+        The messages must be treated as read-only by the caller.
+        """
+        self._max_size = max_size
+        self._messages: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name: str, hash0: str) -> Optional[dict]:
+        with self._lock:
+            message = self._messages.get((name, hash0), None)
+            if message is not None:
+                self._messages.move_to_end((name, hash0))
+            return message
+
+    def put(self, name: str, hash0: str, message: dict) -> None:
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            self._messages[(name, hash0)] = message
+            self._messages.move_to_end((name, hash0))
+            while len(self._messages) > self._max_size:
+                self._messages.popitem(last=False)
+
+class _LoggeryCache:
+    def __init__(self, config: dict, *, memo_size: int):
+        self._config = config
+        self.memo = _ResultMemo(memo_size)
+
+    def find_results(self, hashes: List[str]) -> Dict[str, dict]:
+        # One query for all of the hashes. Returns the most recent message for each hash.
+        import loggery
+        with loggery.config(**self._config):
+            messages = dict()
+            # sorted by ascending time, so the most recent document wins
+            for doc in loggery.find_all({'message.name': 'hither_result', 'message.hash': {'$in': sorted(set(hashes))}}):
+                messages[doc['message']['hash']] = doc['message']
+            return messages
+
+    def insert_result(self, message: dict) -> None:
+        import loggery
+        with loggery.config(**self._config):
+            loggery.insert_one(message=message)
+
+    def find_elapsed_sec(self, function_names: List[str]) -> List[Tuple[str, float]]:
+        # (function name, elapsed sec) of the most recent successful results for these functions
+        import loggery
+        ret = []
+        with loggery.config(**self._config):
+            for function_name in sorted(set(function_names)):
+                docs = loggery.find_all(
+                    {'message.name': 'hither_result', 'message.hash_object.name': function_name, 'message.success': True},
+                    projection={'message.hash_object.name': 1, 'message.runtime_info.elapsed_sec': 1},
+                    limit=_RUNTIME_HISTORY_SIZE
+                )
+                for doc in docs:
+                    try:
+                        ret.append((doc['message']['hash_object']['name'], float(doc['message']['runtime_info']['elapsed_sec'])))
+                    except:
+                        continue
+        return ret
+
+    def create_indexes(self) -> None:
+        import loggery
+        with loggery.config(**self._config):
+            loggery.create_index([('message.name', 1), ('message.hash', 1), ('time', -1)])
+            loggery.create_index([('message.name', 1), ('message.hash_object.name', 1), ('message.success', 1), ('time', -1)])
+
+class _SQLiteCache:
+    def __init__(self, path: str, *, memo_size: int):
+        """Local embedded cache backend (no database service needed)
+
+        Several processes (e.g., the workers of a ParallelJobHandler) may
+        write at the same time. The database uses write-ahead logging, so
+        readers do not block the writer, and writers wait for each other.
+        """
+        self._path = os.path.abspath(path)
+        self.memo = _ResultMemo(memo_size)
+
+    def find_results(self, hashes: List[str]) -> Dict[str, dict]:
+        conn = self._connection()
+        messages = dict()
+        hashes = sorted(set(hashes))
+        # stay below the sqlite limit on the number of query parameters
+        chunk_size = 500
+        for i in range(0, len(hashes), chunk_size):
+            chunk = hashes[i:i + chunk_size]
+            rows = conn.execute(
+                'SELECT hash, message FROM hither_results WHERE hash IN ({}) ORDER BY id ASC'.format(','.join(['?'] * len(chunk))),
+                chunk
+            ).fetchall()
+            # sorted by insertion order, so the most recent row wins
+            for hash0, message_json in rows:
+                messages[hash0] = json.loads(message_json)
+        return messages
+
+    def insert_result(self, message: dict) -> None:
+        conn = self._connection()
+        runtime_info = message.get('runtime_info', None) or dict()
+        with conn:
+            conn.execute(
+                'INSERT INTO hither_results (hash, function_name, success, elapsed_sec, time, message) VALUES (?, ?, ?, ?, ?, ?)',
+                (
+                    message['hash'],
+                    message['hash_object']['name'],
+                    1 if message.get('success', False) else 0,
+                    runtime_info.get('elapsed_sec', None),
+                    time.time(),
+                    json.dumps(message)
+                )
+            )
+
+    def find_elapsed_sec(self, function_names: List[str]) -> List[Tuple[str, float]]:
+        # (function name, elapsed sec) of the most recent successful results for these functions
+        conn = self._connection()
+        ret = []
+        for function_name in sorted(set(function_names)):
+            rows = conn.execute(
+                'SELECT function_name, elapsed_sec FROM hither_results WHERE function_name = ? AND success = 1 AND elapsed_sec IS NOT NULL ORDER BY id DESC LIMIT ?',
+                (function_name, _RUNTIME_HISTORY_SIZE)
+            ).fetchall()
+            ret.extend([(name0, float(elapsed0)) for name0, elapsed0 in rows])
+        return ret
+
+    def _connection(self):
+        # One connection per (process, thread), since sqlite connections
+        # must not be shared across a fork or between threads
+        import sqlite3
+        key = (self._path, os.getpid(), threading.get_ident())
+        conn = _sqlite_connections.get(key, None)
+        if conn is not None:
+            return conn
+        dirname = os.path.dirname(self._path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        conn = sqlite3.connect(self._path, timeout=60)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS hither_results (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    hash TEXT NOT NULL,
+                    function_name TEXT NOT NULL,
+                    success INTEGER NOT NULL,
+                    elapsed_sec REAL,
+                    time REAL NOT NULL,
+                    message TEXT NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS hither_results_hash ON hither_results (hash, id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS hither_results_function_name_id ON hither_results (function_name, success, id)')
+        _sqlite_connections[key] = conn
+        return conn
+
+_sqlite_connections: Dict[Tuple[str, int, int], Any] = dict()
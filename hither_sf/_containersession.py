@@ -0,0 +1,291 @@
+import os
+import sys
+import json
+import time
+import atexit
+import select
+import subprocess
+from typing import Dict, List, Tuple, Union, Any
+from ._shellscript import ShellScript
+
+# Warm container sessions are used by run_function_in_container when HITHER_WARM_CONTAINERS=TRUE.
+# One container per image (and gpu setting) is kept running as a job server, and each job
+# is run in a forked child of the server, so that the interpreter startup and the imports of
+# the modules listed in HITHER_WARM_CONTAINER_PRELOAD are paid once per session.
+#
+# HITHER_WARM_CONTAINER_RUNNER selects how the server is started: docker (the default),
+# singularity (the default when HITHER_USE_SINGULARITY=TRUE) or local, which runs the server
+# directly on the host without any container (for testing).
+#
+# The sessions belong to the process that runs the jobs, so they only pay off when that process
+# runs many jobs: in-process (no job handler), a ParallelJobHandler in pool mode, or the workers of
+# a SlurmJobHandler. With a ParallelJobHandler that starts a process per job (the default), each
+# job would start and stop its own session, so the warm sessions are not used there.
+
+_DEFAULT_PRELOAD_MODULES = 'numpy,spikeextractors,spiketoolkit'
+
+def _warm_containers_enabled() -> bool:
+    if (os.getenv('HITHER_WARM_CONTAINERS', None) != 'TRUE') or (sys.platform == "win32"):
+        return False
+    if _one_job_per_process[0]:
+        if not _warned_one_job_per_process[0]:
+            print('WARNING: HITHER_WARM_CONTAINERS is ignored for jobs that run in their own process. Use pool mode of the ParallelJobHandler.')
+            _warned_one_job_per_process[0] = True
+        return False
+    return True
+
+def _set_one_job_per_process() -> None:
+    # Called in a process that runs a single job (see ParallelJobHandler)
+    _one_job_per_process[0] = True
+
+_one_job_per_process = [False]
+_warned_one_job_per_process = [False]
+
+def _warm_container_runner() -> str:
+    runner = os.getenv('HITHER_WARM_CONTAINER_RUNNER', None)
+    if runner is None:
+        if os.getenv('HITHER_USE_SINGULARITY', None) == 'TRUE':
+            runner = 'singularity'
+        else:
+            runner = 'docker'
+    if runner not in ['docker', 'singularity', 'local']:
+        raise Exception('Unexpected value of HITHER_WARM_CONTAINER_RUNNER: {}'.format(runner))
+    return runner
+
+def _get_container_session(*, container: str, gpu: bool) -> '_ContainerSession':
+    runner = _warm_container_runner()
+    key = json.dumps([runner, container, gpu, os.getenv('NUM_WORKERS', '')])
+    session = _sessions.get(key, None)
+    if (session is not None) and (not session.is_running()):
+        print('Warm container session for {} has exited. Starting a new one.'.format(container))
+        session = None
+    if session is None:
+        session = _ContainerSession(runner=runner, container=container, gpu=gpu)
+        _sessions[key] = session
+    return session
+
+def _stop_container_sessions():
+    for session in _sessions.values():
+        session.stop()
+    _sessions.clear()
+
+_sessions: Dict[str, '_ContainerSession'] = dict()
+atexit.register(_stop_container_sessions)
+
+class _ContainerSession:
+    def __init__(self, *, runner: str, container: str, gpu: bool):
+        """A container that is kept running as a job server
+
+        The jobs are sent as lines of JSON on the stdin of the server, and
+        the server reports the exit code of each job on its stdout. The job
+        directories are created under $KACHERY_STORAGE_DIR/tmp, which is
+        mounted at the same path inside the container, so that paths in the
+        job directory do not need to be translated.
+        """
+        self._runner = runner
+        self._container = container
+        self._kachery_storage_dir = os.getenv('KACHERY_STORAGE_DIR')
+        self._session_dir = os.path.join(self._kachery_storage_dir, 'tmp')
+        if not os.path.exists(self._session_dir):
+            os.makedirs(self._session_dir, exist_ok=True)
+        self._server_script_path = os.path.join(self._session_dir, 'hither_container_session_server.py')
+        ShellScript(_server_script).write(self._server_script_path + '.tmp' + str(os.getpid()))
+        os.replace(self._server_script_path + '.tmp' + str(os.getpid()), self._server_script_path)
+        self._buffer = b''
+        self._job_index = 0
+        command = self._command(gpu=gpu)
+        print('Starting warm container session: {}'.format(' '.join(command)))
+        env = dict(os.environ)
+        env['HITHER_WARM_CONTAINER_PRELOAD'] = os.getenv('HITHER_WARM_CONTAINER_PRELOAD', _DEFAULT_PRELOAD_MODULES)
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+
+    def kachery_storage_dir_inside(self) -> str:
+        if self._runner == 'local':
+            return self._kachery_storage_dir
+        return '/kachery-storage'
+
+    def path_inside(self, path: str) -> Union[str, None]:
+        # The path of a host file inside the container (None if it is not visible there)
+        path = os.path.abspath(path)
+        if path.startswith(self._session_dir + '/'):
+            return path
+        if path.startswith(self._kachery_storage_dir + '/'):
+            return self.kachery_storage_dir_inside() + path[len(self._kachery_storage_dir):]
+        return None
+
+    def is_running(self) -> bool:
+        return self._process.poll() is None
+
+    def run(self, *, run_dir: str, env: Dict[str, str], timeout: Union[float, None]) -> Tuple[int, bool]:
+        """Run run_dir/run.py in a forked child of the server
+
+        The console output of the job goes to run_dir/console.txt. Returns
+        the exit code and whether the job was stopped due to the timeout.
+        """
+        self._job_index = self._job_index + 1
+        job_id = self._job_index
+        self._send(dict(type='run', job_id=job_id, run_dir=run_dir, env=env))
+        timer = time.time()
+        did_timeout = False
+        while True:
+            wait_sec = 1
+            if (timeout is not None) and (not did_timeout):
+                wait_sec = max(0, min(wait_sec, timeout - (time.time() - timer)))
+            msg = self._receive(timeout=wait_sec)
+            if msg is not None:
+                if msg['job_id'] == job_id:
+                    return msg['exit_code'], did_timeout
+                continue
+            if not self.is_running():
+                raise Exception('Warm container session for {} exited unexpectedly'.format(self._container))
+            elapsed = time.time() - timer
+            if (timeout is not None) and (not did_timeout) and (elapsed > timeout):
+                print(f'Stopping job due to timeout {elapsed} > {timeout}')
+                did_timeout = True
+                self._send(dict(type='cancel', job_id=job_id))
+
+    def stop(self) -> None:
+        if self.is_running():
+            try:
+                # the server exits when its stdin is closed
+                self._process.stdin.close()
+                self._process.wait(timeout=10)
+            except:
+                self._process.kill()
+
+    def _command(self, *, gpu: bool) -> List[str]:
+        if self._runner == 'local':
+            return [sys.executable, '-u', self._server_script_path]
+        elif self._runner == 'singularity':
+            return ['singularity', 'exec', '-e'] + (['--nv'] if gpu else []) + [
+                '-B', '{}:/kachery-storage'.format(self._kachery_storage_dir),
+                '-B', '{}:{}'.format(self._session_dir, self._session_dir),
+                self._container,
+                'python3', '-u', self._server_script_path
+            ]
+        else:
+            from ._run_function_in_container import _docker_form_of_container_string
+            return ['docker', 'run', '-i', '--rm'] + (['--gpus', 'all'] if gpu else []) + [
+                '-v', '/etc/localtime:/etc/localtime:ro',
+                '-v', '/etc/passwd:/etc/passwd', '-u', '{}:{}'.format(os.getuid(), os.getgid()),
+                '-v', '{}:/kachery-storage'.format(self._kachery_storage_dir),
+                '-v', '{}:{}'.format(self._session_dir, self._session_dir),
+                '-v', '/tmp:/tmp',
+                '-v', '{}:{}'.format(os.environ['HOME'], os.environ['HOME']),
+                _docker_form_of_container_string(self._container),
+                'python3', '-u', self._server_script_path
+            ]
+
+    def _send(self, msg: dict) -> None:
+        try:
+            self._process.stdin.write((json.dumps(msg) + '\n').encode('utf-8'))
+            self._process.stdin.flush()
+        except BrokenPipeError:
+            raise Exception('Warm container session for {} exited unexpectedly'.format(self._container))
+
+    def _receive(self, timeout: float) -> Union[dict, None]:
+        fd = self._process.stdout.fileno()
+        while b'\n' not in self._buffer:
+            ready, _, _ = select.select([fd], [], [], timeout)
+            if len(ready) == 0:
+                return None
+            x = os.read(fd, 4096)
+            if len(x) == 0:
+                return None
+            self._buffer = self._buffer + x
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return json.loads(line.decode('utf-8'))
+
+# Runs inside the container with python3 (it must not depend on anything but the standard library)
+_server_script = """
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import select
+import signal
+import runpy
+import traceback
+
+def main():
+    # The protocol uses the original stdout -- anything else printed goes to stderr
+    protocol_out = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+    for module_name in os.environ.get('HITHER_WARM_CONTAINER_PRELOAD', '').split(','):
+        if module_name:
+            try:
+                __import__(module_name)
+            except:
+                print('Unable to preload module: ' + module_name)
+    running = dict() # pid -> job id
+    buffer = b''
+    stdin_open = True
+    while stdin_open or (len(running) > 0):
+        if stdin_open:
+            ready, _, _ = select.select([0], [], [], 0.1)
+            if len(ready) > 0:
+                x = os.read(0, 4096)
+                if len(x) == 0:
+                    stdin_open = False
+                    for pid in running.keys():
+                        os.kill(pid, signal.SIGKILL)
+                buffer = buffer + x
+            while b'\\n' in buffer:
+                line, buffer = buffer.split(b'\\n', 1)
+                msg = json.loads(line.decode('utf-8'))
+                if msg['type'] == 'run':
+                    pid = os.fork()
+                    if pid == 0:
+                        _run_job(msg)
+                    running[pid] = msg['job_id']
+                elif msg['type'] == 'cancel':
+                    for pid, job_id in running.items():
+                        if job_id == msg['job_id']:
+                            os.kill(pid, signal.SIGKILL)
+        else:
+            select.select([], [], [], 0.1)
+        while len(running) > 0:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            job_id = running.pop(pid)
+            if os.WIFEXITED(status):
+                exit_code = os.WEXITSTATUS(status)
+            else:
+                exit_code = -1
+            protocol_out.write(json.dumps(dict(job_id=job_id, exit_code=exit_code)) + '\\n')
+            protocol_out.flush()
+
+def _run_job(msg):
+    exit_code = 0
+    try:
+        run_dir = msg['run_dir']
+        fd = os.open(os.path.join(run_dir, 'console.txt'), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+        for k, v in msg['env'].items():
+            os.environ[k] = v
+        sys.path[0:0] = [run_dir] + [p for p in msg['env'].get('PYTHONPATH', '').split(':') if p]
+        sys.argv = [os.path.join(run_dir, 'run.py')]
+        runpy.run_path(os.path.join(run_dir, 'run.py'), run_name='__main__')
+    except SystemExit as e:
+        # as in CPython: None is success, and any other non-integer is failure
+        if e.code is None:
+            exit_code = 0
+        elif isinstance(e.code, int):
+            exit_code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    except:
+        traceback.print_exc()
+        exit_code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(exit_code)
+
+if __name__ == '__main__':
+    main()
+"""
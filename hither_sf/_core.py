@@ -6,13 +6,15 @@ import random
 # import tempfile
 import traceback
 import time
-from typing import Union, Any, Dict, List
+from typing import Union, Any, Dict, List, Tuple, Optional
 from copy import deepcopy
 from ._etconf import ETConf
 from ._preventkeyboardinterrupt import PreventKeyboardInterrupt
 from ._shellscript import ShellScript
 from ._consolecapture import ConsoleCapture
 from ._run_function_in_container import run_function_in_container, _serialize_runnable_function
+from ._jobgraph import _JobGraph
+from ._cache import _get_cache_backend
 
 _global_config = ETConf(
     defaults=dict(
@@ -27,14 +29,26 @@ _global_config = ETConf(
         show_console=None, # None means True
         show_cached_console=None, # None means False
         job_timeout=None,
-        log_path=None
+        log_path=None,
+        resources=None # overrides the resources declared with @hither.resources
     )
 )
 
-_global: Dict[str, Union[list, bool]] = dict(
-    pending_jobs=[], # waiting for inputs to be ready - not yet sent to job handler
-    queued_jobs=[], # inputs are ready, sent to job handler
+# Runtime (sec) assumed for functions without runtime history in the cache,
+# so that the dependency depth still counts when prioritizing jobs
+_DEFAULT_RUNTIME_ESTIMATE = 1
+
+# Maximum time (sec) that wait() will sleep between iterations of job handlers that
+# do not provide wait objects (see _wait_for_job_handlers)
+_JOB_HANDLER_POLL_INTERVAL = 0.2
+
+_global: Dict[str, Any] = dict(
+    job_graph=_JobGraph(), # pending jobs waiting for inputs to be ready - not yet sent to job handler
+    queued_jobs=dict(), # inputs are ready, sent to job handler -- id(job) -> job
     finished_jobs=[], # finished jobs
+    finished_job_events=[], # jobs that have reached a final state but have not yet been processed by wait()
+    running_jobs_by_hash=dict(), # (name, hash) -> queued job whose result may be shared by identical jobs
+    duplicate_jobs=dict(), # id(job) -> identical jobs waiting for the result of the job
     inside_job_queue=False,
     prepared_singularity_containers = [],
     pulled_docker_images = []
@@ -53,7 +67,8 @@ class config:
         show_console: Union[bool, None]=None,
         show_cached_console: Union[bool, None]=None,
         job_timeout: Union[float, None]=None,
-        log_path: Union[str, None]=None
+        log_path: Union[str, None]=None,
+        resources: Union[dict, None]=None
     ):
         self._config = dict(
             container=container,
@@ -67,7 +82,8 @@ class config:
             show_console=show_console,
             show_cached_console=show_cached_console,
             job_timeout=job_timeout,
-            log_path=log_path
+            log_path=log_path,
+            resources=resources
         )
         self._old_config = None
     def __enter__(self):
@@ -83,15 +99,23 @@ class job_queue:
         if _global['inside_job_queue']:
             raise Exception('Cannot be in more than one hither job queue')
         _global['inside_job_queue'] = True
-        _global['pending_jobs'] = []
-        _global['queued_jobs'] = []
+        _global['job_graph'] = _JobGraph()
+        _global['queued_jobs'] = dict()
         _global['finished_jobs'] = []
+        _global['finished_job_events'] = []
+        _global['running_jobs_by_hash'] = dict()
+        _global['duplicate_jobs'] = dict()
     def __exit__(self, exc_type, exc_val, exc_tb):
-        wait()
-        _global['inside_job_queue'] = False
-        _global['pending_jobs'] = []
-        _global['queued_jobs'] = []
-        _global['finished_jobs'] = []
+        try:
+            wait()
+        finally:
+            _global['inside_job_queue'] = False
+            _global['job_graph'] = _JobGraph()
+            _global['queued_jobs'] = dict()
+            _global['finished_jobs'] = []
+            _global['finished_job_events'] = []
+            _global['running_jobs_by_hash'] = dict()
+            _global['duplicate_jobs'] = dict()
 
 def set_config(
         container: Union[str, None]=None,
@@ -105,7 +129,8 @@ def set_config(
         show_console: Union[bool, None]=None,
         show_cached_console: Union[bool, None]=None,
         job_timeout: Union[float, None]=None,
-        log_path: Union[str, None]=None
+        log_path: Union[str, None]=None,
+        resources: Union[dict, None]=None
 ) -> None:
     _global_config.set_config(
         container=container,
@@ -119,7 +144,8 @@ def set_config(
         show_console=show_console,
         show_cached_console=show_cached_console,
         job_timeout=job_timeout,
-        log_path=log_path
+        log_path=log_path,
+        resources=resources
     )
 
 def get_config() -> dict:
@@ -145,6 +171,7 @@ def function(name, version):
             _show_cached_console = config['show_cached_console']
             if _show_cached_console is None: _show_cached_console = False
             _job_timeout=config['job_timeout']
+            _resources = _resolve_job_resources(f, config=config['resources'], gpu=_gpu)
 
             if hasattr(f, '_hither_containers'):
                 if _container in getattr(f, '_hither_containers'):
@@ -249,10 +276,11 @@ def function(name, version):
                 show_console=_show_console,
                 show_cached_console=_show_cached_console,
                 status='pending',
-                timeout=_job_timeout
+                timeout=_job_timeout,
+                resources=_resources
             )
             if _global['inside_job_queue'] and job['job_handler'] is not None:
-                _global['pending_jobs'].append(job)
+                _global['job_graph'].add_job(job)
             else:
                 if job['job_handler'] is not None:
                     raise Exception('Cannot use job handler without a job queue')
@@ -266,6 +294,7 @@ def function(name, version):
                             raise Exception(f'Job [{_label}] is not ready and you are not using a job handler.')
                     _prepare_job_to_run(job)
                     if not _check_cache_for_job_result(job, cache=job['cache']):
+                        _load_input_files(job)
                         if job['container'] is not None:
                             _prepare_container(job['container'])
                         _run_job(job)
@@ -284,7 +313,8 @@ def function(name, version):
                         if job['cache'] is not None:
                             if job['result'].success or job['cache_failing']:
                                 _write_to_log('Storing result for [{}] success={}'.format(job.get('label', job['name']), job['result'].success))
-                                _store_job_result_in_cache(result=result, cache=job['cache'])
+                                _store_job_result_in_cache(result=result, hash=job['hash'], cache=job['cache'])
+                        _notify_job_finished(job)
             return job['result']
         setattr(f, 'run', run)
         return f
@@ -338,6 +368,14 @@ def _prepare_job_to_run(job):
         else:
             x = kwargs[iname]
             # a hither File object
+            sha1 = x._unloaded_sha1()
+            if sha1 is not None:
+                # a cached output that has not been loaded from kachery -- we know its hash,
+                # and it is only loaded if the job needs to run (see _load_input_files)
+                hash_object['input_files'][iname] = dict(sha1=sha1)
+                input_file_keys.append(iname)
+                resolved_input_files[iname] = x
+                continue
             if x._path is None:
                 raise Exception('Unexpected: input file has no path: {}'.format(iname))
             # we really want the path
@@ -392,6 +430,17 @@ def _prepare_job_to_run(job):
     job['input_file_extensions'] = input_file_extensions
     job['output_file_keys'] = output_file_keys
     job['output_file_extensions'] = output_file_extensions
+    # the hash object is complete now that the input files are resolved
+    job['hash'] = ka.get_object_hash(hash_object)
+
+def _load_input_files(job):
+    # Load the input files that were left unloaded by _prepare_job_to_run
+    resolved_kwargs = job['resolved_kwargs']
+    for iname in job['input_file_keys']:
+        x = resolved_kwargs[iname]
+        if isinstance(x, File):
+            resolved_kwargs[iname] = x._path
+            job['input_file_extensions'][iname] = _file_extension(x._path)
 
 def _write_to_log(txt):
     print(f'===== Hither: {txt}')
@@ -476,68 +525,72 @@ def _run_job(job):
 
 def wait(timeout: Union[float, None]=None):
     try:
+        _prioritize_pending_jobs()
         timer = time.time()
         timer_show_summary = time.time()
         while True:
-            pending_jobs = _global['pending_jobs']
+            job_graph = _global['job_graph']
             queued_jobs = _global['queued_jobs']
             finished_jobs = _global['finished_jobs']
-            if len(pending_jobs) == 0 and len(queued_jobs) == 0:
-                _cleanup_job_handlers()
-                break
-            new_pending_jobs = []
-            active_job_handlers = []
-            for job in pending_jobs:
-                active_job_handlers.append(job['job_handler'])
-                if job['status'] == 'pending':
-                    if _job_inputs_have_failed(job):
-                        _set_job_as_failed_due_to_failing_inputs(job)
-                    elif _job_is_ready(job):
-                        _prepare_job_to_run(job)
-                        if not _check_cache_for_job_result(job, cache=job['cache']):
-                            if job['container'] is not None:
-                                _prepare_container(job['container'])
+
+            # Handle the jobs that have reached a final state since the last iteration
+            # This releases the pending jobs that depend on their outputs
+            _handle_finished_job_events()
+
+            # Prepare the jobs whose inputs are ready and send them to the job handlers
+            ready_jobs = []
+            for job in job_graph.pop_ready_jobs():
+                if _job_inputs_have_failed(job):
+                    _set_job_as_failed_due_to_failing_inputs(job)
+                    continue
+                _prepare_job_to_run(job)
+                ready_jobs.append(job)
+            found_in_cache = _check_cache_for_job_results(ready_jobs)
+            for job, found in zip(ready_jobs, found_in_cache):
+                if not found:
+                    key = _job_sharing_key(job)
+                    if key is not None:
+                        running_job = _global['running_jobs_by_hash'].get(key, None)
+                        if running_job is not None:
+                            # identical to a job that is already queued, so it shares that result
+                            _write_to_log('Sharing the result of an identical job for [{}]'.format(job.get('label', job['name'])))
                             job['status'] = 'queued'
-                            queued_jobs.append(job)
-                            job_handler = job['job_handler']
-
-                            _exception_on_fail = job.get('exception_on_fail', None)
-                            if _exception_on_fail is None: _exception_on_fail = True
-                            _label = job.get('label', job.get('name'))
-                            
-                            if job_handler:
-                                job_handler.handle_job(job)
-                            else:
-                                _run_job(job)
-                                result0 = job['result']
-                                if not result0.success:
-                                    if _exception_on_fail:
-                                        raise Exception(f'Error running job: {_label}')
-                                if job['cache'] is not None:
-                                    _write_to_log('Storing result for [{}] success={}'.format(job.get('label', job['name']), job['result'].success))
-                                    _store_job_result_in_cache(result=result0, cache=job['cache'])
-                    else:
-                        new_pending_jobs.append(job)
-            _global['pending_jobs'] = new_pending_jobs
-
-            new_queued_jobs = []
-            for job in queued_jobs:
-                active_job_handlers.append(job['job_handler'])
-                if job['status'] in ['finished', 'error']:
-                    if job['cache'] is not None:
-                        _write_to_log('Storing result for [{}] success={}'.format(job.get('label', job['name']), job['result'].success))
-                        _store_job_result_in_cache(result=job['result'], cache=job['cache'])
-                if job['status'] == 'queued':
-                    new_queued_jobs.append(job)
-                elif job['status'] == 'finished':
-                    finished_jobs.append(job)
-                elif job['status'] == 'error':
+                            queued_jobs[id(job)] = job
+                            _global['duplicate_jobs'].setdefault(id(running_job), []).append(job)
+                            continue
+                        _global['running_jobs_by_hash'][key] = job
+                    _load_input_files(job)
+                    if job['container'] is not None:
+                        _prepare_container(job['container'])
+                    job['status'] = 'queued'
+                    queued_jobs[id(job)] = job
+                    job_handler = job['job_handler']
+
                     _exception_on_fail = job.get('exception_on_fail', None)
                     if _exception_on_fail is None: _exception_on_fail = True
                     _label = job.get('label', job.get('name'))
-                    if _exception_on_fail:
-                        raise Exception(f'Error running job: {_label}')
-            _global['queued_jobs'] = new_queued_jobs
+                    
+                    if job_handler:
+                        job_handler.handle_job(job)
+                    else:
+                        _run_job(job)
+                        result0 = job['result']
+                        if not result0.success:
+                            if _exception_on_fail:
+                                raise Exception(f'Error running job: {_label}')
+                        _notify_job_finished(job)
+
+            if len(_global['finished_job_events']) > 0 or job_graph.has_ready_jobs():
+                # more state changes to take care of before we iterate the job handlers
+                continue
+
+            if len(queued_jobs) == 0:
+                if job_graph.num_pending_jobs() > 0:
+                    # Nothing is running, so nothing can produce the missing inputs
+                    labels = [job.get('label', job['name']) for job in job_graph.pending_jobs()]
+                    raise Exception('Inputs will never be ready for pending jobs: {}'.format(', '.join(labels)))
+                _cleanup_job_handlers()
+                break
 
             elapsed = time.time() - timer
             if timeout is not None:
@@ -545,42 +598,123 @@ def wait(timeout: Union[float, None]=None):
                     return
             
             # iterate the job handlers
-            unique_active_job_handlers = []
-            for h in active_job_handlers:
-                found = False
-                for h2 in unique_active_job_handlers:
-                    if h is h2:
-                        found = True
-                if not found:
-                    unique_active_job_handlers.append(h)
+            unique_active_job_handlers = _unique_job_handlers(queued_jobs.values())
             for h in unique_active_job_handlers:
                 h.iterate()
 
             elapsed_show_summary = time.time() - timer_show_summary
             if elapsed_show_summary > 10:
                 timer_show_summary = time.time()
-                _write_to_log(f'{len(pending_jobs)} pending, {len(queued_jobs)} queued, {len(finished_jobs)} finished')
-                
-
-            time.sleep(0.02)
+                _write_to_log(f'{job_graph.num_pending_jobs()} pending, {len(queued_jobs)} queued, {len(finished_jobs)} finished')
+
+            if len(_global['finished_job_events']) == 0:
+                # Block until some job handler has something to report
+                max_wait = 10 - elapsed_show_summary
+                if timeout is not None:
+                    max_wait = min(max_wait, timeout - elapsed)
+                _wait_for_job_handlers(unique_active_job_handlers, timeout=max(max_wait, 0))
     except:
         _cleanup_job_handlers()
         raise
 
+def _job_sharing_key(job):
+    # Identical jobs (same function and hash object) in a job queue run only once. This
+    # is restricted to jobs whose outputs are all temporary files, since the output paths
+    # are not part of the hash object.
+    for oname in job['result']._output_names:
+        if not getattr(job['result'].outputs, oname)._is_temporary:
+            return None
+    return (job['name'], job['hash'])
+
+def _prioritize_pending_jobs():
+    # Long jobs and jobs on the critical path are sent to the job handlers first
+    job_graph = _global['job_graph']
+    jobs = job_graph.pending_jobs()
+    if len(jobs) == 0:
+        return
+    if all(['priority' in job for job in jobs]):
+        return
+    runtime_history = _load_runtime_history(jobs)
+    job_graph.compute_priorities(lambda job: runtime_history.get(job['name'], _DEFAULT_RUNTIME_ESTIMATE))
+    makespan = job_graph.estimate_makespan(lambda h: h.num_parallel_slots() if hasattr(h, 'num_parallel_slots') else None)
+    critical_path = max([job['priority'] for job in jobs])
+    num_without_history = len([job for job in jobs if job['name'] not in runtime_history])
+    _write_to_log(f'{len(jobs)} jobs: expected makespan {makespan:.1f} sec; critical path {critical_path:.1f} sec ({num_without_history} jobs without runtime history)')
+
+def _notify_job_finished(job):
+    # Called whenever a job reaches a final state (finished or error). The job
+    # handlers report back through _set_result(), which ends up here.
+    if _global['inside_job_queue']:
+        _global['finished_job_events'].append(job)
+
+def _handle_finished_job_events():
+    job_graph = _global['job_graph']
+    queued_jobs = _global['queued_jobs']
+    finished_jobs = _global['finished_jobs']
+    while len(_global['finished_job_events']) > 0:
+        events = _global['finished_job_events']
+        _global['finished_job_events'] = []
+        for job in events:
+            job_graph.job_finished(job)
+            if id(job) not in queued_jobs:
+                continue
+            del queued_jobs[id(job)]
+            if job['cache'] is not None:
+                _write_to_log('Storing result for [{}] success={}'.format(job.get('label', job['name']), job['result'].success))
+                _store_job_result_in_cache(result=job['result'], hash=job['hash'], cache=job['cache'])
+            key = (job['name'], job['hash'])
+            if _global['running_jobs_by_hash'].get(key, None) is job:
+                del _global['running_jobs_by_hash'][key]
+            for duplicate_job in _global['duplicate_jobs'].pop(id(job), []):
+                del queued_jobs[id(duplicate_job)]
+                _set_result(duplicate_job, job['result'])
+                if duplicate_job['status'] == 'finished':
+                    finished_jobs.append(duplicate_job)
+            if job['status'] == 'finished':
+                finished_jobs.append(job)
+            elif job['status'] == 'error':
+                _exception_on_fail = job.get('exception_on_fail', None)
+                if _exception_on_fail is None: _exception_on_fail = True
+                _label = job.get('label', job.get('name'))
+                if _exception_on_fail:
+                    raise Exception(f'Error running job: {_label}')
+
+def _wait_for_job_handlers(job_handlers, timeout):
+    # A job handler may provide a wait_objects() method returning objects
+    # (e.g., multiprocessing connections) that become ready when the handler
+    # has something to report. Otherwise we need to poll the handler.
+    from multiprocessing.connection import wait as wait_for_objects
+    wait_objects = []
+    poll = False
+    for h in job_handlers:
+        if hasattr(h, 'wait_objects'):
+            wait_objects.extend(h.wait_objects())
+        else:
+            poll = True
+    if poll or (len(wait_objects) == 0):
+        timeout = min(timeout, _JOB_HANDLER_POLL_INTERVAL)
+    if len(wait_objects) > 0:
+        wait_for_objects(wait_objects, timeout=timeout)
+    else:
+        time.sleep(timeout)
+
+def _unique_job_handlers(jobs):
+    unique_job_handlers = []
+    for job in jobs:
+        h = job['job_handler']
+        if h is None:
+            continue
+        found = False
+        for h2 in unique_job_handlers:
+            if h is h2:
+                found = True
+        if not found:
+            unique_job_handlers.append(h)
+    return unique_job_handlers
+
 def _cleanup_job_handlers():
     with PreventKeyboardInterrupt():
-        all_job_handlers = []
-        for job in _global['pending_jobs'] + _global['queued_jobs'] + _global['finished_jobs']:
-            if job['job_handler'] is not None:
-                all_job_handlers.append(job['job_handler'])
-        unique_job_handlers = []
-        for h in all_job_handlers:
-            found = False
-            for h2 in unique_job_handlers:
-                if h is h2:
-                    found = True
-            if not found:
-                unique_job_handlers.append(h)
+        unique_job_handlers = _unique_job_handlers(_global['job_graph'].pending_jobs() + list(_global['queued_jobs'].values()) + _global['finished_jobs'])
         if len(unique_job_handlers) > 0:
             print('Cleaning up job handlers...')
             for h in unique_job_handlers:
@@ -643,6 +777,41 @@ def additional_files(additional_files):
         return f
     return wrap
 
+def resources(num_cores: Union[int, None]=None, ram_gb: Union[float, None]=None, num_gpus: Union[int, None]=None):
+    """Declare the resources needed to run a function (used by job handlers that pack jobs onto capacity)
+
+    Parameters
+    ----------
+    num_cores : Union[int, None], optional
+        Number of cpu cores used by the job, by default 1
+    ram_gb : Union[float, None], optional
+        Peak RAM usage of the job in GB, by default 0
+    num_gpus : Union[int, None], optional
+        Number of GPU slots used by the job, by default 1 if the job is run with gpu=True, otherwise 0
+    """
+    def wrap(f):
+        hither_resources = getattr(f, '_hither_resources', dict())
+        for k, v in dict(num_cores=num_cores, ram_gb=ram_gb, num_gpus=num_gpus).items():
+            if v is not None:
+                hither_resources[k] = v
+        setattr(f, '_hither_resources', hither_resources)
+        return f
+    return wrap
+
+def _resolve_job_resources(f, *, config: Union[dict, None], gpu: Union[bool, None]) -> dict:
+    ret = dict(
+        num_cores=1,
+        ram_gb=0,
+        num_gpus=1 if gpu else 0
+    )
+    for x in [getattr(f, '_hither_resources', dict()), config or dict()]:
+        for k, v in x.items():
+            if k not in ret:
+                raise Exception('Unexpected resource: {}'.format(k))
+            if v is not None:
+                ret[k] = v
+    return ret
+
 def parameter(name: str, required=True, default=None):
     def wrap(f):
         hither_parameters = getattr(f, '_hither_parameters', [])
@@ -656,19 +825,49 @@ def parameter(name: str, required=True, default=None):
     return wrap
 
 def _check_cache_for_job_result(job, *, cache):
+    if not _job_uses_cache(job, cache=cache):
+        return False
+    result0 = _load_job_result_from_cache(name=job['name'], hash=job['hash'], cache=cache)
+    if result0 is None:
+        _write_to_log('Did not find cached result for [{}]'.format(job.get('label', job['name'])))
+        return False
+    # the message is shared with the memo
+    result0 = _internal_deserialize_result(deepcopy(result0))
+    return _use_cached_job_result(job, result0)
+
+def _check_cache_for_job_results(jobs) -> List[bool]:
+    """Same as _check_cache_for_job_result() for many jobs at once. There is one
+    cache query per cache configuration.
+    """
+    ret = [False for _ in jobs]
+    jobs_by_cache: Dict[str, Any] = dict()
+    for ii, job in enumerate(jobs):
+        if _job_uses_cache(job, cache=job['cache']):
+            k = json.dumps(job['cache'], sort_keys=True)
+            if k not in jobs_by_cache:
+                jobs_by_cache[k] = (job['cache'], [])
+            jobs_by_cache[k][1].append(ii)
+    for cache, indices in jobs_by_cache.values():
+        results0 = _load_job_results_from_cache(keys=[(jobs[ii]['name'], jobs[ii]['hash']) for ii in indices], cache=cache)
+        for ii, result0 in zip(indices, results0):
+            if result0 is None:
+                _write_to_log('Did not find cached result for [{}]'.format(jobs[ii].get('label', jobs[ii]['name'])))
+            else:
+                # the message is shared with the memo (and with identical jobs)
+                ret[ii] = _use_cached_job_result(jobs[ii], _internal_deserialize_result(deepcopy(result0)))
+    return ret
+
+def _job_uses_cache(job, *, cache):
+    if cache is None or job['force_run']:
+        return False
+    return True
+
+def _use_cached_job_result(job, result0):
     _cache_failing = job['cache_failing']
     _rerun_failing = job['rerun_failing']
-    _force_run = job['force_run']
     _exception_on_fail = job['exception_on_fail']
     _show_cached_console = job['show_cached_console']
     if _exception_on_fail is None: _exception_on_fail = True
-    if cache is None or _force_run:
-        return False
-    result0 = _load_job_result_from_cache(hash_object=job['hash_object'], cache=cache)
-    if result0 is None:
-        _write_to_log('Did not find cached result for [{}]'.format(job.get('label', job['name'])))
-        return False
-    result0 = _internal_deserialize_result(result0)
     if result0 is None:
         _write_to_log('Unable to deserialize cached result for [{}]'.format(job.get('label', job['name'])))
         return False
@@ -683,9 +882,8 @@ def _check_cache_for_job_result(job, *, cache):
     
     result = job['result']
     _set_result(job, result0)
-    console_out_str = _console_out_to_str(result.runtime_info['console_out'])
     if _show_cached_console:
-        print(console_out_str)
+        print(_console_out_to_str(result.runtime_info['console_out']))
     return True
 
 def _set_result(job, result):
@@ -710,12 +908,10 @@ def _set_result(job, result):
     for oname in result2._output_names:
         output1 = getattr(result1.outputs, oname)
         output2 = getattr(result2.outputs, oname)
-        output1._path = output2._path
-        output1._exists = output2._exists
-        output1._failed = output2._failed
-        output1._is_temporary = output2._is_temporary
+        _copy_file_state(output1, output2)
         
         setattr(result1.outputs, oname, getattr(result2.outputs, oname))
+    _notify_job_finished(job)
 
 def _set_job_as_failed_due_to_failing_inputs(job):
     result = job['result']
@@ -729,27 +925,63 @@ def _set_job_as_failed_due_to_failing_inputs(job):
     result.retval = None
     result.status = 'error'
     job['status'] = 'error'
+    _notify_job_finished(job)
+
+def _load_job_result_from_cache(*, name, hash, cache):
+    return _load_job_results_from_cache(keys=[(name, hash)], cache=cache)[0]
+
+def _load_runtime_history(jobs) -> Dict[str, float]:
+    # Median elapsed_sec of the most recent successful cached results of each function.
+    # The history of each (cache, function) is loaded once per process.
+    names_by_cache: Dict[str, Any] = dict()
+    for job in jobs:
+        if job['cache'] is not None:
+            k = json.dumps(job['cache'], sort_keys=True)
+            if k not in names_by_cache:
+                names_by_cache[k] = (job['cache'], set())
+            names_by_cache[k][1].add(job['name'])
+    ret = dict()
+    for k, (cache, names) in names_by_cache.items():
+        names_to_load = sorted([name0 for name0 in names if (k, name0) not in _runtime_history])
+        if len(names_to_load) > 0:
+            elapsed_by_name: Dict[str, List[float]] = dict()
+            for name0, elapsed0 in _get_cache_backend(cache).find_elapsed_sec(names_to_load):
+                elapsed_by_name.setdefault(name0, []).append(elapsed0)
+            for name0 in names_to_load:
+                elapsed = sorted(elapsed_by_name.get(name0, []))
+                _runtime_history[(k, name0)] = elapsed[len(elapsed) // 2] if len(elapsed) > 0 else None
+        for name0 in names:
+            if _runtime_history[(k, name0)] is not None:
+                ret[name0] = _runtime_history[(k, name0)]
+    return ret
 
-def _load_job_result_from_cache(*, hash_object, cache):
-    import kachery as ka
-    import loggery
-    if type(cache) == str:
-        cache = dict(preset=cache)
-    with loggery.config(**cache):
-        name0 = 'hither_result'
-        hash0 = ka.get_object_hash(hash_object)
-        doc = loggery.find_one({'message.name': name0, 'message.hash': hash0})
-        if doc is None:
-            return None
-        return doc['message']
-
-def _store_job_result_in_cache(*, result, cache):
-    import loggery
-    serialized_result = _internal_serialize_result(result)
-    if type(cache) == str:
-        cache = dict(preset=cache)
-    with loggery.config(**cache):
-        loggery.insert_one(message=serialized_result)
+# (cache key, function name) -> median elapsed sec (or None if there is no history)
+_runtime_history: Dict[Tuple[str, str], Optional[float]] = dict()
+
+def _load_job_results_from_cache(*, keys, cache):
+    # keys is a list of (function name, hash). Results that are not in the in-memory
+    # memo are loaded with one query. Returns the most recent message for each key (or None).
+    # The messages are shared with the memo and must not be modified.
+    backend = _get_cache_backend(cache)
+    messages = dict()
+    missing_hashes = []
+    for name0, hash0 in keys:
+        message = backend.memo.get(name0, hash0)
+        if message is not None:
+            messages[hash0] = message
+        else:
+            missing_hashes.append(hash0)
+    if len(missing_hashes) > 0:
+        for hash0, message in backend.find_results(missing_hashes).items():
+            backend.memo.put(message['hash_object']['name'], hash0, message)
+            messages[hash0] = message
+    return [messages.get(hash0, None) for _, hash0 in keys]
+
+def _store_job_result_in_cache(*, result, hash, cache):
+    serialized_result = _internal_serialize_result(result, hash=hash)
+    backend = _get_cache_backend(cache)
+    backend.insert_result(serialized_result)
+    backend.memo.put(serialized_result['hash_object']['name'], hash, serialized_result)
 
 class Result():
     def __init__(self):
@@ -780,7 +1012,7 @@ class Result():
             setattr(self.outputs, oname, ff)
 
 # This is confusing -- it is a different type of serialization than result.serialize()!
-def _internal_serialize_result(result):
+def _internal_serialize_result(result, *, hash: Union[str, None]=None):
     import kachery as ka
     ret: Dict[Any] = dict(
         output_files=dict()
@@ -802,7 +1034,7 @@ def _internal_serialize_result(result):
     ret['version'] = result.version
     ret['container'] = result.container
     ret['hash_object'] = result.hash_object
-    ret['hash'] = ka.get_object_hash(result.hash_object)
+    ret['hash'] = hash if hash is not None else ka.get_object_hash(result.hash_object)
     ret['status'] = result.status
     return ret
 
@@ -811,21 +1043,16 @@ def _internal_deserialize_result(obj):
     import kachery as ka
     result = Result()
     
-    result.runtime_info = obj['runtime_info']
-    result.runtime_info['console_out'] = ka.load_object(result.runtime_info.get('console_out', ''))
-    if result.runtime_info['console_out'] is None:
-        return None
+    # The console output and the output files are loaded from kachery on first access
+    result.runtime_info = _LazyRuntimeInfo(obj['runtime_info'])
     
     output_files = obj['output_files']
     for oname, path in output_files.items():
         if path is not None:
-            path2 = ka.load_file(path)
-            if path2 is None:
-                print('Unable to find file when deserializing result.')
-                return None
+            ff = _lazy_file(path)
         else:
-            path2 = None
-        setattr(result.outputs, oname, File(path2))
+            ff = File(None)
+        setattr(result.outputs, oname, ff)
         result._output_names.append(oname)
     
     result.retval = obj['retval']
@@ -836,6 +1063,64 @@ def _internal_deserialize_result(obj):
     result.status = obj['status']
     return result
 
+class _LazyRuntimeInfo(dict):
+    # runtime_info of a cached result, where console_out is a kachery URI until it is accessed.
+    # Every way of reading the values (including iteration, copies, pickling and json.dump) loads
+    # it first, so that this behaves like the runtime_info of a result that was just computed.
+    def __getitem__(self, key):
+        if key == 'console_out':
+            self._load_console_out()
+        return super().__getitem__(key)
+    def get(self, key, default=None):
+        if key == 'console_out' and key in self:
+            self._load_console_out()
+        return super().get(key, default)
+    def __iter__(self):
+        # Also makes dict(x) and {**x} go through keys() and __getitem__
+        self._load_console_out()
+        return super().__iter__()
+    def items(self):
+        self._load_console_out()
+        return super().items()
+    def values(self):
+        self._load_console_out()
+        return super().values()
+    def copy(self):
+        self._load_console_out()
+        return dict(self)
+    def pop(self, *args):
+        self._load_console_out()
+        return super().pop(*args)
+    def popitem(self):
+        self._load_console_out()
+        return super().popitem()
+    def setdefault(self, key, default=None):
+        self._load_console_out()
+        return super().setdefault(key, default)
+    def __eq__(self, other):
+        self._load_console_out()
+        return super().__eq__(other)
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    __hash__ = None
+    def __repr__(self):
+        self._load_console_out()
+        return super().__repr__()
+    def __reduce_ex__(self, protocol):
+        # copy, deepcopy and pickle give a plain dict
+        self._load_console_out()
+        return (dict, (dict(super().items()),))
+    def _load_console_out(self):
+        import kachery as ka
+        if not super().__contains__('console_out'):
+            return
+        x = super().__getitem__('console_out')
+        if type(x) == str:
+            y = ka.load_object(x)
+            if y is None:
+                raise Exception('Unable to load console output: {}'.format(x))
+            super().__setitem__('console_out', y)
+
 def _serialize_runnable_job(job):
     job_serialized = dict()
     for k,v in job.items():
@@ -908,6 +1193,26 @@ class File():
             self._failed = False
             self._is_temporary = False
         self._path = path
+    @property
+    def _path(self):
+        # The output files of cached results are only loaded from kachery when the path is needed
+        if self._unloaded_uri is not None:
+            import kachery as ka
+            path = ka.load_file(self._unloaded_uri)
+            if path is None:
+                raise Exception('Unable to load file: {}'.format(self._unloaded_uri))
+            self._loaded_path = path
+            self._unloaded_uri = None
+        return self._loaded_path
+    @_path.setter
+    def _path(self, path: Union[str, None]):
+        self._loaded_path = path
+        self._unloaded_uri = None
+    def _unloaded_sha1(self) -> Union[str, None]:
+        # The sha1 hash of a file that has not yet been loaded from kachery (if known)
+        if (self._unloaded_uri is not None) and self._unloaded_uri.startswith('sha1://'):
+            return self._unloaded_uri[len('sha1://'):].split('/')[0]
+        return None
     def __str__(self):
         if self._path is not None:
             return 'hither.File({})'.format(self._path)
@@ -927,6 +1232,21 @@ class File():
         self._failed = obj['_failed']
         self._is_temporary = obj['_is_temporary']
 
+def _lazy_file(uri: str) -> File:
+    # An existing file that is loaded from kachery when its path is accessed
+    f = File(uri)
+    f._loaded_path = None
+    f._unloaded_uri = uri
+    return f
+
+def _copy_file_state(dest: File, src: File):
+    # Does not load src if it is lazy
+    dest._loaded_path = src._loaded_path
+    dest._unloaded_uri = src._unloaded_uri
+    dest._exists = src._exists
+    dest._failed = src._failed
+    dest._is_temporary = src._is_temporary
+
 def _handle_temporary_outputs(outputs: List[File]):
     import kachery as ka
     for output in outputs:
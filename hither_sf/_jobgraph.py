@@ -0,0 +1,170 @@
+from collections import deque
+import heapq
+from typing import Dict, List, Any, Callable, Optional
+
+class _JobGraph:
+    """Dependency graph of the pending jobs in a hither job queue
+
+    A pending job is released (becomes ready) once all of its input files
+    have been produced, or as soon as one of them has failed. Jobs are
+    only revisited when one of the files they are waiting on changes state,
+    so the cost of scheduling grows with the number of finished jobs rather
+    than with the number of pending jobs.
+    """
+    def __init__(self):
+        self._pending_jobs: Dict[int, Dict[str, Any]] = dict() # id(job) -> job
+        self._num_unresolved_inputs: Dict[int, int] = dict() # id(job) -> number of input files not yet resolved
+        self._jobs_waiting_on_file: Dict[int, List[Dict[str, Any]]] = dict() # id(File) -> jobs
+        self._ready_jobs = deque()
+
+    def add_job(self, job: Dict[str, Any]) -> None:
+        job_id = id(job)
+        self._pending_jobs[job_id] = job
+        num_unresolved = 0
+        for f in job['hash_object']['input_files'].values():
+            if f._failed:
+                num_unresolved = 0
+                break
+            if not f._exists:
+                num_unresolved = num_unresolved + 1
+                self._jobs_waiting_on_file.setdefault(id(f), []).append(job)
+        self._num_unresolved_inputs[job_id] = num_unresolved
+        if num_unresolved == 0:
+            self._release_job(job)
+
+    def job_finished(self, job: Dict[str, Any]) -> None:
+        """Notify the graph that a job has reached a final state (finished or error)
+
+        The output files of the job are now either produced or failed, so the
+        jobs waiting on them are updated.
+        """
+        for f in _job_output_files(job):
+            for waiting_job in self._jobs_waiting_on_file.pop(id(f), []):
+                waiting_job_id = id(waiting_job)
+                if waiting_job_id not in self._pending_jobs:
+                    # already released (e.g., some other input has failed)
+                    continue
+                self._num_unresolved_inputs[waiting_job_id] -= 1
+                if f._failed or (self._num_unresolved_inputs[waiting_job_id] == 0):
+                    self._release_job(waiting_job)
+
+    def pop_ready_jobs(self) -> List[Dict[str, Any]]:
+        # highest priority first (see compute_priorities)
+        ret = sorted(self._ready_jobs, key=lambda job: -job.get('priority', 0))
+        self._ready_jobs.clear()
+        return ret
+
+    def dependent_jobs(self, job: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """The pending jobs that use some output of this job as input"""
+        ret = []
+        for f in _job_output_files(job):
+            for waiting_job in self._jobs_waiting_on_file.get(id(f), []):
+                if (id(waiting_job) in self._pending_jobs) and (not any(x is waiting_job for x in ret)):
+                    ret.append(waiting_job)
+        return ret
+
+    def compute_priorities(self, runtime_estimate: Callable[[Dict[str, Any]], float]) -> None:
+        """Set job['priority'] for all pending jobs to the length (in estimated seconds)
+        of the longest chain of jobs that starts with the job. Jobs on the critical path,
+        and long jobs, therefore have the highest priority.
+        """
+        jobs = self.pending_jobs()
+        estimates = dict()
+        for job in jobs:
+            estimates[id(job)] = runtime_estimate(job)
+        priorities: Dict[int, float] = dict()
+        # Iterative depth-first traversal (the chains may be long)
+        for job0 in jobs:
+            stack = [(job0, False)]
+            while len(stack) > 0:
+                job, children_done = stack.pop()
+                if id(job) in priorities:
+                    continue
+                dependents = self.dependent_jobs(job)
+                if children_done:
+                    p = 0
+                    for d in dependents:
+                        p = max(p, priorities[id(d)])
+                    priorities[id(job)] = estimates[id(job)] + p
+                    job['priority'] = priorities[id(job)]
+                else:
+                    stack.append((job, True))
+                    for d in dependents:
+                        if id(d) not in priorities:
+                            stack.append((d, False))
+        for job in jobs:
+            job['estimated_runtime'] = estimates[id(job)]
+
+    def estimate_makespan(self, num_parallel_slots: Callable[[Any], Optional[int]]) -> float:
+        """Simulate running the pending jobs in priority order (see compute_priorities) and return the
+        expected total elapsed time. num_parallel_slots(job_handler) gives the number of jobs that
+        the handler can run at once (None means unlimited).
+        """
+        jobs = self.pending_jobs()
+        num_remaining_inputs = dict()
+        for job in jobs:
+            num_remaining_inputs[id(job)] = 0
+        for job in jobs:
+            for d in self.dependent_jobs(job):
+                num_remaining_inputs[id(d)] = num_remaining_inputs[id(d)] + 1
+        slots = dict()
+        waiting = dict() # id(handler) -> heap of ready jobs
+        counter = 0
+        for job in jobs:
+            h = job['job_handler']
+            if id(h) not in slots:
+                slots[id(h)] = num_parallel_slots(h)
+                waiting[id(h)] = []
+        running: list = [] # heap of (end time, counter, job)
+        t = 0
+        def make_ready(job):
+            nonlocal counter
+            counter = counter + 1
+            heapq.heappush(waiting[id(job['job_handler'])], (-job.get('priority', 0), counter, job))
+        for job in jobs:
+            if num_remaining_inputs[id(job)] == 0:
+                make_ready(job)
+        while True:
+            # start what we can
+            for hid, w in waiting.items():
+                while (len(w) > 0) and ((slots[hid] is None) or (slots[hid] > 0)):
+                    _, _, job = heapq.heappop(w)
+                    if slots[hid] is not None:
+                        slots[hid] = slots[hid] - 1
+                    counter = counter + 1
+                    heapq.heappush(running, (t + job.get('estimated_runtime', 0), counter, job))
+            if len(running) == 0:
+                return t
+            t, _, job = heapq.heappop(running)
+            hid = id(job['job_handler'])
+            if slots[hid] is not None:
+                slots[hid] = slots[hid] + 1
+            for d in self.dependent_jobs(job):
+                num_remaining_inputs[id(d)] = num_remaining_inputs[id(d)] - 1
+                if num_remaining_inputs[id(d)] == 0:
+                    make_ready(d)
+
+    def has_ready_jobs(self) -> bool:
+        return len(self._ready_jobs) > 0
+
+    def pending_jobs(self) -> List[Dict[str, Any]]:
+        return list(self._pending_jobs.values()) + list(self._ready_jobs)
+
+    def num_pending_jobs(self) -> int:
+        return len(self._pending_jobs) + len(self._ready_jobs)
+
+    def _release_job(self, job: Dict[str, Any]) -> None:
+        job_id = id(job)
+        del self._pending_jobs[job_id]
+        del self._num_unresolved_inputs[job_id]
+        self._ready_jobs.append(job)
+
+def _job_output_files(job: Dict[str, Any]) -> list:
+    # These are the File objects that were passed in by the caller, and
+    # therefore the same objects that appear as inputs of downstream jobs
+    ret = []
+    for output_file in getattr(job['f'], '_hither_output_files', []):
+        x = job['kwargs'].get(output_file['name'], None)
+        if x is not None:
+            ret.append(x)
+    return ret
@@ -1,60 +1,296 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import time
+import pickle
 import multiprocessing
 from multiprocessing.connection import Connection
 import time
+import traceback
+import os
 import hither_sf as hither
+from ._resources import _Capacity
+from ._containersession import _set_one_job_per_process
 
 class ParallelJobHandler:
-    def __init__(self, num_workers):
+    def __init__(self, num_workers: Optional[int]=None, *,
+        pool: bool=False,
+        max_jobs_per_worker: Optional[int]=None,
+        num_cores: Optional[int]=None,
+        ram_gb: Optional[float]=None,
+        num_gpus: Optional[int]=None
+    ):
+        """Constructor for parallel job handler
+
+        Jobs are started in submission order as soon as they fit on the
+        available capacity (see @hither.resources), so smaller jobs can fill
+        in around large ones.
+
+        Parameters
+        ----------
+        num_workers : Optional[int]
+            Maximum number of jobs to run simultaneously. May be None if
+            any of num_cores, ram_gb or num_gpus is given.
+        pool : bool, optional
+            If True, run the jobs in num_workers long-lived worker processes
+            that are handed one job at a time, rather than starting a new
+            process for every job, by default False
+        max_jobs_per_worker : Optional[int], optional
+            Only applies in pool mode. If a number, each worker process is
+            replaced by a fresh one after running this many jobs, by default None
+        num_cores : Optional[int], optional
+            Total number of cpu cores available to the jobs, by default None (unlimited)
+        ram_gb : Optional[float], optional
+            Total RAM in GB available to the jobs, by default None (unlimited)
+        num_gpus : Optional[int], optional
+            Number of GPU slots. Each job is restricted to its slots through
+            CUDA_VISIBLE_DEVICES. By default None (unlimited and not assigned)
+        """
+        self._capacity = _Capacity(num_cores=num_cores, ram_gb=ram_gb, num_gpus=num_gpus)
+        if num_workers is None:
+            if pool:
+                raise Exception('num_workers must be specified in pool mode')
+            if not self._capacity.is_limited():
+                raise Exception('Either num_workers or some resource limit must be specified')
         self._num_workers = num_workers
+        self._pool = pool
+        self._max_jobs_per_worker = max_jobs_per_worker
+        self._waiting_jobs: List[dict] = [] # not yet started because there is no room
+        self._waiting_jobs_need_sort = False
         self._processes: List[dict] = []
         self._halted = False
 
+        # pool mode
+        self._pool_workers: List[dict] = []
+        self._pool_jobs: Dict[int, dict] = dict() # job index -> dict(job, allocation, job_pickled) (sent to the pool but not yet finished)
+        self._pool_undispatched: List[int] = [] # job indices not yet handed to a worker, in order
+        self._pool_last_job_index = 0
+
     def handle_job(self, job):
         import kachery as ka
-        pipe_to_parent, pipe_to_child = multiprocessing.Pipe()
-        process = multiprocessing.Process(target=_pjh_run_job, args=(pipe_to_parent, job, ka.get_config()))
-        self._processes.append(dict(
+        resources = _job_resources(job)
+        if not self._capacity.can_ever_fit(resources):
+            raise Exception('Cannot execute job [{}]. Resources exceed the capacity of the job handler: {}'.format(job.get('label', job.get('name', '<>')), resources))
+        self._waiting_jobs.append(dict(
             job=job,
-            process=process,
-            pipe_to_child=pipe_to_child,
-            pjh_status='pending'
+            kachery_config=ka.get_config()
         ))
-    
+        # highest priority first (stable, so otherwise in submission order)
+        self._waiting_jobs_need_sort = True
+
     def iterate(self):
         if self._halted:
             return
 
-        for p in self._processes:
-            if p['pjh_status'] == 'running':
-                if p['pipe_to_child'].poll():
-                    result_obj = p['pipe_to_child'].recv()
-                    p['pipe_to_child'].send('okay!')
-                    result0 = hither.Result()
-                    result0.deserialize(result_obj)
-                    hither._set_result(p['job'], result0)
-                    p['pjh_status'] = 'finished'
-        
-        num_running = 0
-        for p in self._processes:
-            if p['pjh_status'] == 'running':
+        if self._pool:
+            self._pool_iterate()
+        else:
+            for p in self._processes:
+                if p['pjh_status'] == 'running':
+                    if p['pipe_to_child'].poll():
+                        result_obj = p['pipe_to_child'].recv()
+                        p['pipe_to_child'].send('okay!')
+                        result0 = hither.Result()
+                        result0.deserialize(result_obj)
+                        self._capacity.release(p['allocation'])
+                        hither._set_result(p['job'], result0)
+                        p['pjh_status'] = 'finished'
+            self._processes = [p for p in self._processes if p['pjh_status'] != 'finished']
+
+        # Start the waiting jobs that fit
+        if self._waiting_jobs_need_sort:
+            self._waiting_jobs.sort(key=lambda w: -w['job'].get('priority', 0))
+            self._waiting_jobs_need_sort = False
+        if self._pool:
+            num_running = len(self._pool_jobs)
+        else:
+            num_running = len(self._processes)
+        waiting_jobs_after = []
+        for w in self._waiting_jobs:
+            resources = _job_resources(w['job'])
+            if (self._num_workers is not None) and (num_running >= self._num_workers):
+                waiting_jobs_after.append(w)
+            elif self._capacity.fits(resources):
+                allocation = self._capacity.allocate(resources)
+                if self._pool:
+                    self._pool_handle_job(w['job'], kachery_config=w['kachery_config'], allocation=allocation)
+                else:
+                    self._start_process(w['job'], kachery_config=w['kachery_config'], allocation=allocation)
                 num_running = num_running + 1
+            else:
+                waiting_jobs_after.append(w)
+        self._waiting_jobs = waiting_jobs_after
+
+        if self._pool:
+            self._pool_start_workers_as_needed()
+            self._pool_dispatch_jobs()
 
-        for p in self._processes:
-            if p['pjh_status'] == 'pending':
-                if num_running < self._num_workers:
-                    p['pjh_status'] = 'running'
-                    p['process'].start()
-                    num_running = num_running + 1
+    def wait_objects(self):
+        # The framework waits on these (multiprocessing.connection.wait) rather than polling
+        if self._pool:
+            ret = []
+            for w in self._pool_workers:
+                ret.append(w['pipe_to_child'])
+                ret.append(w['process'].sentinel)
+            return ret
+        return [p['pipe_to_child'] for p in self._processes if p['pjh_status'] == 'running']
+
+    def num_parallel_slots(self) -> Optional[int]:
+        """Maximum number of jobs that can run at once (None means unlimited), used to estimate the makespan"""
+        if self._num_workers is not None:
+            return self._num_workers
+        return self._capacity.max_parallel_jobs()
 
-        time.sleep(1)
     def cleanup(self):
-        pass
+        self._waiting_jobs = []
+        if self._pool:
+            self._pool_shutdown()
+
+    def _start_process(self, job, *, kachery_config: dict, allocation: dict):
+        pipe_to_parent, pipe_to_child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_pjh_run_job, args=(pipe_to_parent, job, kachery_config, self._job_environment(allocation)))
+        self._processes.append(dict(
+            job=job,
+            process=process,
+            pipe_to_child=pipe_to_child,
+            allocation=allocation,
+            pjh_status='running'
+        ))
+        process.start()
+
+    def _job_environment(self, allocation: dict) -> Dict[str, str]:
+        # Environment variables to set in the process that runs the job
+        ret = dict()
+        if not self._capacity.is_limited():
+            return ret
+        ret['NUM_WORKERS'] = str(allocation['num_cores'])
+        if allocation['gpu_slots'] is not None:
+            ret['CUDA_VISIBLE_DEVICES'] = ','.join([str(i) for i in allocation['gpu_slots']])
+        return ret
+
+    def _pool_handle_job(self, job, *, kachery_config: dict, allocation: dict):
+        job_index = self._pool_last_job_index + 1
+        self._pool_last_job_index = job_index
+        # The job is pickled here (not when it is dispatched) so that
+        # serialization problems are raised when the job is handled
+        job_pickled = pickle.dumps(dict(
+            job_index=job_index,
+            job=_pool_runnable_job(job),
+            kachery_config=kachery_config,
+            environment=self._job_environment(allocation)
+        ))
+        self._pool_jobs[job_index] = dict(job=job, allocation=allocation, job_pickled=job_pickled)
+        self._pool_undispatched.append(job_index)
 
-def _pjh_run_job(pipe_to_parent: Connection, job: Dict[str, Any], kachery_config: dict) -> None:
+    def _pool_iterate(self):
+        # Handle the messages from the workers
+        for w in self._pool_workers:
+            self._pool_handle_worker_messages(w)
+
+        # Replace workers that have ended (recycled or crashed)
+        workers_after = []
+        for w in self._pool_workers:
+            if w['process'].is_alive():
+                workers_after.append(w)
+            else:
+                # there may be messages sent just before the worker ended
+                self._pool_handle_worker_messages(w)
+                # A job is assigned to a worker when it is sent to it, so a
+                # worker that dies can never take an unaccounted job with it
+                if w['job_index'] is not None:
+                    x = self._pool_jobs.pop(w['job_index'], None)
+                    if x is not None:
+                        job = x['job']
+                        print('Worker process ended unexpectedly while running job [{}]'.format(job.get('label', job.get('name', '<>'))))
+                        self._capacity.release(x['allocation'])
+                        hither._set_result(job, _failed_job_result(job))
+                w['pipe_to_child'].close()
+        self._pool_workers = workers_after
+
+    def _pool_start_workers_as_needed(self):
+        num_needed = min(self._num_workers, len(self._pool_jobs))
+        while len(self._pool_workers) < num_needed:
+            self._pool_start_worker()
+
+    def _pool_dispatch_jobs(self):
+        for w in self._pool_workers:
+            if not self._pool_undispatched:
+                return
+            if w['job_index'] is not None:
+                continue
+            if (self._max_jobs_per_worker is not None) and (w['num_jobs'] >= self._max_jobs_per_worker):
+                # this worker is about to exit and be replaced
+                continue
+            if not w['process'].is_alive():
+                continue
+            job_index = self._pool_undispatched[0]
+            try:
+                w['pipe_to_child'].send(self._pool_jobs[job_index]['job_pickled'])
+            except OSError:
+                # the worker ended; it is replaced on the next iteration
+                continue
+            self._pool_undispatched.pop(0)
+            w['job_index'] = job_index
+            w['num_jobs'] = w['num_jobs'] + 1
+
+    def _pool_handle_worker_messages(self, w: dict):
+        while True:
+            try:
+                if not w['pipe_to_child'].poll():
+                    return
+                msg = w['pipe_to_child'].recv()
+            except (EOFError, OSError):
+                return
+            if msg['type'] == 'finished':
+                w['job_index'] = None
+                x = self._pool_jobs.pop(msg['job_index'], None)
+                if x is not None:
+                    result0 = hither.Result()
+                    result0.deserialize(msg['result'])
+                    self._capacity.release(x['allocation'])
+                    hither._set_result(x['job'], result0)
+            elif msg['type'] == 'error':
+                # This is not a job error, this is a framework error
+                print(msg['traceback'])
+                w['job_index'] = None
+                x = self._pool_jobs.pop(msg['job_index'], None)
+                if x is not None:
+                    self._capacity.release(x['allocation'])
+                    hither._set_result(x['job'], _failed_job_result(x['job']))
+
+    def _pool_start_worker(self):
+        pipe_to_parent, pipe_to_child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_pjh_pool_worker, args=(pipe_to_parent, self._max_jobs_per_worker))
+        process.start()
+        pipe_to_parent.close()
+        self._pool_workers.append(dict(
+            process=process,
+            pipe_to_child=pipe_to_child,
+            job_index=None, # the job the worker is running
+            num_jobs=0 # number of jobs sent to the worker
+        ))
+
+    def _pool_shutdown(self):
+        for w in self._pool_workers:
+            try:
+                w['pipe_to_child'].send(None)
+            except OSError:
+                pass
+        for w in self._pool_workers:
+            w['process'].join(timeout=5)
+            if w['process'].is_alive():
+                w['process'].terminate()
+            w['pipe_to_child'].close()
+        self._pool_workers = []
+        for x in self._pool_jobs.values():
+            self._capacity.release(x['allocation'])
+        self._pool_jobs = dict()
+        self._pool_undispatched = []
+
+def _pjh_run_job(pipe_to_parent: Connection, job: Dict[str, Any], kachery_config: dict, environment: Dict[str, str]) -> None:
     import kachery as ka
+    os.environ.update(environment)
     ka.set_config(**kachery_config)
+    # a warm container session would be started and stopped for this one job
+    _set_one_job_per_process()
     hither._run_job(job)
     pipe_to_parent.send(job['result'].serialize())
     # wait for message to return
@@ -62,4 +298,86 @@ def _pjh_run_job(pipe_to_parent: Connection, job: Dict[str, Any], kachery_config
         if pipe_to_parent.poll():
             pipe_to_parent.recv()
             return
-        time.sleep(0.1)
\ No newline at end of file
+        time.sleep(0.1)
+
+def _pjh_pool_worker(pipe_to_parent: Connection, max_jobs_per_worker: Optional[int]) -> None:
+    # Modules imported by the jobs (and the kachery configuration) stay loaded
+    # between jobs
+    import kachery as ka
+    kachery_config = None
+    num_jobs = 0
+    while True:
+        try:
+            x = pipe_to_parent.recv()
+        except EOFError:
+            # the parent has gone away
+            return
+        if x is None:
+            return
+        x = pickle.loads(x)
+        job_index = x['job_index']
+        try:
+            if x['kachery_config'] != kachery_config:
+                kachery_config = x['kachery_config']
+                ka.set_config(**kachery_config)
+            job = x['job']
+            result = hither.Result()
+            result.deserialize(job['result'])
+            job['result'] = result
+            with _environment(x['environment']):
+                hither._run_job(job)
+            pipe_to_parent.send(dict(type='finished', job_index=job_index, result=job['result'].serialize()))
+        except:
+            pipe_to_parent.send(dict(type='error', job_index=job_index, traceback=traceback.format_exc()))
+        num_jobs = num_jobs + 1
+        if (max_jobs_per_worker is not None) and (num_jobs >= max_jobs_per_worker):
+            return
+
+class _environment:
+    def __init__(self, environment: Dict[str, str]):
+        self._environment = environment
+        self._old_environment: Dict[str, Optional[str]] = dict()
+    def __enter__(self):
+        for k, v in self._environment.items():
+            self._old_environment[k] = os.environ.get(k, None)
+            os.environ[k] = v
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for k, v in self._old_environment.items():
+            if v is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = v
+
+def _job_resources(job: Dict[str, Any]) -> Dict[str, Any]:
+    resources = job.get('resources', None)
+    if resources is None:
+        resources = dict(num_cores=1, ram_gb=0, num_gpus=1 if job.get('gpu', False) else 0)
+    return resources
+
+def _pool_runnable_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    # The function itself is pickled by reference, so the worker imports it once
+    ret = dict()
+    for k, v in job.items():
+        if k not in ['result', 'job_handler']:
+            ret[k] = v
+    ret['result'] = job['result'].serialize()
+    return ret
+
+def _failed_job_result(job: Dict[str, Any]) -> hither.Result:
+    result = hither.Result()
+    result.deserialize(job['result'].serialize())
+    for oname in result._output_names:
+        f = getattr(result.outputs, oname)
+        f._failed = True
+        f._exists = False
+    t = time.time()
+    result.runtime_info = dict(
+        start_time=t,
+        end_time=t,
+        elapsed_sec=0,
+        console_out=dict(label=job.get('label', ''), lines=[]),
+        status='error'
+    )
+    result.success = False
+    result.status = 'error'
+    return result
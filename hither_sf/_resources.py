@@ -0,0 +1,60 @@
+from typing import Dict, Any, Optional, List
+
+class _Capacity:
+    def __init__(self, *, num_cores: Optional[int]=None, ram_gb: Optional[float]=None, num_gpus: Optional[int]=None):
+        """Available compute resources that jobs are packed onto
+
+        A limit of None means that the resource is not limited. GPUs are
+        handed out as numbered slots so that each job can be restricted to
+        its own devices (these may be simulated slots when testing locally).
+        """
+        self._num_cores = num_cores
+        self._ram_gb = ram_gb
+        self._num_gpus = num_gpus
+        self._used_cores = 0
+        self._used_ram_gb = 0
+        self._free_gpu_slots: List[int] = list(range(num_gpus)) if num_gpus is not None else []
+
+    def can_ever_fit(self, resources: Dict[str, Any]) -> bool:
+        if (self._num_cores is not None) and (resources['num_cores'] > self._num_cores):
+            return False
+        if (self._ram_gb is not None) and (resources['ram_gb'] > self._ram_gb):
+            return False
+        if (self._num_gpus is not None) and (resources['num_gpus'] > self._num_gpus):
+            return False
+        return True
+
+    def fits(self, resources: Dict[str, Any]) -> bool:
+        if (self._num_cores is not None) and (self._used_cores + resources['num_cores'] > self._num_cores):
+            return False
+        if (self._ram_gb is not None) and (self._used_ram_gb + resources['ram_gb'] > self._ram_gb):
+            return False
+        if (self._num_gpus is not None) and (resources['num_gpus'] > len(self._free_gpu_slots)):
+            return False
+        return True
+
+    def allocate(self, resources: Dict[str, Any]) -> dict:
+        self._used_cores = self._used_cores + resources['num_cores']
+        self._used_ram_gb = self._used_ram_gb + resources['ram_gb']
+        gpu_slots: Optional[List[int]] = None
+        if self._num_gpus is not None:
+            gpu_slots = self._free_gpu_slots[:resources['num_gpus']]
+            self._free_gpu_slots = self._free_gpu_slots[resources['num_gpus']:]
+        return dict(
+            num_cores=resources['num_cores'],
+            ram_gb=resources['ram_gb'],
+            gpu_slots=gpu_slots
+        )
+
+    def release(self, allocation: dict) -> None:
+        self._used_cores = self._used_cores - allocation['num_cores']
+        self._used_ram_gb = self._used_ram_gb - allocation['ram_gb']
+        if allocation['gpu_slots'] is not None:
+            self._free_gpu_slots = sorted(self._free_gpu_slots + allocation['gpu_slots'])
+
+    def max_parallel_jobs(self) -> Optional[int]:
+        # assuming jobs that use a single core and no GPU
+        return self._num_cores
+
+    def is_limited(self) -> bool:
+        return (self._num_cores is not None) or (self._ram_gb is not None) or (self._num_gpus is not None)
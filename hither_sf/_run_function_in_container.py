@@ -4,14 +4,17 @@ import sys
 from sys import stdout
 from typing import Any, List, Tuple, Union, Dict
 import json
+import hashlib
 import fnmatch
 import inspect
 import shutil
+import tempfile
 import time
 from pathlib import Path
 from copy import deepcopy
 from ._temporarydirectory import TemporaryDirectory
 from ._shellscript import ShellScript
+from ._containersession import _warm_containers_enabled, _get_container_session
 
 def run_function_in_container(*,
         name: str,
@@ -41,23 +44,45 @@ def run_function_in_container(*,
             raise Exception('Unexpected: function and function_serialized are both None for [{}]'.format(label))
         function_serialized = _serialize_runnable_function(function, name=name, additional_files=additional_files, local_modules=local_modules, container=container)
     
-    code = function_serialized['code']
+    code_dir = _unpack_code_bundle(function_serialized['code_uri'])
     container = function_serialized['container']
 
+    session = None
+    if (container is not None) and _warm_containers_enabled():
+        if not os.getenv('KACHERY_STORAGE_DIR'):
+            raise Exception('You must set the environment variable: KACHERY_STORAGE_DIR')
+        session = _get_container_session(container=container, gpu=gpu)
+        for iname in input_file_keys:
+            if iname in keyword_args.keys():
+                if (not _is_hash_url(keyword_args[iname])) and (session.path_inside(keyword_args[iname]) is None):
+                    # the input file cannot be mounted into a running container
+                    print('Input file is outside of the kachery storage directory. Not using the warm container session for [{}]'.format(label))
+                    session = None
+                    break
+
     remove = True
     if os.getenv('HITHER_DEBUG', None) == 'TRUE':
         remove = False
     with TemporaryDirectory(prefix='tmp_hither_run_in_container_' + name + '_', remove=remove) as temp_path:
-        _write_python_code_to_directory(os.path.join(temp_path, 'function_src'), code)
-
         keyword_args_adjusted = deepcopy(keyword_args)
         binds = dict()
+        if (container is not None) and (session is None):
+            os.mkdir(os.path.join(temp_path, 'function_src'))
+            # read-only, since the unpacked code directory is shared by all of the jobs on this machine
+            binds[code_dir] = '/run_in_container/function_src:ro'
+        else:
+            try:
+                os.symlink(code_dir, os.path.join(temp_path, 'function_src'))
+            except OSError:
+                shutil.copytree(code_dir, os.path.join(temp_path, 'function_src'))
         for iname in input_file_keys:
             if iname in keyword_args.keys():
                 fname_outside = keyword_args[iname]
                 if not _is_hash_url(fname_outside):
                     fname_inside = '/inputs/{}{}'.format(iname, input_file_extensions[iname])
-                    if container is not None:
+                    if session is not None:
+                        keyword_args_adjusted[iname] = session.path_inside(fname_outside)
+                    elif container is not None:
                         keyword_args_adjusted[iname] = fname_inside
                         binds[fname_outside] = fname_inside
                     else:
@@ -71,13 +96,23 @@ def run_function_in_container(*,
                 fname_outside = keyword_args[oname]
                 fname_inside = '/outputs/{}{}'.format(oname, output_file_extensions[oname])
                 fname_temp = '{}/{}{}'.format(outputs_tmp, oname, output_file_extensions[oname])
-                if container is not None:
+                if session is not None:
+                    keyword_args_adjusted[oname] = fname_temp
+                    outputs_to_copy[fname_temp] = fname_outside
+                elif container is not None:
                     keyword_args_adjusted[oname] = fname_inside
                     outputs_to_copy[fname_temp] = fname_outside
                 else:
                     keyword_args_adjusted[oname] = fname_outside
         
-        if container is not None:
+        if session is not None:
+            # the job directory has the same path inside the container
+            run_in_container_path = temp_path
+            env_vars_inside_container = dict(
+                KACHERY_STORAGE_DIR=session.kachery_storage_dir_inside(),
+                PYTHONPATH=f'{run_in_container_path}/function_src/_local_modules'
+            )
+        elif container is not None:
             run_in_container_path = '/run_in_container'
             env_vars_inside_container = dict(
                 KACHERY_STORAGE_DIR='/kachery-storage',
@@ -169,103 +204,43 @@ def run_function_in_container(*,
         if not os.getenv('KACHERY_STORAGE_DIR'):
             raise Exception('You must set the environment variable: KACHERY_STORAGE_DIR')
 
-        docker_container_name = None
-
-        # fancy_command = 'bash -c "((bash /run_in_container/run.sh | tee /run_in_container/stdout.txt) 3>&1 1>&2 2>&3 | tee /run_in_container/stderr.txt) 3>&1 1>&2 1>&3 | tee /run_in_container/console_out.txt"'
-        if container is None:
-            run_outside_container_script = """
-                #!/bin/bash
-
-                exec {run_in_container_path}/run.sh
-            """.format(
-                run_in_container_path=run_in_container_path
-            )
-        elif os.getenv('HITHER_USE_SINGULARITY', None) == 'TRUE':
-            if gpu:
-                gpu_opt = '--nv'
-            else:
-                gpu_opt = ''
-            run_outside_container_script = """
-                #!/bin/bash
-
-                exec singularity exec -e {gpu_opt} \\
-                    -B $KACHERY_STORAGE_DIR:/kachery-storage \\
-                    -B {temp_path}:/run_in_container \\
-                    {binds_str} \\
-                    {container} \\
-                    bash /run_in_container/run.sh
-            """.format(
-                gpu_opt=gpu_opt,
-                binds_str=' '.join(['-B {}:{}'.format(a, b) for a, b in binds.items()]),
-                container=container,
-                temp_path=temp_path
+        timer = time.time()
+        if session is not None:
+            num_workers_env = os.getenv('NUM_WORKERS', '')
+            retcode, did_timeout = session.run(
+                run_dir=temp_path,
+                env=dict(
+                    NUM_WORKERS=num_workers_env,
+                    MKL_NUM_THREADS=num_workers_env,
+                    NUMEXPR_NUM_THREADS=num_workers_env,
+                    OMP_NUM_THREADS=num_workers_env,
+                    **env_vars_inside_container
+                ),
+                timeout=timeout
             )
+            if show_console:
+                with open(os.path.join(temp_path, 'console.txt'), 'r') as f:
+                    print(f.read(), end='')
         else:
-            if gpu:
-                gpu_opt = '--gpus all'
-            else:
-                gpu_opt = ''
-            docker_container_name = _random_string(8) + '_' + name
-            # May not want to use -t below as it has the potential to mess up line feeds in the parent process!
-            if (sys.platform == "win32"):
-                winpath_ = lambda a : '/' + a.replace('\\','/').replace(':','')
-                binds_str_ = ' '.join(['-v {}:{}'.format(winpath_(a), b) for a, b in binds.items()])
-                container_ = _docker_form_of_container_string(container)
-                temp_path_ = winpath_(temp_path)
-                kachery_storage_dir_ = winpath_(os.getenv('KACHERY_STORAGE_DIR'))
-                print('temp_path_: ' + temp_path_)
-                run_outside_container_script = f'''
-                    docker run --name {docker_container_name} -i {gpu_opt} ^
-                    -v {kachery_storage_dir_}:/kachery-storage ^
-                    -v {temp_path_}:/run_in_container ^
-                    {binds_str_} ^
-                    {container_} ^
-                    bash /run_in_container/run.sh'''
-            else:
-                run_outside_container_script = """
-                #!/bin/bash
-
-                exec docker run --name {docker_container_name} -i {gpu_opt} \\
-                    -v /etc/localtime:/etc/localtime:ro \\
-                    -v /etc/passwd:/etc/passwd -u `id -u`:`id -g` \\
-                    -v $KACHERY_STORAGE_DIR:/kachery-storage \\
-                    -v {temp_path}:/run_in_container \\
-                    -v /tmp:/tmp \\
-                    -v $HOME:$HOME \\
-                    {binds_str} \\
-                    {container} \\
-                    bash /run_in_container/run.sh
-                """.format(
-                    docker_container_name=docker_container_name,
-                    gpu_opt=gpu_opt,
-                    binds_str=' '.join(['-v {}:{}'.format(a, b) for a, b in binds.items()]),
-                    container=_docker_form_of_container_string(container),
-                    temp_path=temp_path
-                )
-        print('#############################################################')
-        print(run_outside_container_script)
-        print('#############################################################')
-
-        ss = ShellScript(run_outside_container_script, keep_temp_files=False, label='run_outside_container', docker_container_name=docker_container_name)
-        ss.start()
-        timer = time.time()
-        did_timeout = False
-        while True:
-            retcode = ss.wait(1)
-            if retcode is not None:
-                break
-            elapsed = time.time() - timer
-            if timeout is not None:
-                if elapsed > timeout:
-                    print(f'Stopping job due to timeout {elapsed} > {timeout}')
-                    did_timeout = True
-                    ss.stop()
+            retcode, did_timeout = _run_in_new_container(
+                name=name, container=container, gpu=gpu, binds=binds, temp_path=temp_path,
+                run_in_container_path=run_in_container_path, timeout=timeout
+            )
 
         if (retcode != 0) and (not did_timeout):
             raise Exception('Non-zero exit code ({}) running [{}] in container {}'.format(retcode, label, container))
 
-        with open(os.path.join(temp_path, 'result.json')) as f:
-            obj = json.load(f)
+        if did_timeout and not os.path.exists(os.path.join(temp_path, 'result.json')):
+            # the job was stopped before it could write its result
+            t = time.time()
+            obj = dict(
+                retval=None,
+                status='error',
+                runtime_info=dict(start_time=timer, end_time=t, elapsed_sec=t - timer, console_out=dict(label=name, lines=[]))
+            )
+        else:
+            with open(os.path.join(temp_path, 'result.json')) as f:
+                obj = json.load(f)
         retval = obj['retval']
         runtime_info = obj['runtime_info']
         status = obj['status']
@@ -285,11 +260,200 @@ def run_function_in_container(*,
 
         return retval, runtime_info
 
+def _run_in_new_container(*, name: str, container: Union[str, None], gpu: bool, binds: dict, temp_path: str, run_in_container_path: str, timeout: Union[float, None]) -> Tuple[int, bool]:
+    # Runs temp_path/run.sh and returns the exit code and whether the job was stopped due to the timeout
+    docker_container_name = None
+
+    # fancy_command = 'bash -c "((bash /run_in_container/run.sh | tee /run_in_container/stdout.txt) 3>&1 1>&2 2>&3 | tee /run_in_container/stderr.txt) 3>&1 1>&2 1>&3 | tee /run_in_container/console_out.txt"'
+    if container is None:
+        run_outside_container_script = """
+            #!/bin/bash
+
+            exec {run_in_container_path}/run.sh
+        """.format(
+            run_in_container_path=run_in_container_path
+        )
+    elif os.getenv('HITHER_USE_SINGULARITY', None) == 'TRUE':
+        if gpu:
+            gpu_opt = '--nv'
+        else:
+            gpu_opt = ''
+        run_outside_container_script = """
+            #!/bin/bash
+
+            exec singularity exec -e {gpu_opt} \\
+                -B $KACHERY_STORAGE_DIR:/kachery-storage \\
+                -B {temp_path}:/run_in_container \\
+                {binds_str} \\
+                {container} \\
+                bash /run_in_container/run.sh
+        """.format(
+            gpu_opt=gpu_opt,
+            binds_str=' '.join(['-B {}:{}'.format(a, b) for a, b in binds.items()]),
+            container=container,
+            temp_path=temp_path
+        )
+    else:
+        if gpu:
+            gpu_opt = '--gpus all'
+        else:
+            gpu_opt = ''
+        docker_container_name = _random_string(8) + '_' + name
+        # May not want to use -t below as it has the potential to mess up line feeds in the parent process!
+        if (sys.platform == "win32"):
+            winpath_ = lambda a : '/' + a.replace('\\','/').replace(':','')
+            binds_str_ = ' '.join(['-v {}:{}'.format(winpath_(a), b) for a, b in binds.items()])
+            container_ = _docker_form_of_container_string(container)
+            temp_path_ = winpath_(temp_path)
+            kachery_storage_dir_ = winpath_(os.getenv('KACHERY_STORAGE_DIR'))
+            print('temp_path_: ' + temp_path_)
+            run_outside_container_script = f'''
+                docker run --name {docker_container_name} -i {gpu_opt} ^
+                -v {kachery_storage_dir_}:/kachery-storage ^
+                -v {temp_path_}:/run_in_container ^
+                {binds_str_} ^
+                {container_} ^
+                bash /run_in_container/run.sh'''
+        else:
+            run_outside_container_script = """
+            #!/bin/bash
+
+            exec docker run --name {docker_container_name} -i {gpu_opt} \\
+                -v /etc/localtime:/etc/localtime:ro \\
+                -v /etc/passwd:/etc/passwd -u `id -u`:`id -g` \\
+                -v $KACHERY_STORAGE_DIR:/kachery-storage \\
+                -v {temp_path}:/run_in_container \\
+                -v /tmp:/tmp \\
+                -v $HOME:$HOME \\
+                {binds_str} \\
+                {container} \\
+                bash /run_in_container/run.sh
+            """.format(
+                docker_container_name=docker_container_name,
+                gpu_opt=gpu_opt,
+                binds_str=' '.join(['-v {}:{}'.format(a, b) for a, b in binds.items()]),
+                container=_docker_form_of_container_string(container),
+                temp_path=temp_path
+            )
+    print('#############################################################')
+    print(run_outside_container_script)
+    print('#############################################################')
+
+    ss = ShellScript(run_outside_container_script, keep_temp_files=False, label='run_outside_container', docker_container_name=docker_container_name)
+    ss.start()
+    timer = time.time()
+    did_timeout = False
+    while True:
+        retcode = ss.wait(1)
+        if retcode is not None:
+            break
+        elapsed = time.time() - timer
+        if timeout is not None:
+            if elapsed > timeout:
+                print(f'Stopping job due to timeout {elapsed} > {timeout}')
+                did_timeout = True
+                ss.stop()
+    return retcode, did_timeout
+
+# Kachery URIs of the code bundles of functions, by (source file, name, additional files, local modules,
+# fingerprint of the files)
+_code_bundle_uris: Dict[str, str] = dict()
+
+# Directories where code bundles have been unpacked, by kachery URI
+_unpacked_code_dirs: Dict[str, str] = dict()
+
+# Fingerprints of the code of functions, by (source file, local modules): (signal, fingerprint),
+# where the fingerprint is computed again only when the (cheap) signal changes
+_code_fingerprints: Dict[str, Tuple[str, str]] = dict()
+
 def _serialize_runnable_function(function, *, name: str, additional_files: list, local_modules: list, container: str) -> dict:
+    # The code bundle is read once per function and stored in kachery. Jobs refer to it by its URI
+    # (which contains the content hash), and it is unpacked once per machine (see _unpack_code_bundle).
+    import kachery as ka
     try:
         function_source_fname = os.path.abspath(inspect.getsourcefile(function))
     except:
         raise Exception('Unable to get source file for function {}. Cannot run in a container.'.format(name))
+    # The fingerprint changes when the source files are edited (e.g., in a notebook), so that the bundle is read again
+    fingerprint = _code_fingerprint(function_source_fname, local_modules=local_modules)
+    key = json.dumps([function_source_fname, name, additional_files, local_modules, fingerprint])
+    if key not in _code_bundle_uris:
+        code = _read_code_bundle(function_source_fname, name=name, additional_files=additional_files, local_modules=local_modules)
+        code_uri = ka.store_object(code)
+        if code_uri is None:
+            raise Exception('Unable to store code bundle for function {}'.format(name))
+        _code_bundle_uris[key] = code_uri
+    return dict(
+        code_uri=_code_bundle_uris[key],
+        container=container
+    )
+
+def _unpack_code_bundle(code_uri: str) -> str:
+    # Returns the directory where the code bundle is unpacked
+    if code_uri in _unpacked_code_dirs:
+        if os.path.exists(_unpacked_code_dirs[code_uri]):
+            return _unpacked_code_dirs[code_uri]
+    import kachery as ka
+    storage_dir = os.environ.get('KACHERY_STORAGE_DIR', None)
+    if storage_dir:
+        parent_dir = os.path.join(storage_dir, 'tmp')
+        if not os.path.exists(parent_dir):
+            os.makedirs(parent_dir, exist_ok=True)
+    else:
+        parent_dir = tempfile.gettempdir()
+    code_hash = code_uri.split('://')[1].split('/')[0]
+    dirname = os.path.join(parent_dir, 'hither_code_' + code_hash)
+    if not os.path.exists(dirname):
+        code = ka.load_object(code_uri)
+        if code is None:
+            raise Exception('Unable to load code bundle: {}'.format(code_uri))
+        # Other workers may be unpacking the same bundle, so write it elsewhere and rename
+        tmp_dirname = dirname + '_tmp_' + _random_string(8)
+        _write_python_code_to_directory(tmp_dirname, code)
+        try:
+            os.rename(tmp_dirname, dirname)
+        except OSError:
+            if not os.path.exists(dirname):
+                raise
+            shutil.rmtree(tmp_dirname)
+    _unpacked_code_dirs[code_uri] = dirname
+    return dirname
+
+def _code_fingerprint(function_source_fname: str, *, local_modules: list) -> str:
+    # Hash of the paths, modification times and sizes of the files in the directories of a code bundle.
+    # The directory trees are only walked again when the modification time of one of the top-level
+    # directories (files added, removed or replaced, as most editors do when saving) or of the
+    # function source file changes, so that submitting a job does not stat every file.
+    function_source_dirname = os.path.dirname(function_source_fname)
+    dirnames = [function_source_dirname, os.path.dirname(os.path.realpath(__file__))]
+    for lm in local_modules:
+        dirnames.append(lm if os.path.isabs(lm) else os.path.join(function_source_dirname, lm))
+    key = json.dumps([function_source_fname, local_modules])
+    signal = json.dumps([_mtime_ns(path) for path in dirnames + [function_source_fname]])
+    if (key in _code_fingerprints) and (_code_fingerprints[key][0] == signal):
+        return _code_fingerprints[key][1]
+    items = []
+    for dirname in dirnames:
+        for root, dirs, files in os.walk(dirname):
+            # same directories as _read_python_code_of_directory
+            dirs[:] = sorted([d for d in dirs if (not d.startswith('__')) and (not d.startswith('.'))])
+            for fname in sorted(files):
+                try:
+                    st = os.stat(os.path.join(root, fname))
+                except OSError:
+                    continue
+                items.append([os.path.join(root, fname), st.st_mtime_ns, st.st_size])
+    fingerprint = hashlib.sha1(json.dumps(items).encode('utf-8')).hexdigest()
+    _code_fingerprints[key] = (signal, fingerprint)
+    return fingerprint
+
+def _mtime_ns(path: str) -> Union[int, None]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def _read_code_bundle(function_source_fname: str, *, name: str, additional_files: list, local_modules: list) -> dict:
     function_source_dirname = os.path.dirname(function_source_fname)
     function_source_basename = os.path.basename(function_source_fname)
     function_source_basename_noext = os.path.splitext(function_source_basename)[0]
@@ -325,10 +489,7 @@ def _serialize_runnable_function(function, *, name: str, additional_files: list,
             ]
         )
     ))
-    return dict(
-        code=code,
-        container=container
-    )
+    return code
 
 def _docker_form_of_container_string(container):
     if container.startswith('docker://'):
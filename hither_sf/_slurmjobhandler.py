@@ -4,12 +4,15 @@ import time
 import random
 import signal
 import shutil
+import socket
+import select
 import traceback
 from ._shellscript import ShellScript
 from ._filelock import FileLock
 from typing import Optional, List, Dict, Any, Union
 import json
-from ._core import _set_result
+import math
+from ._core import _set_result, _write_to_log
 from ._core import Result, _serialize_runnable_job
 
 DEFAULT_JOB_TIMEOUT = 1200
@@ -22,7 +25,10 @@ class SlurmJobHandler:
         use_slurm: bool=True,
         time_limit_per_batch: Optional[float]=None,  # number of seconds or None
         max_simultaneous_batches: Optional[int]=None,
-        additional_srun_opts: List[str]=[]
+        additional_srun_opts: List[str]=[],
+        transport: str='socket',
+        autoscale: bool=False,
+        autoscale_target_sec: float=300
     ):
         """Constructor for slurm job handler
 
@@ -40,6 +46,19 @@ class SlurmJobHandler:
             If a number, the maximum duration of a batch in seconds, by default None
         additional_srun_opts : List[str], optional
             A list of additional string options to send to srun (only applies of use_slurm is True), by default []
+        transport : str, optional
+            How jobs and results are passed between the handler and the batch workers, by default 'socket'.
+            With 'socket', the workers connect back to the handler over TCP. With 'file', they are passed
+            through files in the working directory. The file transport is also the fallback if the socket cannot
+            be opened, and for each worker that cannot connect to the handler.
+        autoscale : bool, optional
+            If True, the number of batches and the number of workers of each new batch follow the queued work,
+            by default False. The work is estimated from the observed durations of the jobs (or the runtime
+            estimates of the job queue), and num_workers_per_batch and max_simultaneous_batches become upper
+            limits. Each scaling decision is written to the hither log.
+        autoscale_target_sec : float, optional
+            With autoscale, enough workers are requested to complete the queued work in about this number of
+            seconds (or within the time limit per batch, taking the job timeouts into account), by default 300
         """
         if not os.path.exists(working_dir):
             os.mkdir(working_dir)
@@ -56,6 +75,20 @@ class SlurmJobHandler:
         self._last_batch_id: int = 0
         self._handler_dir: str = handler_dir
         self._unassigned_jobs: List[Dict[str, Any]] = []
+        self._unassigned_jobs_need_sort: bool = False
+        self._autoscaler: Optional[_Autoscaler] = None
+        if autoscale:
+            self._autoscaler = _Autoscaler(target_sec=autoscale_target_sec, time_limit_per_batch=time_limit_per_batch)
+        self._dispatched_jobs: Dict[int, Any] = dict()  # id(job) -> (job, timestamp), for the autoscaler
+        self._job_server: Optional[_JobServer] = None
+        if transport == 'socket':
+            try:
+                self._job_server = _JobServer(host_for_workers=socket.gethostname() if use_slurm else '127.0.0.1')
+            except:
+                traceback.print_exc()
+                print('WARNING: Unable to open socket for slurm job handler. Using the file transport.')
+        elif transport != 'file':
+            raise Exception('Unexpected transport for slurm job handler: {}'.format(transport))
 
     def handle_job(self, job: Dict[str, Any]):
         """Queue a job to run in a batch. This is called from the framework (e.g., the job queue)
@@ -71,7 +104,29 @@ class SlurmJobHandler:
         if self._time_limit_per_batch is not None:
             if job_timeout > self._time_limit_per_batch:
                 raise Exception('Cannot execute job. Job timeout exceeds time limit for batch type: {} > {}'.format(job_timeout, self._time_limit_per_batch))                
+        resources = job.get('resources', None)
+        if resources is not None:
+            if resources['num_cores'] > self._num_cores_per_job:
+                raise Exception('Cannot execute job. Number of cores exceeds the number of cores per job: {} > {}'.format(resources['num_cores'], self._num_cores_per_job))
         self._unassigned_jobs.append(job)
+        self._unassigned_jobs_need_sort = True
+
+    def num_parallel_slots(self) -> Optional[int]:
+        """Maximum number of jobs that can run at once (None means unlimited), used to estimate the makespan
+        """
+        if self._max_simultaneous_batches is None:
+            return None
+        return self._num_workers_per_batch * self._max_simultaneous_batches
+
+    def wait_objects(self):
+        # With the socket transport, the framework waits on the sockets rather than polling,
+        # except while a batch is starting or has workers that fell back to the file transport
+        if self._job_server is None:
+            return []
+        for b in self._batches.values():
+            if b.isWaitingToStart() or (b.isRunning() and b.hasFileWorkers()):
+                return []
+        return self._job_server.wait_objects()
 
     def iterate(self) -> None:
         """Called by the framework to take care of business.
@@ -84,18 +139,26 @@ class SlurmJobHandler:
         if self._halted:
             return
 
+        # Handle the messages from the batch workers (socket transport)
+        if self._job_server is not None:
+            for connection, msg in self._job_server.poll():
+                self._handle_worker_message(connection, msg)
+
         # Iterate the batches that are not finished
         for _, b in self._batches.items():
             if not b.isFinished():
                 b.iterate()
-
-        # Handle the unassigned jobs
-        unassigned_jobs_after = []
-        for job in self._unassigned_jobs:
-            if not self._handle_unassigned_job(job):
-                # Unable to assign the job, so we'll try next iteration
-                unassigned_jobs_after.append(job)
-        self._unassigned_jobs = unassigned_jobs_after
+        if self._autoscaler is not None:
+            self._record_finished_jobs()
+
+        # The unassigned jobs form one queue for all of the batches, highest priority first
+        # (stable, so otherwise in submission order)
+        if self._unassigned_jobs_need_sort:
+            self._unassigned_jobs.sort(key=lambda job: -job.get('priority', 0))
+            self._unassigned_jobs_need_sort = False
+        self._dispatch_unassigned_jobs()
+        self._halt_idle_batches()
+        self._start_batches_as_needed()
 
     def isFinished(self) -> bool:
         """Whether all queued jobs have finished
@@ -138,48 +201,236 @@ class SlurmJobHandler:
         None
         """
         self.halt()
+        if self._job_server is not None:
+            self._job_server.close()
         _rmdir_with_retries(self._handler_dir, num_retries=10)
 
-    def _handle_unassigned_job(self, job: Dict[str, Any]):
-        # See if we can add a job to an existing batch that has a vacancy
-        for _, b in self._batches.items():
+    def _handle_worker_message(self, connection: '_Connection', msg: Optional[dict]) -> None:
+        # msg is None when the connection was closed
+        if connection.worker is None:
+            if msg is None:
+                return
+            batch = None
+            if msg.get('type', None) == 'hello':
+                for b in self._batches.values():
+                    if b.batchKey() == msg.get('batch', None):
+                        batch = b
+            if (batch is None) or batch.isFinished():
+                connection.send(dict(type='stop'))
+                self._job_server.closeConnection(connection)
+                return
+            batch.addSocketWorker(connection)
+        else:
+            connection.worker.handleMessage(msg)
+
+    def _dispatch_unassigned_jobs(self) -> None:
+        # Every idle worker (in any running batch) takes the next job in the queue that fits in
+        # the remaining time of its batch. Among the idle workers that can take a job, we prefer
+        # the batch with the least remaining time, so that batches with more time left stay
+        # available for the longer jobs.
+        idle_workers = []
+        for b in self._batches.values():
             if b.isRunning():
-                if b.canAddJob(job):
-                    b.addJob(job)
-                    return True
+                for w in b.idleWorkers():
+                    idle_workers.append((b, w))
+        if len(idle_workers) == 0:
+            return
+        idle_workers.sort(key=lambda x: x[0].remainingTime())
+        unassigned_jobs_after = []
+        for job in self._unassigned_jobs:
+            assigned = False
+            for ii, (b, w) in enumerate(idle_workers):
+                if b.hasTimeForJob(job):
+                    b.addJob(job, worker=w)
+                    if self._autoscaler is not None:
+                        self._dispatched_jobs[id(job)] = (job, time.time())
+                    del idle_workers[ii]
+                    assigned = True
+                    break
+            if not assigned:
+                unassigned_jobs_after.append(job)
+        self._unassigned_jobs = unassigned_jobs_after
 
-        # See if there is anything waiting to start and count up the number of running batches
-        num_running_batches = 0
-        for _, b in self._batches.items():
+    def _halt_idle_batches(self) -> None:
+        # A running batch without jobs is halted if none of the queued jobs fits in its remaining
+        # time, or if the queue has been empty for 30 seconds since its last job (more jobs may
+        # still arrive as the dependencies of pending jobs finish)
+        for b in self._batches.values():
+            if (not b.isRunning()) or b.hasJob():
+                continue
+            if any([b.hasTimeForJob(job) for job in self._unassigned_jobs]):
+                continue
+            if (len(self._unassigned_jobs) > 0) or (b.elapsedSinceIdle() > 30):
+                b.halt()
+            elif (self._autoscaler is not None) and (b.elapsedSinceIdle() > self._autoscaler.scaleDownDelay()):
+                # Scale down sooner if the other batches have enough workers for the jobs that are still running
+                num_other_workers = sum([b2.numWorkers() for b2 in self._batches.values() if (b2 is not b) and (not b2.isFinished())])
+                num_needed_workers = self._autoscaler.numWorkersNeeded(queued_jobs=[], running_jobs=list(self._dispatched_jobs.values()))
+                if num_other_workers >= num_needed_workers:
+                    _write_to_log('Slurm autoscale: halting idle {} ({} workers); {} workers remain for {} running jobs (need {})'.format(
+                        b.batchLabel(), b.numWorkers(), num_other_workers, len(self._dispatched_jobs), num_needed_workers
+                    ))
+                    b.halt()
+
+    def _start_batches_as_needed(self) -> None:
+        # Start new batches for the jobs that the running and starting batches cannot take
+        if self._autoscaler is not None:
+            self._autoscale_batches()
+            return
+        num_available_workers = 0
+        num_active_batches = 0
+        for b in self._batches.values():
             if b.isWaitingToStart() or b.isPending():
-                # we'll wait for the batch to start before assigning it
-                return False
+                num_available_workers = num_available_workers + b.numWorkers()
+            elif b.isRunning():
+                num_available_workers = num_available_workers + len(b.idleWorkers()) + b.numWorkersToConnect()
             if not b.isFinished():
-                num_running_batches = num_running_batches + 1
-
-        # Check if we would exceed max num of simultaneous batches
-        if self._max_simultaneous_batches is not None:
-            if num_running_batches >= self._max_simultaneous_batches:
-                # we can't create a new batch now
-                return False
-
-        # we need to create a new batch and we'll add the job later
+                num_active_batches = num_active_batches + 1
+        num_needed_workers = len(self._unassigned_jobs) - num_available_workers
+        while num_needed_workers > 0:
+            if self._max_simultaneous_batches is not None:
+                if num_active_batches >= self._max_simultaneous_batches:
+                    # we can't create a new batch now
+                    return
+            self._start_batch(num_workers=self._num_workers_per_batch)
+            num_active_batches = num_active_batches + 1
+            num_needed_workers = num_needed_workers - self._num_workers_per_batch
+
+    def _autoscale_batches(self) -> None:
+        # Grow: request enough workers to complete the queued and running work in the target time.
+        # New batches are sized to the shortfall, so the batches get smaller toward the end of a run.
+        if len(self._unassigned_jobs) == 0:
+            return
+        assert self._autoscaler is not None
+        num_workers = 0
+        num_active_batches = 0
+        for b in self._batches.values():
+            if not b.isFinished():
+                num_workers = num_workers + b.numWorkers()
+                num_active_batches = num_active_batches + 1
+        running_jobs = list(self._dispatched_jobs.values())
+        num_needed_workers = self._autoscaler.numWorkersNeeded(queued_jobs=self._unassigned_jobs, running_jobs=running_jobs)
+        num_new_workers = num_needed_workers - num_workers
+        if not any([b.isWaitingToStart() or b.isPending() for b in self._batches.values()]):
+            # the queued jobs that no running batch has time for need a new batch in any case
+            unfit_jobs = [
+                job for job in self._unassigned_jobs
+                if not any([b.hasTimeForJob(job) for b in self._batches.values() if b.isRunning()])
+            ]
+            if len(unfit_jobs) > 0:
+                num_new_workers = max(num_new_workers, self._autoscaler.numWorkersNeeded(queued_jobs=unfit_jobs, running_jobs=[]))
+        while num_new_workers > 0:
+            if self._max_simultaneous_batches is not None:
+                if num_active_batches >= self._max_simultaneous_batches:
+                    # we can't create a new batch now
+                    return
+            n = min(num_new_workers, self._num_workers_per_batch)
+            _write_to_log('Slurm autoscale: starting batch {} with {} workers ({} queued jobs, {} running jobs, estimated {:.1f} sec of work; {} workers in {} batches; need {})'.format(
+                self._last_batch_id + 1, n, len(self._unassigned_jobs), len(running_jobs),
+                self._autoscaler.estimatedWork(queued_jobs=self._unassigned_jobs, running_jobs=running_jobs),
+                num_workers, num_active_batches, num_needed_workers
+            ))
+            self._start_batch(num_workers=n)
+            num_workers = num_workers + n
+            num_active_batches = num_active_batches + 1
+            num_new_workers = num_new_workers - n
+
+    def _record_finished_jobs(self) -> None:
+        # Observed durations (from dispatch to result) of the jobs, for the autoscaler
+        assert self._autoscaler is not None
+        for key, (job, timestamp) in list(self._dispatched_jobs.items()):
+            if job.get('status', None) in ['finished', 'error']:
+                self._autoscaler.recordJobDuration(job, time.time() - timestamp)
+                del self._dispatched_jobs[key]
+
+    def _start_batch(self, *, num_workers: int) -> None:
         batch_id = self._last_batch_id + 1
         self._last_batch_id = batch_id
         # we put a random string in the working directory so we don't have a chance of interference from previous runs (although this should not logically happen)
         new_batch = _Batch(
             working_dir=self._handler_dir + '/batch_{}_{}'.format(batch_id, _random_string(8)),
             batch_label='batch {}'.format(batch_id),
-            num_workers=self._num_workers_per_batch,
+            num_workers=num_workers,
             num_cores_per_job=self._num_cores_per_job,
             use_slurm=self._use_slurm,
             time_limit=self._time_limit_per_batch,
-            additional_srun_opts=self._additional_srun_opts
+            additional_srun_opts=self._additional_srun_opts,
+            job_server=self._job_server
         )
         self._batches[batch_id] = new_batch
         new_batch.start()
-        # we'll add the job later
-        return False
+
+
+class _Autoscaler():
+    def __init__(self, *, target_sec: float, time_limit_per_batch: Optional[float]):
+        """Scaling policy of SlurmJobHandler with autoscale=True
+
+        The duration of a job is estimated by the mean observed duration of the jobs
+        of the same function, or else by the runtime estimate of the job queue, or
+        else by the job timeout.
+
+        Parameters
+        ----------
+        target_sec : float
+            The queued work should be completed in about this number of seconds
+        time_limit_per_batch : Optional[float]
+            The time limit of the batches (a worker only takes the jobs that can finish within it)
+        """
+        self._target_sec = target_sec
+        self._time_limit_per_batch = time_limit_per_batch
+        self._durations: Dict[str, List[float]] = dict()
+
+    def recordJobDuration(self, job: Dict[str, Any], elapsed: float) -> None:
+        if job['name'] not in self._durations:
+            self._durations[job['name']] = []
+        self._durations[job['name']].append(elapsed)
+
+    def estimatedDuration(self, job: Dict[str, Any]) -> float:
+        durations = self._durations.get(job['name'], [])
+        if len(durations) > 0:
+            return sum(durations) / len(durations)
+        if 'estimated_runtime' in job:
+            return job['estimated_runtime']
+        return _job_timeout(job)
+
+    def estimatedWork(self, *, queued_jobs: List[Dict[str, Any]], running_jobs: List[Any]) -> float:
+        """Estimated number of worker seconds for the queued jobs and the rest of the running jobs ((job, timestamp) pairs)
+        """
+        ret = 0.0
+        for job in queued_jobs:
+            ret = ret + self.estimatedDuration(job)
+        for job, timestamp in running_jobs:
+            ret = ret + max(self.estimatedDuration(job) - (time.time() - timestamp), 0)
+        return ret
+
+    def numWorkersNeeded(self, *, queued_jobs: List[Dict[str, Any]], running_jobs: List[Any]) -> int:
+        """Number of workers needed to complete the queued jobs and the running jobs ((job, timestamp) pairs) in the target time
+        """
+        x = 0.0
+        for job in queued_jobs:
+            x = x + self.estimatedDuration(job) / self._horizon(job)
+        for job, timestamp in running_jobs:
+            x = x + max(self.estimatedDuration(job) - (time.time() - timestamp), 0) / self._horizon(job)
+        # never more than one worker per job
+        return min(int(math.ceil(x - 1e-6)), len(queued_jobs) + len(running_jobs))
+
+    def scaleDownDelay(self) -> float:
+        """Number of seconds that a batch may be idle (with an empty queue) before it is halted
+        """
+        # about the duration of a typical job, since the jobs that depend on the running jobs may become ready by then
+        durations = [d for durations in self._durations.values() for d in durations]
+        if len(durations) == 0:
+            return 30
+        return min(max(sum(durations) / len(durations), 5), 30)
+
+    def _horizon(self, job: Dict[str, Any]) -> float:
+        # The number of seconds that one worker can spend on jobs like this one
+        duration = self.estimatedDuration(job)
+        horizon = self._target_sec
+        if self._time_limit_per_batch is not None:
+            # a worker only starts a job if it would finish (by its timeout) within the time limit of the batch
+            horizon = min(horizon, max(self._time_limit_per_batch - _job_timeout(job), 0) + duration)
+        return max(horizon, duration, 1e-3)
 
 
 class _Batch():
@@ -190,7 +441,8 @@ class _Batch():
         num_cores_per_job: int,
         use_slurm: bool,
         time_limit: Union[float, None],
-        additional_srun_opts: List[str]
+        additional_srun_opts: List[str],
+        job_server: Optional['_JobServer']
     ):
         """Constructor for _Batch class internal to SlurmJobHandler
 
@@ -200,6 +452,8 @@ class _Batch():
             The working directory within the slurm job handler working directory
         batch_label : str
             A label for display purposes
+        job_server : Optional[_JobServer]
+            If not None, the workers connect to this server (socket transport) rather than using files
         """
         os.mkdir(working_dir)
         self._status = 'pending'
@@ -211,11 +465,13 @@ class _Batch():
         self._use_slurm = use_slurm
         self._time_limit = time_limit
         self._additional_srun_opts = additional_srun_opts
-        self._workers: List[_Worker] = []
+        self._workers: List[Union[_Worker, _SocketWorker]] = []
         self._had_a_job = False
         self._timestamp_slurm_process_started = None
+        self._job_server = job_server
 
-        # Create the workers
+        # Create the workers. With the socket transport, _SocketWorker objects are added as the workers
+        # connect, and a worker that cannot connect falls back to the file transport (as a _Worker).
         for i in range(self._num_workers):
             self._workers.append(_Worker(base_path=self._working_dir + '/worker_{}'.format(i)))
 
@@ -225,7 +481,10 @@ class _Batch():
             num_cores_per_job=self._num_cores_per_job,
             additional_srun_opts=self._additional_srun_opts,
             use_slurm=self._use_slurm,
-            time_limit=self._time_limit
+            time_limit=self._time_limit,
+            job_server_address=self._job_server.address() if self._job_server is not None else '',
+            job_server_token=self._job_server.token() if self._job_server is not None else '',
+            batch_key=self.batchKey()
         )
 
     def isPending(self) -> bool:
@@ -240,6 +499,31 @@ class _Batch():
     def isFinished(self) -> bool:
         return self._status == 'finished'
 
+    def batchLabel(self) -> str:
+        return self._batch_label
+
+    def numWorkers(self) -> int:
+        return self._num_workers
+
+    def batchKey(self) -> str:
+        # Identifies the batch when its workers connect to the job server
+        return os.path.basename(self._working_dir)
+
+    def addSocketWorker(self, connection: '_Connection') -> None:
+        """Called when a worker of this batch connects to the job server (socket transport)
+        """
+        if len([w for w in self._workers if w.hasStarted()]) >= self._num_workers:
+            raise Exception('Unexpected: too many workers connected for {}'.format(self._batch_label))
+        self._workers.append(_SocketWorker(connection))
+        if self.isWaitingToStart():
+            self._status = 'running'
+            self._time_started = time.time()
+
+    def hasFileWorkers(self) -> bool:
+        """Whether some worker of the batch uses the file transport (with the socket transport, after a failed connection)
+        """
+        return any([isinstance(w, _Worker) and w.hasStarted() for w in self._workers])
+
     def timeStarted(self) -> Optional[float]:
         return self._time_started
 
@@ -280,31 +564,15 @@ class _Batch():
                 #         raise Exception(f'Unable to start batch after {elapsed} sec.')
         elif self.isRunning():
             # first iterate all the workers so they can do what they need to do
+            # (the job handler decides when an idle batch is halted)
             for w in self._workers:
                 w.iterate()
-
-            # If we had a job in the past and we
-            # haven't had anything to do for last 30 seconds, then
-            # let's just end.
-            if self._had_a_job:
-                still_doing_stuff = False
-                for w in self._workers:
-                    if w.hasJob():
-                        still_doing_stuff = True
-                    else:
-                        if w.everHadJob():
-                            elapsed = w.elapsedTimeSinceLastJob()
-                            assert elapsed is not None, "Unexpected elapsed is None"
-                            if elapsed <= 30:
-                                still_doing_stuff = True
-                if not still_doing_stuff:
-                    self.halt()
         elif self.isFinished():
             # We are finished so there's nothing to do
             pass
 
-    def canAddJob(self, job: Dict[str, Any]) -> bool:
-        """Return True if we are able to add job, based on timing info, etc.
+    def hasTimeForJob(self, job: Dict[str, Any]) -> bool:
+        """Return True if the job would finish within the time limit of the batch (based on the job timeout)
 
         Parameters
         ----------
@@ -314,7 +582,7 @@ class _Batch():
         Returns
         -------
         bool
-            Whether the job can be added
+            Whether the job fits in the remaining time
         """
         if self.isFinished():
             # We are finished, so we can't add any jobs
@@ -329,12 +597,35 @@ class _Batch():
             if job_timeout + self.elapsedSinceStarted() > self._time_limit + 5:
                 # We would exceed the time limit. Can't add the job
                 return False
-        # If some worker has a vacancy then we can add the job
+        return True
+
+    def remainingTime(self) -> float:
+        """Number of seconds until the time limit of the batch (inf if there is no time limit)
+        """
+        if self._time_limit is None:
+            return float('inf')
+        return self._time_limit - self.elapsedSinceStarted()
+
+    def idleWorkers(self) -> list:
+        """The workers that have started and do not have a job
+        """
+        return [w for w in self._workers if w.hasStarted() and (not w.hasJob())]
+
+    def numWorkersToConnect(self) -> int:
+        """Number of workers of a running batch that have not started yet
+        """
+        return self._num_workers - len([w for w in self._workers if w.hasStarted()])
+
+    def elapsedSinceIdle(self) -> float:
+        """Number of seconds since the batch last had a job (or since it started)
+        """
+        if self.hasJob():
+            return 0
+        elapsed = self.elapsedSinceStarted()
         for w in self._workers:
-            if not w.hasJob():
-                return True
-        # Otherwise, we have no vacancy for a new job
-        return False
+            if w.everHadJob():
+                elapsed = min(elapsed, w.elapsedTimeSinceLastJob())
+        return elapsed
 
     def hasJob(self) -> bool:
         """Return True if some worker has a job
@@ -344,13 +635,15 @@ class _Batch():
                 return True
         return False
 
-    def addJob(self, job: Dict[str, Any]) -> None:
-        """Add a job to the batch. Presumably it was already checked with canAddJob()
+    def addJob(self, job: Dict[str, Any], *, worker: Union['_Worker', '_SocketWorker']) -> None:
+        """Add a job to an idle worker of the batch. Presumably it was already checked with hasTimeForJob()
 
         Parameters
         ----------
         job : hither job
             The job to add
+        worker : _Worker or _SocketWorker
+            One of the idleWorkers() of this batch
 
         Returns
         -------
@@ -371,14 +664,9 @@ class _Batch():
         # Since we are adding a job, we declare that we have had a job
         self._had_a_job = True
 
-        # Add the job to a vacant worker
-        for w in self._workers:
-            if not w.hasJob():
-                w.setJob(job)
-                return
-
-        # This would be unexpected because we should have already checked with canAddJob()
-        raise Exception('Unexpected: Unable to add job to batch. Unexpected -- no vacancies.')
+        if worker.hasJob() or not any([w is worker for w in self._workers]):
+            raise Exception('Unexpected: Unable to add job to batch. Unexpected -- worker is not idle.')
+        worker.setJob(job)
 
     def start(self) -> None:
         """Start the batch
@@ -405,6 +693,10 @@ class _Batch():
     def halt(self) -> None:
         """Halt the batch
         """
+        # Tell the connected workers to stop (socket transport)
+        for w in self._workers:
+            if isinstance(w, _SocketWorker):
+                w.stop()
         # Remove the running.txt file which should trigger the workers to end
         running_fname = self._working_dir + '/running.txt'
         if os.path.exists(running_fname):
@@ -556,8 +848,186 @@ class _Worker():
             self._job_finish_timestamp = time.time()
 
 
+class _SocketWorker():
+    def __init__(self, connection: '_Connection'):
+        """Worker of a _Batch that is connected to the job server (socket transport)
+
+        Same interface as _Worker, except that the jobs and results are passed
+        over the connection.
+        """
+        self._connection = connection
+        self._connection.worker = self
+        self._job: Optional[Dict[str, Any]] = None
+        self._job_finish_timestamp: Optional[float] = None
+
+    def hasJob(self) -> bool:
+        return self._job is not None
+
+    def hasStarted(self) -> bool:
+        # The worker is created when it connects
+        return True
+
+    def everHadJob(self) -> bool:
+        return (self._job is not None) or (self._job_finish_timestamp is not None)
+
+    def elapsedTimeSinceLastJob(self) -> Optional[float]:
+        if self._job is not None:
+            return 0
+        if self._job_finish_timestamp is not None:
+            return time.time() - self._job_finish_timestamp
+        return None
+
+    def setJob(self, job: Dict[str, Any]) -> None:
+        self._job = job
+        self._connection.send(dict(type='job', job=_serialize_runnable_job(job)))
+
+    def iterate(self) -> None:
+        # Everything happens in handleMessage()
+        pass
+
+    def handleMessage(self, msg: Optional[dict]) -> None:
+        if msg is None:
+            # The connection was closed
+            if self._job is not None:
+                label = self._job.get('label', self._job.get('name', '<>'))
+                raise Exception(f'Unexpected: worker disconnected while processing job {label} in batch.')
+            return
+        if msg['type'] == 'result':
+            result0 = Result()
+            result0.deserialize(msg['result'])
+            job = self._job
+            self._job = None
+            self._job_finish_timestamp = time.time()
+            _set_result(job, result0)
+        elif msg['type'] == 'error':
+            # This is not a job error, this is a framework error
+            print('#####################################################################################################################################')
+            print(msg['traceback'])
+            print('#####################################################################################################################################')
+            try:
+                label = self._job.get('label', self._job.get('name', '<>'))
+            except:
+                label = 'unknown'
+            raise Exception(f'Unexpected error processing job {label} in batch.')
+
+    def stop(self) -> None:
+        self._connection.send(dict(type='stop'))
+
+class _Connection():
+    def __init__(self, sock: socket.socket):
+        # A connection from a batch worker to the job server. Messages are lines of JSON.
+        self.sock = sock
+        self.worker: Optional[_SocketWorker] = None
+        self._buffer = b''
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def send(self, msg: dict) -> None:
+        try:
+            self.sock.sendall((json.dumps(msg) + '\n').encode('utf-8'))
+        except OSError:
+            # the worker is gone; this is handled when the connection is found to be closed
+            pass
+
+    def read_messages(self) -> Optional[List[dict]]:
+        # Called when the socket is readable. Returns None if the connection was closed.
+        try:
+            x = self.sock.recv(65536)
+        except OSError:
+            x = b''
+        if len(x) == 0:
+            return None
+        self._buffer = self._buffer + x
+        ret = []
+        while b'\n' in self._buffer:
+            line, self._buffer = self._buffer.split(b'\n', 1)
+            ret.append(json.loads(line.decode('utf-8')))
+        return ret
+
+class _JobServer():
+    def __init__(self, *, host_for_workers: str):
+        """TCP server that the batch workers connect back to (socket transport of SlurmJobHandler)
+
+        Parameters
+        ----------
+        host_for_workers : str
+            The host name (or address) that the workers use to reach this machine
+        """
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Only listen on the interface that the workers use (not on all interfaces). If the workers
+        # cannot connect (e.g., a firewall between the nodes), they fall back to the file transport.
+        self._sock.bind((socket.gethostbyname(host_for_workers), 0))
+        self._sock.listen(128)
+        self._sock.setblocking(False)
+        self._host_for_workers = host_for_workers
+        self._token = _random_string(16)
+        self._connections: List[_Connection] = []
+        self._unauthenticated: List[_Connection] = []
+
+    def address(self) -> str:
+        return '{}:{}'.format(self._host_for_workers, self._sock.getsockname()[1])
+
+    def token(self) -> str:
+        return self._token
+
+    def wait_objects(self) -> list:
+        return [self._sock] + [c.sock for c in self._connections + self._unauthenticated]
+
+    def poll(self) -> List[Any]:
+        """Accept new connections and read the available messages without blocking
+
+        Returns a list of (connection, message), where message is None if the connection was closed.
+        """
+        ret: List[Any] = []
+        while True:
+            try:
+                sock, _ = self._sock.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            sock.setblocking(True)
+            self._unauthenticated.append(_Connection(sock))
+        all_connections = self._connections + self._unauthenticated
+        if len(all_connections) == 0:
+            return ret
+        readable, _, _ = select.select(all_connections, [], [], 0)
+        for c in readable:
+            msgs = c.read_messages()
+            if msgs is None:
+                self.closeConnection(c)
+                if c.worker is not None:
+                    ret.append((c, None))
+                continue
+            for msg in msgs:
+                if c in self._unauthenticated:
+                    if (msg.get('type', None) == 'hello') and (msg.get('token', None) == self._token):
+                        self._unauthenticated.remove(c)
+                        self._connections.append(c)
+                        ret.append((c, msg))
+                    else:
+                        self.closeConnection(c)
+                        break
+                else:
+                    ret.append((c, msg))
+        return ret
+
+    def closeConnection(self, c: _Connection) -> None:
+        if c in self._connections:
+            self._connections.remove(c)
+        if c in self._unauthenticated:
+            self._unauthenticated.remove(c)
+        try:
+            c.sock.close()
+        except:
+            pass
+
+    def close(self) -> None:
+        for c in self._connections + self._unauthenticated:
+            self.closeConnection(c)
+        self._sock.close()
+
 class _SlurmProcess():
-    def __init__(self, working_dir: str, num_workers: int, additional_srun_opts: List[str], use_slurm: bool, time_limit: Optional[float], num_cores_per_job: int):
+    def __init__(self, working_dir: str, num_workers: int, additional_srun_opts: List[str], use_slurm: bool, time_limit: Optional[float], num_cores_per_job: int, job_server_address: str='', job_server_token: str='', batch_key: str=''):
         """Constructor for a slurm process (corresponding to a batch)
 
         Parameters
@@ -574,6 +1044,12 @@ class _SlurmProcess():
             The time limit in seconds for this slurm batch
         num_cores_per_job : int
             Number of cpu cores devoted to each job / worker
+        job_server_address : str
+            host:port of the job server for the socket transport, or empty for the file transport
+        job_server_token : str
+            Token that the workers send when connecting to the job server
+        batch_key : str
+            Identifies the batch when the workers connect to the job server
         """
         self._working_dir = working_dir
         self._num_workers = num_workers
@@ -583,6 +1059,9 @@ class _SlurmProcess():
         if self._num_cores_per_job is None:
             self._num_cores_per_job = 1
         self._time_limit = time_limit
+        self._job_server_address = job_server_address
+        self._job_server_token = job_server_token
+        self._batch_key = batch_key
 
     def start(self) -> None:
         """Start the slurm process
@@ -612,6 +1091,44 @@ class _SlurmProcess():
                 except:
                     pass
 
+                job_server_address = '{job_server_address}'
+                sock = None
+                if job_server_address:
+                    import socket
+                    host, port = job_server_address.rsplit(':', 1)
+                    try:
+                        sock = socket.create_connection((host, int(port)), timeout=30)
+                        sock.settimeout(None)
+                    except OSError:
+                        traceback.print_exc()
+                        print('WARNING: Unable to connect to the job handler at {}. Using the file transport.'.format(job_server_address))
+                        sock = None
+                if sock is not None:
+                    # Socket transport: fetch the jobs from the handler and send back the results
+                    import sys
+                    sockf = sock.makefile('rwb')
+                    def send_message(msg):
+                        sockf.write((json.dumps(msg) + '\\n').encode('utf-8'))
+                        sockf.flush()
+                    send_message(dict(type='hello', token='{job_server_token}', batch='{batch_key}'))
+                    while True:
+                        line = sockf.readline()
+                        if not line:
+                            print('Connection to job handler closed. Stopping worker.')
+                            break
+                        msg = json.loads(line.decode('utf-8'))
+                        if msg['type'] == 'stop':
+                            print('Stopping worker.')
+                            break
+                        elif msg['type'] == 'job':
+                            try:
+                                job = _deserialize_runnable_job(msg['job'])
+                                _run_job(job)
+                                send_message(dict(type='result', result=job['result'].serialize()))
+                            except:
+                                send_message(dict(type='error', traceback=traceback.format_exc()))
+                    sys.exit(0)
+
                 slurm_started_fname = working_dir + '/slurm_started.txt'
                 with FileLock(slurm_started_fname + '.lock', exclusive=True):
                     with open(slurm_started_fname, 'w') as f:
@@ -695,6 +1212,9 @@ class _SlurmProcess():
         srun_py_script.substitute('{num_workers}', self._num_workers)
         srun_py_script.substitute('{running_fname}', self._working_dir + '/running.txt')
         srun_py_script.substitute('{kachery_config_json}', json.dumps(ka.get_config()))
+        srun_py_script.substitute('{job_server_address}', self._job_server_address)
+        srun_py_script.substitute('{job_server_token}', self._job_server_token)
+        srun_py_script.substitute('{batch_key}', self._batch_key)
         srun_py_script.write()
 
         srun_opts = []
@@ -812,6 +1332,13 @@ def _rmdir_with_retries(dirname, num_retries, delay_between_tries=1):
                 raise Exception('Unable to remove directory after {} tries: {}'.format(num_retries, dirname))
 
 
+def _job_timeout(job: Dict[str, Any]) -> float:
+    job_timeout = job.get('timeout', None)
+    if job_timeout is None:
+        # if job doesn't have timeout, we use the default
+        job_timeout = DEFAULT_JOB_TIMEOUT
+    return job_timeout
+
 def _random_string(num: int):
     """Generate random string of a given length.
     """
@@ -1,2 +1,2 @@
 from ._core import set_config, config
-from ._core import insert_one, find_one, find_all, update
+from ._core import insert_one, find_one, find_all, update, create_index
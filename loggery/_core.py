@@ -26,14 +26,27 @@ class _MongoClient:
             raise Exception('No db.')
         for doc in db.find(query).sort('time', direction=pymongo.DESCENDING):
             return doc
-    def find_all(self, *, query, config):
+    def find_all(self, *, query, config, projection=None, limit=None):
         db = self._get_db(config)
         if not db:
             raise Exception('No db.')
         ret = []
-        for doc in db.find(query).sort('time', direction=pymongo.ASCENDING):
+        if limit is None:
+            cursor = db.find(query, projection).sort('time', direction=pymongo.ASCENDING)
+        else:
+            # the most recent documents
+            cursor = db.find(query, projection).sort('time', direction=pymongo.DESCENDING).limit(limit)
+        for doc in cursor:
             ret.append(doc)
+        if limit is not None:
+            ret.reverse()
         return ret
+    def create_index(self, *, keys, config):
+        db = self._get_db(config)
+        if not db:
+            raise Exception('No db.')
+        # this is a no-op if the index already exists
+        db.create_index(keys)
     def update(self, *, query, update, config):
         db = self._get_db(config)
         if not db:
@@ -108,8 +121,11 @@ def insert_one(message: dict):
 def update(query, update):
     _global_client.update(query=query, update=update, config=_global_config.get_config())
 
+def create_index(keys: List[Tuple[str, int]]):
+    _global_client.create_index(keys=keys, config=_global_config.get_config())
+
 def find_one(query):
     return _global_client.find_one(query=query, config=_global_config.get_config())
 
-def find_all(query):
-    return _global_client.find_all(query=query, config=_global_config.get_config())
+def find_all(query, projection=None, limit=None):
+    return _global_client.find_all(query=query, config=_global_config.get_config(), projection=projection, limit=limit)
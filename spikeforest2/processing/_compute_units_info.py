@@ -3,9 +3,10 @@ import hither_sf as hither
 import numpy as np
 from spikeforest2_utils import AutoRecordingExtractor, AutoSortingExtractor
 
-@hither.function('compute_units_info', version='0.1.0')
+@hither.function('compute_units_info', version='0.1.1')
 @hither.input_file('sorting_path')
 @hither.output_file('json_out')
+@hither.resources(ram_gb=2)
 @hither.container(default='docker://magland/spikeforest2:0.1.1')
 @hither.local_module('../../spikeforest2_utils')
 def compute_units_info(recording_path, sorting_path, json_out):
@@ -17,19 +18,15 @@ def compute_units_info(recording_path, sorting_path, json_out):
 
 def _compute_units_info(*, recording, sorting, channel_ids=[], unit_ids=[]):
     import spikeextractors as se
-    import spiketoolkit as st
+    from spikeforest2_utils import bandpass_filter
 
     if (channel_ids) and (len(channel_ids) > 0):
         recording = se.SubRecordingExtractor(parent_recording=recording, channel_ids=channel_ids)
 
-    # load into memory
-    print('Loading recording into RAM...')
-    recording = se.NumpyRecordingExtractor(timeseries=recording.get_traces(), sampling_frequency=recording.get_sampling_frequency())
-
-    # do filtering
-    print('Filtering...')
-    recording = st.preprocessing.bandpass_filter(recording=recording, freq_min=300, freq_max=6000)
-    recording = se.NumpyRecordingExtractor(timeseries=recording.get_traces(), sampling_frequency=recording.get_sampling_frequency())
+    # The recording is filtered lazily, chunk by chunk, so only the chunks that contain the
+    # noise window and the snippets are filtered, and the memory use does not depend on the
+    # duration of the recording
+    recording = bandpass_filter(recording=recording, freq_min=300, freq_max=6000)
 
     if (not unit_ids) or (len(unit_ids) == 0):
         unit_ids = sorting.get_unit_ids()
@@ -74,25 +71,66 @@ def _compute_channel_noise_levels(recording):
     return ret
 
 def _compute_unit_templates(*, recording, sorting, unit_ids, snippet_len=50, max_num=100, channels=None):
-    ret = []
+    # The snippets of all of the units are read in one pass in the order of time, so that each
+    # filtered chunk of the recording is computed once (and then found in the chunk cache).
+    # Only the snippets of the units that are in progress are held: the buffer of a unit (at most
+    # max_num snippets) is allocated at its first event, and its template is computed and the
+    # buffer released as soon as its last event has been read. The memory therefore depends on
+    # how many units have events both before and after a given time (at worst all of them, when
+    # the events of every unit span the recording), in exchange for filtering the recording once.
+    event_frames = []
     for unit in unit_ids:
-        # print('Unit {} of {}'.format(unit,len(unit_ids)))
-        waveforms = _get_random_spike_waveforms(recording=recording, sorting=sorting, unit=unit, snippet_len=snippet_len, max_num=max_num, channels=None)
-        template = np.median(waveforms, axis=2)
-        ret.append(template)
+        event_frames.append(_get_random_spike_frames(sorting=sorting, unit=unit, max_num=max_num))
+    ret = [None for _ in unit_ids]
+    for ii, snippets in _iter_unit_snippets(recording=recording, event_frames=event_frames, snippet_len=snippet_len, channel_ids=channels):
+        # channels x snippet_len x events
+        waveforms = np.moveaxis(snippets, 0, 2)
+        ret[ii] = np.median(waveforms, axis=2)
     return ret
 
-def _get_random_spike_waveforms(*, recording, sorting, unit, snippet_len, max_num, channels=None):
+def _get_random_spike_frames(*, sorting, unit, max_num):
     st = sorting.get_unit_spike_train(unit_id=unit)
     num_events = len(st)
     if num_events > max_num:
         event_indices = np.random.choice(range(num_events), size=max_num, replace=False)
     else:
         event_indices = range(num_events)
+    return np.array(st)[event_indices].astype(int)
 
-    spikes = recording.get_snippets(reference_frames=st[event_indices].astype(int), snippet_len=snippet_len, channel_ids=channels)
-    if len(spikes) > 0:
-        spikes = np.dstack(tuple(spikes))
-    else:
-        spikes = np.zeros((recording.get_num_channels(), snippet_len, 0))
-    return spikes
\ No newline at end of file
+def _iter_unit_snippets(*, recording, event_frames, snippet_len, channel_ids=None):
+    # Yields (unit index, snippets) for each unit as soon as all of its snippets have been read,
+    # where event_frames[i] are the reference frames of unit i. The snippets are the same as
+    # recording.get_snippets (zero padded at the ends of the recording), read in the order of
+    # time, and stored in the dtype of the traces.
+    snippet_len_before = int((snippet_len + 1) / 2)
+    snippet_len_after = int(snippet_len - snippet_len_before)
+    if channel_ids is None:
+        channel_ids = recording.get_channel_ids()
+    N = recording.get_num_frames()
+    snippets = [None for _ in event_frames]
+    num_remaining = [len(frames) for frames in event_frames]
+    def _snippets_of_unit(ii, dtype=np.float64):
+        if snippets[ii] is None:
+            snippets[ii] = np.zeros((len(event_frames[ii]), len(channel_ids), snippet_len_before + snippet_len_after), dtype=dtype)
+        return snippets[ii]
+    for ii in range(len(event_frames)):
+        if num_remaining[ii] == 0:
+            yield ii, _snippets_of_unit(ii)
+            snippets[ii] = None
+    if len(event_frames) == 0:
+        return
+    all_frames = np.concatenate(event_frames)
+    all_units = np.concatenate([np.full(len(frames), ii, dtype=int) for ii, frames in enumerate(event_frames)])
+    all_indices = np.concatenate([np.arange(len(frames)) for frames in event_frames])
+    for i in np.argsort(all_frames, kind='stable'):
+        ii = all_units[i]
+        t = int(all_frames[i])
+        if 0 <= t < N:
+            i1 = max(t - snippet_len_before, 0)
+            i2 = min(t + snippet_len_after, N)
+            traces = recording.get_traces(channel_ids=channel_ids, start_frame=i1, end_frame=i2)
+            _snippets_of_unit(ii, traces.dtype)[all_indices[i], :, i1 - (t - snippet_len_before):i2 - (t - snippet_len_before)] = traces
+        num_remaining[ii] = num_remaining[ii] - 1
+        if num_remaining[ii] == 0:
+            yield ii, _snippets_of_unit(ii)
+            snippets[ii] = None
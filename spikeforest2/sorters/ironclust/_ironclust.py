@@ -3,6 +3,7 @@ import hither_sf as hither
 
 @hither.function('ironclust', '5.9.8-w4')
 @hither.output_file('sorting_out')
+@hither.resources(num_gpus=1, ram_gb=8)
 @hither.container(default='docker://jamesjun/sf-ironclust:5.9.8')
 @hither.local_module('../../../spikeforest2_utils')
 def ironclust(recording_path, sorting_out, 
@@ -3,6 +3,7 @@ import hither_sf as hither
 
 @hither.function('kilosort', '0.1.0-w1')
 @hither.output_file('sorting_out')
+@hither.resources(num_gpus=1, ram_gb=16)
 @hither.container(default='docker://magland/sf-kilosort:0.1.0')
 @hither.container(default=None)
 @hither.local_module('../../../spikeforest2_utils')
@@ -4,6 +4,7 @@ import hither_sf as hither
 
 @hither.function('tridesclous', '1.6.0')
 @hither.output_file('sorting_out')
+@hither.resources(num_gpus=1, ram_gb=4)
 #@hither.container(default='docker://magland/sf-tridesclous:1.4.3')
 @hither.container(default='docker://samuelgarcialyon/sf-tridesclous:1.6.0')
 @hither.local_module('../../../spikeforest2_utils')
@@ -1,6 +1,7 @@
-from .autoextractors import AutoRecordingExtractor, AutoSortingExtractor
+from .autoextractors import AutoRecordingExtractor, AutoSortingExtractor, sampled_digest, bandpass_filter
 from .autoextractors import MdaRecordingExtractor, MdaSortingExtractor
-from .autoextractors import DiskReadMda, readmda, writemda32, writemda64, writemda, appendmda
+from .autoextractors import TiledRecordingExtractor, convert_mda_recording_to_tiled
+from .autoextractors import DiskReadMda, DiskWriteMda, write_timeseries_blocks, readmda, writemda32, writemda64, writemda, appendmda
 from ._aggregate_sorting_results import aggregate_sorting_results
 from ._sortingcomparison import SortingComparison
 from ._test_sort_tetrode import test_sort_tetrode, test_sort_32c, test_sort_monotrode, test_sort
\ No newline at end of file
@@ -170,29 +170,22 @@ class SortingComparison():
         N2 = len(unit2_ids)
 
         # Compute events counts
+        trains1 = [np.asarray(sorting1.get_unit_spike_train(unit_id=u1)) for u1 in unit1_ids]
+        trains2 = [np.asarray(sorting2.get_unit_spike_train(unit_id=u2)) for u2 in unit2_ids]
         event_counts1 = np.zeros((N1)).astype(np.int64)
         for i1, u1 in enumerate(unit1_ids):
-            times1 = sorting1.get_unit_spike_train(unit_id=u1)
-            event_counts1[i1] = len(times1)
-            self._event_counts_1[u1] = len(times1)
+            event_counts1[i1] = len(trains1[i1])
+            self._event_counts_1[u1] = len(trains1[i1])
         event_counts2 = np.zeros((N2)).astype(np.int64)
         for i2, u2 in enumerate(unit2_ids):
-            times2 = sorting2.get_unit_spike_train(unit_id=u2)
-            event_counts2[i2] = len(times2)
-            self._event_counts_2[u2] = len(times2)
+            event_counts2[i2] = len(trains2[i2])
+            self._event_counts_2[u2] = len(trains2[i2])
 
-        # Compute matching events
-        matching_event_counts = np.zeros((N1, N2)).astype(np.int64)
+        # Compute matching events (same as count_matching_events for each pair of units)
+        matching_event_counts = count_matching_events_matrix(trains1, trains2, delta=self._delta_tp)
+        denom = event_counts1[:, np.newaxis] + event_counts2[np.newaxis, :] - matching_event_counts
         scores = np.zeros((N1, N2))
-        for i1, u1 in enumerate(unit1_ids):
-            times1 = sorting1.get_unit_spike_train(unit_id=u1)
-            for i2, u2 in enumerate(unit2_ids):
-                times2 = sorting2.get_unit_spike_train(unit_id=u2)
-                num_matches = count_matching_events(times1, times2, delta=self._delta_tp)
-                # test_unmatched=get_unmatched_times(times1,times2,delta=self._delta_tp)
-                # print(u1,u2,'num_matches',num_matches,'num_unmatched',len(test_unmatched),'sum',num_matches+len(test_unmatched),'total',len(times1))
-                matching_event_counts[i1, i2] = num_matches
-                scores[i1, i2] = self._compute_agreement_score(num_matches, event_counts1[i1], event_counts2[i2])
+        np.divide(matching_event_counts, denom, out=scores, where=(denom != 0))
 
         # Find best matches for spiketrains 1
         for i1, u1 in enumerate(unit1_ids):
@@ -513,6 +506,120 @@ def count_matching_events(times1, times2, delta=10):
     return len(inds2) + 1
 
 
+def count_matching_events_matrix(trains1, trains2, delta=10):
+    # The N1 x N2 matrix of count_matching_events(trains1[i1], trains2[i2], delta=delta), with all of
+    # the spike trains merged and sorted once.
+    #
+    # For a pair of units, count_matching_events merges the two trains and counts the runs of
+    # consecutive links, where a link is two events that are adjacent in the merged train, from
+    # different units and within delta. The merged train of a pair is a subsequence of the merged
+    # train of all of the units, so the links are the pairs of events (e, f), within delta and from
+    # the two sortings, with no event of the unit of e or of the unit of f between them. The number
+    # of runs is the number of links minus the number of links that continue the previous link.
+    #
+    # When the two trains of a pair share a time, count_matching_events leaves the order of the
+    # equal times to its (unstable) sort. That order does not change the count when the shared time
+    # has a single event of one of the two units and no other event of either unit within delta:
+    # no link can reach outside the tie, and the links inside it form one run whatever the order.
+    # Otherwise the pair is computed with count_matching_events itself, so that the matrix is the
+    # same as count_matching_events for every pair.
+    N1 = len(trains1)
+    N2 = len(trains2)
+    ret = np.zeros((N1, N2), dtype=np.int64)
+    trains = list(trains1) + list(trains2)
+    if (N1 == 0) or (N2 == 0) or (sum([len(train) for train in trains]) == 0):
+        return ret
+    times = np.concatenate([np.asarray(train).ravel() for train in trains])
+    units = np.concatenate([np.full(len(train), k, dtype=np.int64) for k, train in enumerate(trains)])
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    units = units[order]
+    S = len(times)
+
+    # the next and previous positions of the events of the same unit
+    by_unit = np.lexsort((np.arange(S), units))
+    same_next = np.full(S, S, dtype=np.int64)
+    same_prev = np.full(S, -1, dtype=np.int64)
+    same = units[by_unit[1:]] == units[by_unit[:-1]]
+    same_next[by_unit[:-1][same]] = by_unit[1:][same]
+    same_prev[by_unit[1:][same]] = by_unit[:-1][same]
+
+    # links, by offset in the merged train (the events are sorted, so an index that is out of
+    # range for one offset is out of range for all larger offsets)
+    link_starts = []
+    link_ends = []
+    tie_starts = []
+    tie_ends = []
+    active = np.arange(S, dtype=np.int64)
+    d = 1
+    while True:
+        active = active[active + d < S]
+        active = active[times[active + d] - times[active] <= delta]
+        if len(active) == 0:
+            break
+        ii = active
+        jj = active + d
+        cross = (units[ii] < N1) != (units[jj] < N1)
+        ok = cross & (same_next[ii] > jj) & (same_prev[jj] < ii)
+        link_starts.append(ii[ok])
+        link_ends.append(jj[ok])
+        tie = cross & (times[jj] == times[ii])
+        tie_starts.append(ii[tie])
+        tie_ends.append(jj[tie])
+        d = d + 1
+    if len(link_starts) == 0:
+        return ret
+    link_starts = np.concatenate(link_starts)
+    link_ends = np.concatenate(link_ends)
+    tie_starts = np.concatenate(tie_starts)
+    tie_ends = np.concatenate(tie_ends)
+    if len(link_starts) == 0:
+        return ret
+
+    # a link (e, f) continues the previous link if that link is (g, e) with g of the unit of f
+    U = len(trains)
+    end_keys = link_ends * U + units[link_starts]
+    start_keys = link_starts * U + units[link_ends]
+    end_keys = np.sort(end_keys)
+    pos = np.minimum(np.searchsorted(end_keys, start_keys), len(end_keys) - 1)
+    continues = end_keys[pos] == start_keys
+
+    u_a = units[link_starts]
+    u_b = units[link_ends]
+    i1 = np.where(u_a < N1, u_a, u_b)
+    i2 = np.where(u_a < N1, u_b, u_a) - N1
+    np.add.at(ret, (i1, i2), np.where(continues, 0, 1))
+
+    # the pairs with shared times where the order of the equal times may change the count
+    if len(tie_starts) == 0:
+        return ret
+    is_new = np.concatenate(([True], times[1:] != times[:-1]))
+    distinct_times = times[is_new]
+    ranks = np.cumsum(is_new) - 1
+    R = len(distinct_times) + 1
+    # sorted, since the events of each unit are in the order of time in by_unit
+    unit_rank_keys = (units * R + ranks)[by_unit]
+
+    def _num_events(k, rank1, rank2):
+        # number of events of unit k with the rank of their time in [rank1, rank2)
+        return np.searchsorted(unit_rank_keys, k * R + rank2) - np.searchsorted(unit_rank_keys, k * R + rank1)
+    t = times[tie_starts]
+    r = ranks[tie_starts]
+    r1 = np.searchsorted(distinct_times, t - delta, side='left')
+    r2 = np.searchsorted(distinct_times, t + delta, side='right')
+    u_a = units[tie_starts]
+    u_b = units[tie_ends]
+    num_a = _num_events(u_a, r, r + 1)
+    num_b = _num_events(u_b, r, r + 1)
+    ambiguous = ((num_a >= 2) & (num_b >= 2)) | (_num_events(u_a, r1, r2) > num_a) | (_num_events(u_b, r1, r2) > num_b)
+    u_a = u_a[ambiguous]
+    u_b = u_b[ambiguous]
+    ambiguous_pairs = set(zip(np.where(u_a < N1, u_a, u_b).tolist(), (np.where(u_a < N1, u_b, u_a) - N1).tolist()))
+    for i1, i2 in ambiguous_pairs:
+        ret[i1, i2] = count_matching_events(trains1[i1], trains2[i2], delta=delta)
+    return ret
+
+
 def confusion_matrix(gtst, sst, pairs, plot_fig=True, xlabel=None, ylabel=None):
     '''
 
@@ -1,4 +1,6 @@
 from .autosortingextractor import AutoSortingExtractor
-from .autorecordingextractor import AutoRecordingExtractor
-from .mdaextractors import DiskReadMda, readmda, writemda32, writemda64, writemda, appendmda
-from .mdaextractors import MdaRecordingExtractor, MdaSortingExtractor
\ No newline at end of file
+from .autorecordingextractor import AutoRecordingExtractor, sampled_digest
+from .bandpass_filter import bandpass_filter
+from .mdaextractors import DiskReadMda, DiskWriteMda, write_timeseries_blocks, readmda, writemda32, writemda64, writemda, appendmda
+from .mdaextractors import MdaRecordingExtractor, MdaSortingExtractor
+from .tiledextractors import TiledRecordingExtractor, convert_mda_recording_to_tiled
\ No newline at end of file
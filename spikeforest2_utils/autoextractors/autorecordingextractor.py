@@ -3,13 +3,18 @@ from .bandpass_filter import bandpass_filter
 import spikeextractors as se
 import numpy as np
 import hashlib
+import os
 import json
 from .mdaextractors import MdaRecordingExtractor
+from .tiledextractors import TiledRecordingExtractor
+from .filehashindex import get_file_hash
 
 class AutoRecordingExtractor(se.RecordingExtractor):
-    def __init__(self, arg, download=False):
+    def __init__(self, arg, download=False, lazy_hash=False):
+        # With lazy_hash=True, the hash of the timeseries file is not computed until hash() is called
         super().__init__()
         self._hash = None
+        self._hash_function = None
         if isinstance(arg, str):
             arg = dict(path=arg)
         if isinstance(arg, se.RecordingExtractor):
@@ -22,10 +27,10 @@ class AutoRecordingExtractor(se.RecordingExtractor):
 
             # filters
             if ('recording' in arg) and ('filters' in arg):
-                recording1 = AutoRecordingExtractor(arg['recording'])
+                recording1 = AutoRecordingExtractor(arg['recording'], lazy_hash=lazy_hash)
                 self._recording = self._apply_filters(recording1, arg['filters'])
             elif ('raw' in arg) and ('params' in arg) and ('geom' in arg):
-                self._recording = MdaRecordingExtractor(timeseries_path=arg['raw'], samplerate=arg['params']['samplerate'], geom=np.array(arg['geom']), download=download)
+                self._recording = MdaRecordingExtractor(timeseries_path=arg['raw'], samplerate=arg['params']['samplerate'], geom=np.array(arg['geom']), download=download, lazy_hash=lazy_hash)
                 return
             else:
                 path = arg.get('path', '')
@@ -35,12 +40,20 @@ class AutoRecordingExtractor(se.RecordingExtractor):
                     if 'samplerate' not in arg:
                         raise Exception('Missing argument: samplerate')
                     samplerate = arg['samplerate']
-                    self._recording = MdaRecordingExtractor(timeseries_path=path, samplerate=samplerate, download=download)
-                    hash0 = _sha1_of_object(dict(
-                        timeseries_sha1=ka.get_file_info(path, algorithm='sha1')['sha1'],
-                        samplerate=samplerate
-                    ))
-                    setattr(self, 'hash', hash0)
+                    self._recording = MdaRecordingExtractor(timeseries_path=path, samplerate=samplerate, download=download, lazy_hash=lazy_hash)
+                    def hash_function():
+                        return _sha1_of_object(dict(
+                            timeseries_sha1=get_file_hash(path),
+                            samplerate=samplerate
+                        ))
+                    if lazy_hash:
+                        self._hash_function = hash_function
+                    else:
+                        setattr(self, 'hash', hash_function())
+                elif path.endswith('.tiles'):
+                    if 'samplerate' not in arg:
+                        raise Exception('Missing argument: samplerate')
+                    self._recording = TiledRecordingExtractor(timeseries_path=path, samplerate=arg['samplerate'], download=download, lazy_hash=lazy_hash)
                 elif path.endswith('.nwb.json'):
                     self._recording = NwbJsonRecordingExtractor(file_path=path)
                     hash0 = ka.get_file_info(path)['sha1']
@@ -50,11 +63,16 @@ class AutoRecordingExtractor(se.RecordingExtractor):
                     if obj is None:
                         raise Exception(f'Unable to load object: {path}')
                     if ('raw' in obj) and ('params' in obj) and ('geom' in obj):
-                        self._recording = MdaRecordingExtractor(timeseries_path=obj['raw'], samplerate=obj['params']['samplerate'], geom=np.array(obj['geom']), download=download)
+                        if obj['raw'].endswith('.tiles'):
+                            self._recording = TiledRecordingExtractor(timeseries_path=obj['raw'], samplerate=obj['params']['samplerate'], geom=np.array(obj['geom']), download=download, lazy_hash=lazy_hash)
+                        else:
+                            self._recording = MdaRecordingExtractor(timeseries_path=obj['raw'], samplerate=obj['params']['samplerate'], geom=np.array(obj['geom']), download=download, lazy_hash=lazy_hash)
                     else:
                         raise Exception('Problem initializing recording extractor')
-                elif ka.get_file_info(path + '/raw.mda'):
-                    self._recording = MdaRecordingExtractor(recording_directory=path, download=download)
+                elif _file_exists(path + '/raw.mda'):
+                    self._recording = MdaRecordingExtractor(recording_directory=path, download=download, lazy_hash=lazy_hash)
+                elif _file_exists(path + '/raw.tiles'):
+                    self._recording = TiledRecordingExtractor(recording_directory=path, download=download, lazy_hash=lazy_hash)
                 else:
                     raise Exception('Unable to initialize recording extractor. Unable to determine format of recording: {}'.format(path))
         self.copy_channel_properties(recording=self._recording)
@@ -79,13 +97,15 @@ class AutoRecordingExtractor(se.RecordingExtractor):
     
     def hash(self):
         if not self._hash:
-            if hasattr(self._recording, 'hash'):
+            if self._hash_function is not None:
+                self._hash = self._hash_function()
+            elif hasattr(self._recording, 'hash'):
                 if type(self._recording.hash) == str:
                     self._hash = self._recording.hash
                 else:
                     self._hash = self._recording.hash()
             else:
-                self._hash = _samplehash(self._recording)
+                self._hash = sampled_digest(self._recording)
         return self._hash
 
     def get_channel_ids(self):
@@ -100,6 +120,9 @@ class AutoRecordingExtractor(se.RecordingExtractor):
     def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
         return self._recording.get_traces(channel_ids=channel_ids, start_frame=start_frame, end_frame=end_frame)
 
+    def get_traces_windows(self, start_frames, window_size):
+        return _get_traces_windows(self._recording, start_frames, window_size)
+
 class NwbJsonRecordingExtractor(se.RecordingExtractor):
     extractor_name = 'NwbJsonRecordingExtractor'
     is_writable = False
@@ -167,24 +190,63 @@ class NwbElectricalSeriesRecordingExtractor(se.RecordingExtractor):
             X = load_nwb_item(file=f, nwb_path=self._nwb_path)
             return X['data'][start_frame:end_frame, :][:, channel_ids].T
 
-def _samplehash(recording):
-    obj = {
-        'channels': tuple(recording.get_channel_ids()),
-        'frames': recording.get_num_frames(),
-        'data': _samplehash_helper(recording)
-    }
-    return _sha1_of_object(obj)
-
-
-def _samplehash_helper(recording):
-    rng = np.random.RandomState(37)
-    n_samples = min(recording.get_num_frames() // 1000, 100)
-    inds = rng.randint(low=0, high=recording.get_num_frames(), size=n_samples)
-    h = 0
-    for i in inds:
-        t = recording.get_traces(start_frame=i, end_frame=i + 100)
-        h = hash((hash(bytes(t)), hash(h)))
-    return h
+def sampled_digest(recording, *, num_windows=100, window_size=100):
+    # A sha1 digest of the channel ids, the number of frames, and the traces in num_windows
+    # windows (at pseudo-random positions that only depend on the number of frames). This
+    # is the same in every process, so it can be used as the hash of a recording that does
+    # not have a hash() of its own.
+    N = recording.get_num_frames()
+    window_size = min(window_size, N)
+    if window_size > 0:
+        rng = np.random.RandomState(37)
+        start_frames = np.unique(rng.randint(low=0, high=N - window_size + 1, size=num_windows))
+    else:
+        start_frames = np.zeros((0,), dtype=int)
+    X = _get_traces_windows(recording, start_frames, window_size)
+    hh = hashlib.sha1()
+    hh.update(json.dumps(dict(
+        channels=[int(ch) if isinstance(ch, (int, np.integer)) else str(ch) for ch in recording.get_channel_ids()],
+        frames=int(N),
+        window_size=int(window_size),
+        start_frames=[int(i) for i in start_frames],
+        dtype=X.dtype.str[1:]
+    ), sort_keys=True, separators=(',', ':')).encode('utf-8'))
+    hh.update(np.ascontiguousarray(X, dtype=X.dtype.newbyteorder('<')).tobytes())
+    return hh.hexdigest()
+
+
+def _get_traces_windows(recording, start_frames, window_size):
+    # The traces of all channels in the windows, as an array (channels x windows x frames).
+    # The recording may provide a batched read (get_traces_windows). Otherwise, windows that
+    # are close together are read with a single get_traces call.
+    if hasattr(recording, 'get_traces_windows'):
+        return recording.get_traces_windows(start_frames, window_size)
+    start_frames = [int(i) for i in start_frames]
+    M = len(recording.get_channel_ids())
+    if len(start_frames) == 0:
+        # (a recording without frames)
+        return np.zeros((M, 0, window_size), dtype='float32')
+    blocks = []
+    i = 0
+    while i < len(start_frames):
+        j = i + 1
+        while (j < len(start_frames)) and (start_frames[j] - start_frames[j - 1] <= 10 * window_size):
+            j = j + 1
+        t1 = start_frames[i]
+        X = recording.get_traces(start_frame=t1, end_frame=start_frames[j - 1] + window_size)
+        for k in range(i, j):
+            blocks.append(X[:, start_frames[k] - t1:start_frames[k] - t1 + window_size])
+        i = j
+    return np.stack(blocks, axis=1)
+
+
+def _file_exists(path):
+    # ka.get_file_info() would compute the hash of a local file
+    if os.path.isfile(path):
+        return True
+    if os.path.isdir(os.path.dirname(path)):
+        return False
+    return ka.get_file_info(path) is not None
 
 def _sha1_of_string(txt: str) -> str:
     hh = hashlib.sha1(txt.encode('utf-8'))
@@ -1,4 +1,6 @@
 from .filterrecording import FilterRecording
+import threading
+from collections import OrderedDict
 import numpy as np
 from scipy import special
 
@@ -13,6 +15,10 @@ class BandpassFilterRecording(FilterRecording):
             freq_wid=freq_wid
         )
         self._recording = recording
+        # The raw data of the last padded chunk (i1, i2, data), so that the overlap with the
+        # next chunk does not need to be read again
+        self._last_read = None
+        self._last_read_lock = threading.Lock()
 
     def paramsForHash(self):
         return self._params
@@ -21,14 +27,15 @@ class BandpassFilterRecording(FilterRecording):
         padding = 3000
         i1 = start_frame - padding
         i2 = end_frame + padding
+        # Extend the padding at the end so that the FFT size is fast (for the
+        # default chunk size and padding, 36000 is already 5-smooth)
+        i2 = i1 + _next_fast_len(i2 - i1)
         padded_chunk = self._read_chunk(i1, i2)
         if i1 < 0:
-            for m in range(padded_chunk.shape[0]):
-                padded_chunk[m, :-i1] = padded_chunk[m, -i1]
+            padded_chunk[:, :-i1] = padded_chunk[:, -i1][:, np.newaxis]
         if i2 > self._recording.get_num_frames():
-            for m in range(padded_chunk.shape[0]):
-                aa = (i2 - self._recording.get_num_frames())
-                padded_chunk[m, -aa:] = padded_chunk[m, aa - 1]
+            aa = (i2 - self._recording.get_num_frames())
+            padded_chunk[:, -aa:] = padded_chunk[:, aa - 1][:, np.newaxis]
         filtered_padded_chunk = self._do_filter(padded_chunk)
         return filtered_padded_chunk[:, start_frame - i1:end_frame - i1]
 
@@ -64,15 +71,30 @@ class BandpassFilterRecording(FilterRecording):
         #        chunk2[m,:]=chunk2[m,:]-np.mean(chunk2[m,:])
         # Do the actual filtering with a DFT with real input
         chunk_fft = np.fft.rfft(chunk2)
+        kernel = self._get_filter_kernel(chunk2.shape[1], samplerate)
+        chunk_fft *= kernel[np.newaxis, :]
+        chunk_filtered = np.fft.irfft(chunk_fft, n=chunk2.shape[1])
+        return chunk_filtered
+
+    def _get_filter_kernel(self, N, samplerate):
+        # The kernels are the same for all of the chunks (of the same size), so they are cached
+        key = (N, samplerate, self._params['freq_min'], self._params['freq_max'], self._params['freq_wid'])
+        with _kernel_cache_lock:
+            kernel = _kernel_cache.get(key, None)
+            if kernel is not None:
+                _kernel_cache.move_to_end(key)
+                return kernel
         kernel = self._create_filter_kernel(
-            chunk2.shape[1],
+            N,
             samplerate,
             self._params['freq_min'], self._params['freq_max'], self._params['freq_wid']
         )
-        kernel = kernel[0:chunk_fft.shape[1]]  # because this is the DFT of real data
-        chunk_fft = chunk_fft * np.tile(kernel, (M, 1))
-        chunk_filtered = np.fft.irfft(chunk_fft)
-        return chunk_filtered
+        kernel = kernel[0:N // 2 + 1]  # because this is the DFT of real data
+        with _kernel_cache_lock:
+            _kernel_cache[key] = kernel
+            while len(_kernel_cache) > 16:
+                _kernel_cache.popitem(last=False)
+        return kernel
 
     def _read_chunk(self, i1, i2):
         M = len(self._recording.get_channel_ids())
@@ -86,10 +108,44 @@ class BandpassFilterRecording(FilterRecording):
         else:
             i2b = i2
         ret = np.zeros((M, i2 - i1))
-        ret[:, i1b - i1:i2b - i1] = self._recording.get_traces(start_frame=i1b, end_frame=i2b)
+        # Reuse the overlap with the last chunk that was read (adjacent chunks overlap by twice the padding)
+        with self._last_read_lock:
+            last_read = self._last_read
+        if (last_read is not None) and (last_read[0] <= i1b < last_read[1] <= i2b):
+            j1, j2, last_data = last_read
+            ret[:, i1b - i1:j2 - i1] = last_data[:, i1b - j1:j2 - j1]
+            i1c = j2
+        else:
+            i1c = i1b
+        if i2b > i1c:
+            ret[:, i1c - i1:i2b - i1] = self._recording.get_traces(start_frame=i1c, end_frame=i2b)
+        with self._last_read_lock:
+            # only the frames that are within the recording (the padding is modified by filterChunk)
+            self._last_read = (i1b, i2b, ret[:, i1b - i1:i2b - i1])
         return ret
 
 
+def _next_fast_len(n):
+    # The smallest 5-smooth number (only prime factors 2, 3 and 5) that is >= n
+    best = None
+    p5 = 1
+    while p5 < 2 * n:
+        p35 = p5
+        while p35 < 2 * n:
+            p235 = p35
+            while p235 < n:
+                p235 = p235 * 2
+            if (best is None) or (p235 < best):
+                best = p235
+            p35 = p35 * 3
+        p5 = p5 * 5
+    return best
+
+
+_kernel_cache: OrderedDict = OrderedDict()
+_kernel_cache_lock = threading.Lock()
+
+
 def bandpass_filter(recording, freq_min=300, freq_max=6000, freq_wid=1000, resample=None):
     return BandpassFilterRecording(
         recording=recording,
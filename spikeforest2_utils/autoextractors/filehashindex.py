@@ -0,0 +1,80 @@
+import os
+import threading
+import kachery as ka
+
+# Persistent index of the sha1 hashes of local files, so that the hash of a large
+# file (e.g., raw.mda) is computed once rather than in every process that opens it.
+# The entries are keyed on the real path, inode, modification time and size, so an
+# entry is not used after the file changes. The index is a sqlite database at
+# $SPIKEFOREST_HASH_INDEX (default ~/.spikeforest2/file_hash_index.db).
+
+def get_file_hash(path):
+    if _is_url(path) or (not os.path.isfile(path)):
+        return ka.get_file_hash(path)
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    key = (path, st.st_ino, st.st_mtime_ns, st.st_size)
+    try:
+        conn = _connection()
+        row = conn.execute(
+            'SELECT sha1 FROM file_hashes WHERE path = ? AND inode = ? AND mtime_ns = ? AND size = ?',
+            key
+        ).fetchone()
+    except Exception as e:
+        print('WARNING: problem reading file hash index: {}'.format(e))
+        return ka.get_file_hash(path)
+    if row is not None:
+        return row[0]
+    sha1 = ka.get_file_hash(path)
+    if sha1 is None:
+        return None
+    try:
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO file_hashes (path, inode, mtime_ns, size, sha1) VALUES (?, ?, ?, ?, ?)',
+                key + (sha1,)
+            )
+    except Exception as e:
+        print('WARNING: problem writing file hash index: {}'.format(e))
+    return sha1
+
+
+def _index_path():
+    return os.getenv('SPIKEFOREST_HASH_INDEX', os.path.join(os.path.expanduser('~'), '.spikeforest2', 'file_hash_index.db'))
+
+
+def _connection():
+    # One connection per (index path, process, thread), since sqlite connections
+    # must not be shared across a fork or between threads
+    import sqlite3
+    index_path = _index_path()
+    key = (index_path, os.getpid(), threading.get_ident())
+    conn = _connections.get(key, None)
+    if conn is not None:
+        return conn
+    dirname = os.path.dirname(index_path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    conn = sqlite3.connect(index_path, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS file_hashes (
+                path TEXT PRIMARY KEY,
+                inode INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                sha1 TEXT NOT NULL
+            )
+        ''')
+    _connections[key] = conn
+    return conn
+
+
+_connections = dict()
+
+
+def _is_url(path):
+    path = path or ''
+    return path.startswith('http://') or path.startswith('https://') or path.startswith(
+        'kbucket://') or path.startswith('sha1://') or path.startswith('sha1dir://')
@@ -1,14 +1,25 @@
 from abc import ABC, abstractmethod
+import threading
+from collections import OrderedDict, deque
 import spikeextractors as se
 import numpy as np
 import kachery as ka
 
 
 class FilterRecording(se.RecordingExtractor):
-    def __init__(self, *, recording, chunk_size=10000):
+    def __init__(self, *, recording, chunk_size=10000, chunk_cache_bytes=256 * 1024 * 1024):
+        # The filtered chunks (all channels) are kept in a least-recently-used cache of at most
+        # chunk_cache_bytes (0 to disable), so that overlapping get_traces calls (e.g., snippets)
+        # filter each chunk once
         se.RecordingExtractor.__init__(self)
         self._recording = recording
         self._chunk_size = chunk_size
+        self._chunk_cache_bytes = chunk_cache_bytes
+        self._chunk_cache: OrderedDict = OrderedDict()
+        self._chunk_cache_num_bytes = 0
+        self._chunk_cache_hits = 0
+        self._chunk_cache_misses = 0
+        self._chunk_cache_lock = threading.Lock()
         self.copy_channel_properties(recording)
 
     def paramsForHash(self):
@@ -42,6 +53,8 @@ class FilterRecording(se.RecordingExtractor):
             channel_ids = self.get_channel_ids()
         ich1 = int(start_frame / self._chunk_size)
         ich2 = int((end_frame - 1) / self._chunk_size)
+        all_channel_ids = self.get_channel_ids()
+        chan_idx = [all_channel_ids.index(chan) for chan in channel_ids]
         filtered_chunk_list = []
         for ich in range(ich1, ich2 + 1):
             filtered_chunk0 = self._get_filtered_chunk(ich)
@@ -53,16 +66,106 @@ class FilterRecording(se.RecordingExtractor):
                 end0 = end_frame - ich * self._chunk_size
             else:
                 end0 = self._chunk_size
-            chan_idx = [self.get_channel_ids().index(chan) for chan in channel_ids]
             filtered_chunk_list.append(filtered_chunk0[chan_idx, start0:end0])
         return np.concatenate(filtered_chunk_list, axis=1)
 
+    def iterChunks(self, *, start_frame=None, end_frame=None, channel_ids=None, num_threads=1):
+        # Yields (chunk_start_frame, chunk_end_frame, traces) for the consecutive chunks, in order.
+        # This is for full passes: the chunks are filtered in num_threads parallel threads (the FFTs
+        # release the GIL), at most 2 * num_threads chunks are in memory at a time, and the chunks
+        # are not added to the chunk cache.
+        from concurrent.futures import ThreadPoolExecutor
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.get_num_frames()
+        if channel_ids is None:
+            channel_ids = self.get_channel_ids()
+        if end_frame <= start_frame:
+            return
+        all_channel_ids = self.get_channel_ids()
+        chan_idx = [all_channel_ids.index(chan) for chan in channel_ids]
+        ich1 = int(start_frame / self._chunk_size)
+        ich2 = int((end_frame - 1) / self._chunk_size)
+
+        def filter_chunk(ich):
+            start0 = ich * self._chunk_size
+            with self._chunk_cache_lock:
+                chunk1 = self._chunk_cache.get(ich, None)
+            if chunk1 is None:
+                chunk1 = self.filterChunk(start_frame=start0, end_frame=start0 + self._chunk_size)
+            a = max(start_frame, start0)
+            b = min(end_frame, start0 + self._chunk_size)
+            return a, b, chunk1[chan_idx, a - start0:b - start0]
+
+        if num_threads <= 1:
+            for ich in range(ich1, ich2 + 1):
+                yield filter_chunk(ich)
+            return
+        max_in_flight = 2 * num_threads
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            pending = deque()
+            ich_next = ich1
+            while (ich_next <= ich2) or pending:
+                while (ich_next <= ich2) and (len(pending) < max_in_flight):
+                    pending.append(executor.submit(filter_chunk, ich_next))
+                    ich_next = ich_next + 1
+                yield pending.popleft().result()
+
+    def getTracesParallel(self, *, out=None, start_frame=None, end_frame=None, channel_ids=None, num_threads=1):
+        # Same as get_traces, but the chunks are filtered in parallel threads (see iterChunks) and
+        # written into out (a preallocated array or memmap of shape channels x frames) if given
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.get_num_frames()
+        if channel_ids is None:
+            channel_ids = self.get_channel_ids()
+        shape = (len(channel_ids), end_frame - start_frame)
+        if (out is not None) and (tuple(out.shape) != shape):
+            raise Exception('Unexpected shape for out: {} <> {}'.format(out.shape, shape))
+        for a, b, traces in self.iterChunks(start_frame=start_frame, end_frame=end_frame, channel_ids=channel_ids, num_threads=num_threads):
+            if out is None:
+                out = np.zeros(shape, dtype=traces.dtype)
+            out[:, a - start_frame:b - start_frame] = traces
+        if out is None:
+            out = np.zeros(shape)
+        return out
+
+    def chunkCacheStats(self):
+        with self._chunk_cache_lock:
+            return dict(
+                hits=self._chunk_cache_hits,
+                misses=self._chunk_cache_misses,
+                num_chunks=len(self._chunk_cache),
+                num_bytes=self._chunk_cache_num_bytes
+            )
+
     @abstractmethod
     def filterChunk(self, *, start_frame, end_frame):
         raise NotImplementedError('filterChunk not implemented')
 
     def _get_filtered_chunk(self, ind):
+        with self._chunk_cache_lock:
+            chunk1 = self._chunk_cache.get(ind, None)
+            if chunk1 is not None:
+                self._chunk_cache.move_to_end(ind)
+                self._chunk_cache_hits = self._chunk_cache_hits + 1
+                return chunk1
+            self._chunk_cache_misses = self._chunk_cache_misses + 1
         start0 = ind * self._chunk_size
         end0 = (ind + 1) * self._chunk_size
         chunk1 = self.filterChunk(start_frame=start0, end_frame=end0)
+        if chunk1.nbytes <= self._chunk_cache_bytes:
+            # (not a view of the padded chunk, so that the size in the cache is the actual size)
+            chunk1 = np.ascontiguousarray(chunk1)
+            # the cached chunks are shared by all callers, so they must not be modified
+            chunk1.flags.writeable = False
+            with self._chunk_cache_lock:
+                if ind not in self._chunk_cache:
+                    self._chunk_cache[ind] = chunk1
+                    self._chunk_cache_num_bytes = self._chunk_cache_num_bytes + chunk1.nbytes
+                while self._chunk_cache_num_bytes > self._chunk_cache_bytes:
+                    _, chunk0 = self._chunk_cache.popitem(last=False)
+                    self._chunk_cache_num_bytes = self._chunk_cache_num_bytes - chunk0.nbytes
         return chunk1
@@ -1,2 +1,2 @@
-from .mdaextractors import MdaRecordingExtractor, MdaSortingExtractor
-from .mdaio import DiskReadMda, readmda, writemda32, writemda64, writemda, appendmda
\ No newline at end of file
+from .mdaextractors import MdaRecordingExtractor, MdaSortingExtractor, write_timeseries_blocks
+from .mdaio import DiskReadMda, DiskWriteMda, readmda, writemda32, writemda64, writemda, appendmda
\ No newline at end of file
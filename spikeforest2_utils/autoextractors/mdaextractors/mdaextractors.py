@@ -4,12 +4,14 @@ from spikeextractors import SortingExtractor
 import kachery as ka
 import json
 import numpy as np
-from .mdaio import DiskReadMda, readmda, readmda_header, writemda32, writemda64, writemda, appendmda
+from .mdaio import DiskReadMda, DiskWriteMda, readmda, readmda_header, writemda32, writemda64, writemda, appendmda
 import os
+from ..filehashindex import get_file_hash
 
 
 class MdaRecordingExtractor(RecordingExtractor):
-    def __init__(self, *, recording_directory=None, timeseries_path=None, download=False, samplerate=None, geom=None, geom_path=None, params_path=None):
+    def __init__(self, *, recording_directory=None, timeseries_path=None, download=False, samplerate=None, geom=None, geom_path=None, params_path=None, lazy_hash=False):
+        # With lazy_hash=True, the hash of the timeseries file is not computed until hash() is called
         RecordingExtractor.__init__(self)
         if recording_directory:
             if timeseries_path is None:
@@ -58,11 +60,9 @@ class MdaRecordingExtractor(RecordingExtractor):
             print('WARNING: Incompatible dimensions between geom.csv and timeseries file {} <> {}'.format(self._geom.shape[0], X.N1()))
             self._geom = np.zeros((X.N1(), 2))
         
-        self._hash = ka.get_object_hash(dict(
-            timeseries=ka.get_file_hash(self._timeseries_path),
-            samplerate=self._samplerate,
-            geom=_json_serialize(self._geom)
-        ))
+        self._hash = None
+        if not lazy_hash:
+            self.hash()
 
         self._num_channels = X.N1()
         self._num_timepoints = X.N2()
@@ -86,39 +86,31 @@ class MdaRecordingExtractor(RecordingExtractor):
         if channel_ids is None:
             channel_ids = self.get_channel_ids()
         X = self._timeseries
-        recordings = X.readChunk(i1=0, i2=start_frame, N1=X.N1(), N2=end_frame - start_frame)
-        recordings = recordings[channel_ids, :]
-        return recordings
+        if list(channel_ids) == self.get_channel_ids():
+            # all channels, copied out of the read-only view of the memory-mapped file (for a local
+            # file), so that the caller owns the traces and may modify them in place
+            return np.array(X.readChunk(i1=0, i2=start_frame, N1=X.N1(), N2=end_frame - start_frame), order='C')
+        return X.readChunkChannels(channel_ids, i2=start_frame, N2=end_frame - start_frame)
+
+    def get_traces_windows(self, start_frames, window_size):
+        # All channels in several windows of frames (channels x windows x frames), in one batched read
+        return self._timeseries.readWindows(start_frames, window_size)
     
     def hash(self):
+        if self._hash is None:
+            self._hash = ka.get_object_hash(dict(
+                timeseries=get_file_hash(self._timeseries_path),
+                samplerate=self._samplerate,
+                geom=_json_serialize(self._geom)
+            ))
         return self._hash
 
     @staticmethod
     def write_recording(recording, save_path, params=dict(), raw_fname='raw.mda', params_fname='params.json', 
-            _preserve_dtype=False, in_blocks=False):
-        if in_blocks:
-            return write_recording_blocks(recording, save_path, params, raw_fname, params_fname, _preserve_dtype)
-
-        channel_ids = recording.get_channel_ids()
-        M = len(channel_ids)
-        # N = recording.get_num_frames()
-        raw = recording.get_traces()
-        location0 = recording.get_channel_property(channel_ids[0], 'location')
-        nd = len(location0)
-        geom = np.zeros((M, nd))
-        for ii in range(len(channel_ids)):
-            location_ii = recording.get_channel_property(channel_ids[ii], 'location')
-            geom[ii, :] = list(location_ii)
-        if not os.path.isdir(save_path):
-            os.mkdir(save_path)
-        if _preserve_dtype:
-            writemda(raw, save_path + '/' + raw_fname, dtype=raw.dtype)
-        else:
-            writemda32(raw, save_path + '/' + raw_fname)
-        params["samplerate"] = recording.get_sampling_frequency()
-        with open(save_path + '/' + params_fname, 'w') as f:
-            json.dump(params, f)
-        np.savetxt(save_path + '/geom.csv', geom, delimiter=',')
+            _preserve_dtype=False, in_blocks=True):
+        # The traces are always written one block of frames at a time (see write_timeseries_blocks),
+        # so the recording is never loaded into memory as a whole. in_blocks is kept for compatibility.
+        return write_recording_blocks(recording, save_path, params, raw_fname, params_fname, _preserve_dtype)
 
 
 class MdaSortingExtractor(SortingExtractor):
@@ -130,20 +122,33 @@ class MdaSortingExtractor(SortingExtractor):
 
         self._firings = readmda(self._firings_path)
         self._sampling_frequency = samplerate
-        self._times = self._firings[1, :]
-        self._labels = self._firings[2, :]
-        self._unit_ids = np.unique(self._labels).astype(int)
+        times = self._firings[1, :]
+        labels = self._firings[2, :]
+        # Sort the events by label and then by time, so that the events of unit
+        # self._labels[k] are self._times[self._offsets[k]:self._offsets[k + 1]]
+        order = np.lexsort((times, labels))
+        self._times = times[order]
+        sorted_labels = labels[order]
+        self._labels = np.unique(sorted_labels)
+        self._offsets = np.searchsorted(sorted_labels, self._labels, side='left')
+        self._offsets = np.append(self._offsets, len(sorted_labels))
+        self._unit_ids = self._labels.astype(int)
 
     def get_unit_ids(self):
         return self._unit_ids
 
     def get_unit_spike_train(self, unit_id, start_frame=None, end_frame=None):
-        if start_frame is None:
-            start_frame = 0
-        if end_frame is None:
-            end_frame = np.Inf
-        inds = np.where((self._labels == unit_id) & (start_frame <= self._times) & (self._times < end_frame))
-        return np.rint(self._times[inds]).astype(int)
+        k = np.searchsorted(self._labels, unit_id)
+        if (k >= len(self._labels)) or (self._labels[k] != unit_id):
+            return np.zeros((0,), dtype=int)
+        times = self._times[self._offsets[k]:self._offsets[k + 1]]
+        i1 = 0
+        i2 = len(times)
+        if start_frame is not None:
+            i1 = np.searchsorted(times, start_frame, side='left')
+        if end_frame is not None:
+            i2 = np.searchsorted(times, end_frame, side='left')
+        return np.rint(times[i1:i2]).astype(int)
 
     def get_sampling_frequency(self):
         return self._sampling_frequency
@@ -207,34 +212,50 @@ def is_url(path):
         'kbucket://') or path.startswith('sha1://') or path.startswith('sha1dir://')
 
 
+def write_timeseries_blocks(recording, timeseries_path, *, dtype='float32', block_size=None, num_threads=1):
+    # Write the traces of any recording extractor to an mda file, one block of frames at a time,
+    # so that the memory use is bounded (by about num_threads blocks). By default the blocks are
+    # about 100 MB. With num_threads > 1 the blocks are read (e.g., filtered) and written in parallel
+    # threads, so the get_traces() of the recording must be thread safe. A FilterRecording is instead
+    # written with its iterChunks (filtered chunks, in parallel threads), and block_size is not used.
+    from concurrent.futures import ThreadPoolExecutor
+    M = len(recording.get_channel_ids())
+    N = recording.get_num_frames()
+    if block_size is None:
+        block_size = max(1, int(100 * 1024 * 1024 / (max(M, 1) * np.dtype(dtype).itemsize)))
+    with DiskWriteMda(timeseries_path, (M, N), dt=dtype) as X:
+        if hasattr(recording, 'iterChunks'):
+            # A filtered recording is written as it is filtered, chunk by chunk
+            for i_start, _, block in recording.iterChunks(num_threads=num_threads):
+                X.writeChunk(block.astype(dtype, copy=False), i1=0, i2=i_start)
+            return True
+        def write_block(i_start):
+            i_end = min(i_start + block_size, N)
+            block = recording.get_traces(start_frame=i_start, end_frame=i_end)
+            X.writeChunk(block, i1=0, i2=i_start)
+        if num_threads > 1:
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                # list() so that exceptions are raised here
+                list(executor.map(write_block, range(0, N, block_size)))
+        else:
+            for i_start in range(0, N, block_size):
+                write_block(i_start)
+    return True
+
+
 def write_recording_blocks(recording, save_path, params=dict(), raw_fname='raw.mda', params_fname='params.json',
         _preserve_dtype=False):
-    import math
     if not os.path.isdir(save_path):
         os.mkdir(save_path)
 
     channel_ids = recording.get_channel_ids()
     M = len(channel_ids)
-    N = recording.get_num_frames()
-
-    block_size = 20000 * 60 * 10
-    n_blocks = math.ceil((N*1.0) / block_size)
 
-    # open file
-    total_size = 0
-    for i in range(n_blocks):
-        i_start = (i*block_size)
-        if i == (n_blocks - 1):
-            i_end = N
-        else:
-            i_end = i_start+block_size
-        block = recording.get_traces(start_frame=i_start, end_frame=i_end)
-        if i == 0:
-            writemda32(block, save_path + '/' + raw_fname)
-        else:
-            appendmda(block, save_path + '/' + raw_fname)
-        # write block
-        total_size = total_size + np.shape(block)[1]
+    if _preserve_dtype:
+        dtype = recording.get_traces(start_frame=0, end_frame=min(1, recording.get_num_frames())).dtype.name
+    else:
+        dtype = 'float32'
+    write_timeseries_blocks(recording, save_path + '/' + raw_fname, dtype=dtype)
 
     location0 = recording.get_channel_property(channel_ids[0], 'location')
     nd = len(location0)
@@ -66,6 +66,9 @@ class DiskReadMda:
             self._header.header_size = 0
         else:
             self._header = _read_header(self._path)
+        # memory-mapped data of a local file (see _local_data)
+        self._local_data = None
+        self._local_data_checked = False
 
     def dims(self):
         if self._npy_mode:
@@ -125,7 +128,46 @@ class DiskReadMda:
             X = self._read_chunk_1d(i1 + N1 * i2 + N1 * N2 * i3, N1 * N2 * N3)
             return np.reshape(X, (N1, N2, N3), order='F')
 
+    def readChunkChannels(self, channels, i2, N2):
+        # Rows `channels` of columns i2 to i2 + N2 of a 2d array (e.g., a subset of the channels
+        # of a timeseries) without loading the other rows into memory
+        N1 = self.N1()
+        channels = np.array(channels, dtype=int).ravel()
+        if len(channels) == 0:
+            return np.zeros((0, N2), dtype=self.dt())
+        X = self._get_local_data()
+        if X is not None:
+            A = np.reshape(X[N1 * i2:N1 * (i2 + N2)], (N1, N2), order='F')
+            return A[channels, :]
+        if N2 == 0:
+            return np.zeros((len(channels), 0), dtype=self.dt())
+        # Only read from the first to the last of the selected rows (the layout is column-major),
+        # then take the rows from a strided view of that range
+        c1 = int(np.min(channels))
+        c2 = int(np.max(channels)) + 1
+        Y = self._read_chunk_1d(c1 + N1 * i2, N1 * (N2 - 1) + (c2 - c1))
+        A = np.lib.stride_tricks.as_strided(Y, shape=(c2 - c1, N2), strides=(Y.itemsize, Y.itemsize * N1), writeable=False)
+        return A[channels - c1, :]
+
+    def readWindows(self, i2_list, N2):
+        # Columns i2 to i2 + N2 of a 2d array for each i2 in i2_list, as an array (N1 x len(i2_list) x N2).
+        # For a local file this is a single gather from the memory-mapped file.
+        N1 = self.N1()
+        i2_list = np.array(i2_list, dtype=int).ravel()
+        X = self._get_local_data()
+        if (X is not None) and (len(i2_list) > 0):
+            A = np.reshape(X[:N1 * self.N2()], (N1, self.N2()), order='F')
+            return A[:, i2_list[:, None] + np.arange(N2)[None, :]]
+        ret = np.zeros((N1, len(i2_list), N2), dtype=self.dt())
+        for k, i2 in enumerate(i2_list):
+            ret[:, k, :] = self.readChunk(i1=0, i2=int(i2), N1=N1, N2=N2)
+        return ret
+
     def _read_chunk_1d(self, i, N):
+        X = self._get_local_data()
+        if X is not None:
+            # read-only view of the mapped file (no copy)
+            return X[i:i + N]
         start_byte = self._header.header_size + self._header.num_bytes_per_entry * i
         end_byte = start_byte + self._header.num_bytes_per_entry * N
         try:
@@ -139,6 +181,19 @@ class DiskReadMda:
             raise
         return np.frombuffer(bytes0, dtype=self._header.dt, count=N)
 
+    def _get_local_data(self):
+        # For a file on the local file system, the entries of the file as a 1d array
+        # that is memory-mapped once (None for kachery URLs, which are read with ka.load_bytes)
+        if not self._local_data_checked:
+            self._local_data_checked = True
+            if (not is_url(self._path)) and os.path.isfile(self._path):
+                H = self._header
+                num_entries = int(np.prod(H.dims))
+                if num_entries > 0 and os.path.getsize(self._path) >= H.header_size + H.num_bytes_per_entry * num_entries:
+                    X = np.memmap(self._path, dtype=H.dt, mode='r', offset=H.header_size, shape=(num_entries,))
+                    self._local_data = X.view(np.ndarray)
+        return self._local_data
+
     # def _read_chunk_1d_helper(self, path0, N, *, offset):
     #     f = open(path0, "rb")
     #     try:
@@ -152,16 +207,85 @@ class DiskReadMda:
     #         return None
 
 
+class DiskWriteMda:
+    def __init__(self, path, dims, dt='float32'):
+        # An mda file of known final dimensions that is written chunk by chunk. The header is
+        # written and the file is allocated up front, so the chunks may be written in any order,
+        # and from several threads (each chunk is written with a positional write).
+        self._path = path
+        self._header = MdaHeader(dt0=dt, dims0=[int(d) for d in dims])
+        if self._header.dt_code is None:
+            raise Exception('Unexpected data type: {}'.format(dt))
+        with open(path, 'wb') as f:
+            self._header.write(f)
+            f.truncate(self._header.header_size + self._header.num_bytes_per_entry * int(self._header.dimprod))
+        self._fd = os.open(path, os.O_WRONLY)
+
+    def dims(self):
+        return self._header.dims
+
+    def N1(self):
+        return self.dims()[0]
+
+    def N2(self):
+        return self.dims()[1]
+
+    def N3(self):
+        return self.dims()[2]
+
+    def dt(self):
+        return self._header.dt
+
+    def writeChunk(self, X, i1=-1, i2=-1, i3=-1):
+        # Same indexing as DiskReadMda.readChunk (the chunk must span the leading dimensions)
+        if (i2 < 0):
+            self._write_chunk_1d(X.ravel(order='F'), i1)
+        elif (i3 < 0):
+            if X.shape[0] != self.N1():
+                raise Exception("Unable to support N1 {} != {}".format(X.shape[0], self.N1()))
+            self._write_chunk_1d(X.ravel(order='F'), i1 + self.N1() * i2)
+        else:
+            if (X.shape[0] != self.N1()) or (X.shape[1] != self.N2()):
+                raise Exception("Unable to support N1, N2 {}, {} != {}, {}".format(X.shape[0], X.shape[1], self.N1(), self.N2()))
+            self._write_chunk_1d(X.ravel(order='F'), i1 + self.N1() * i2 + self.N1() * self.N2() * i3)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _write_chunk_1d(self, X, i):
+        if i + X.size > self._header.dimprod:
+            raise Exception('Chunk out of range: {} + {} > {}'.format(i, X.size, self._header.dimprod))
+        bytes0 = memoryview(np.ascontiguousarray(X, dtype=self._header.dt)).cast('B')
+        offset = self._header.header_size + self._header.num_bytes_per_entry * i
+        while len(bytes0) > 0:
+            num_written = os.pwrite(self._fd, bytes0, offset)
+            bytes0 = bytes0[num_written:]
+            offset = offset + num_written
+
+
 def is_url(path):
     path = path or ''
     return path.startswith('http://') or path.startswith('https://') or path.startswith(
         'kbucket://') or path.startswith('sha1://') or path.startswith('sha1dir://')
 
 def _read_header(path, verbose=True):
-    info0 = ka.get_file_info(path)
-    if info0 is None:
-        raise Exception(f'Unable to find file: {path}')
-    bytes0 = ka.load_bytes(path, start=0, end=min(200, info0['size']))
+    if (not is_url(path)) and os.path.isfile(path):
+        # avoid ka.get_file_info(), which would compute the hash of a local file
+        size0 = os.path.getsize(path)
+    else:
+        info0 = ka.get_file_info(path)
+        if info0 is None:
+            raise Exception(f'Unable to find file: {path}')
+        size0 = info0['size']
+    bytes0 = ka.load_bytes(path, start=0, end=min(200, size0))
     if bytes0 is None:
         ka.set_config(fr='default_readonly')
         print(ka.get_file_info(path))
@@ -546,11 +670,11 @@ def mdaio_test():
     Z = DiskReadMda('tmp1.mda')
     print(Z.readChunk(i1=0, i2=4, N1=M, N2=N - 4))
 
-    # A = DiskWriteMda('tmpA.mda', (M, N))
-    # A.writeChunk(Y, i1=0, i2=0)
-    # B = readmda('tmpA.mda')
-    # print(B.shape)
-    # print(B)
+    with DiskWriteMda('tmpA.mda', (M, N)) as A:
+        A.writeChunk(Y, i1=0, i2=0)
+    B = readmda('tmpA.mda')
+    print(B.shape)
+    print(B)
 
 
 # mdaio_test()
@@ -0,0 +1,2 @@
+from .tiledextractors import TiledRecordingExtractor, write_tiled_timeseries, convert_mda_recording_to_tiled
+from .tiledio import DiskReadTiles, DiskWriteTiles
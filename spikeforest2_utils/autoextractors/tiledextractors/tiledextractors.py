@@ -0,0 +1,145 @@
+from spikeextractors import RecordingExtractor
+
+import kachery as ka
+import json
+import numpy as np
+import os
+from .tiledio import DiskReadTiles, DiskWriteTiles
+from ..filehashindex import get_file_hash
+
+
+class TiledRecordingExtractor(RecordingExtractor):
+    def __init__(self, *, recording_directory=None, timeseries_path=None, download=False, samplerate=None, geom=None, geom_path=None, params_path=None, lazy_hash=False):
+        # Same arguments as MdaRecordingExtractor, with a tiled timeseries file (raw.tiles) in place of raw.mda
+        RecordingExtractor.__init__(self)
+        if recording_directory:
+            if timeseries_path is None:
+                timeseries_path = recording_directory + '/raw.tiles'
+            geom_path = recording_directory + '/geom.csv'
+            params_path = recording_directory + '/params.json'
+        self._timeseries_path = timeseries_path
+        if params_path:
+            self._dataset_params = ka.load_object(params_path)
+            if not self._dataset_params:
+                raise Exception('Unable to load recording params: {}'.format(params_path))
+            self._samplerate = self._dataset_params['samplerate']
+        else:
+            self._dataset_params = dict(
+                samplerate=samplerate
+            )
+            self._samplerate = samplerate
+
+        if download:
+            path0 = ka.load_file(path=self._timeseries_path)
+            if not path0:
+                raise Exception('Unable to download file: ' + self._timeseries_path)
+            self._timeseries_path = path0
+
+        self._timeseries = DiskReadTiles(self._timeseries_path)
+        X = self._timeseries
+        if geom is not None:
+            self._geom = geom
+        elif geom_path:
+            geom_path2 = ka.load_file(geom_path)
+            self._geom = np.genfromtxt(geom_path2, delimiter=',')
+        else:
+            self._geom = np.zeros((X.N1(), 2))
+        if len(self._geom.shape) == 1:
+            self._geom = np.reshape(self._geom, (X.N1(), -1))
+
+        if self._geom.shape[0] != X.N1():
+            print('WARNING: Incompatible dimensions between geom.csv and timeseries file {} <> {}'.format(self._geom.shape[0], X.N1()))
+            self._geom = np.zeros((X.N1(), 2))
+
+        self._hash = None
+        if not lazy_hash:
+            self.hash()
+
+        self._num_channels = X.N1()
+        self._num_timepoints = X.N2()
+        for m in range(self._num_channels):
+            self.set_channel_property(m, 'location', self._geom[m, :])
+
+    def get_channel_ids(self):
+        return list(range(self._num_channels))
+
+    def get_num_frames(self):
+        return self._num_timepoints
+
+    def get_sampling_frequency(self):
+        return self._samplerate
+
+    def get_traces(self, channel_ids=None, start_frame=None, end_frame=None):
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.get_num_frames()
+        if channel_ids is None:
+            channel_ids = self.get_channel_ids()
+        return self._timeseries.readChunkChannels(channel_ids, i2=start_frame, N2=end_frame - start_frame)
+
+    def hash(self):
+        if self._hash is None:
+            self._hash = ka.get_object_hash(dict(
+                timeseries=get_file_hash(self._timeseries_path),
+                samplerate=self._samplerate,
+                geom=self._geom.tolist()
+            ))
+        return self._hash
+
+    @staticmethod
+    def write_recording(recording, save_path, params=dict(), raw_fname='raw.tiles', params_fname='params.json',
+            dtype=None, tile_channels=16, tile_frames=10000, compression='zlib', delta=True, num_threads=1):
+        # Writes a recording directory (raw.tiles, params.json and geom.csv), one row of tiles at a time.
+        # By default the data type of the recording is kept (int16 recordings are delta encoded).
+        channel_ids = recording.get_channel_ids()
+        M = len(channel_ids)
+        if not os.path.isdir(save_path):
+            os.mkdir(save_path)
+        write_tiled_timeseries(
+            recording, save_path + '/' + raw_fname, dtype=dtype, tile_channels=tile_channels, tile_frames=tile_frames,
+            compression=compression, delta=delta, num_threads=num_threads
+        )
+        location0 = recording.get_channel_property(channel_ids[0], 'location')
+        nd = len(location0)
+        geom = np.zeros((M, nd))
+        for ii in range(len(channel_ids)):
+            location_ii = recording.get_channel_property(channel_ids[ii], 'location')
+            geom[ii, :] = list(location_ii)
+        params = dict(params)
+        params["samplerate"] = recording.get_sampling_frequency()
+        with open(save_path + '/' + params_fname, 'w') as f:
+            json.dump(params, f)
+        np.savetxt(save_path + '/geom.csv', geom, delimiter=',')
+
+
+def write_tiled_timeseries(recording, timeseries_path, *, dtype=None, tile_channels=16, tile_frames=10000, compression='zlib', delta=True, num_threads=1):
+    # Write the traces of any recording extractor to a tiled timeseries file, one row of tiles at a time
+    from concurrent.futures import ThreadPoolExecutor
+    M = len(recording.get_channel_ids())
+    N = recording.get_num_frames()
+    if dtype is None:
+        dtype = recording.get_traces(start_frame=0, end_frame=min(1, N)).dtype.name
+    with DiskWriteTiles(timeseries_path, num_channels=M, num_frames=N, dt=dtype, tile_channels=tile_channels,
+            tile_frames=tile_frames, compression=compression, delta=delta) as X:
+        H = X.header()
+        def write_row(r):
+            block = recording.get_traces(start_frame=r * H.tile_frames, end_frame=min((r + 1) * H.tile_frames, N))
+            X.writeTileRow(block, r)
+        if num_threads > 1:
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                # list() so that exceptions are raised here
+                list(executor.map(write_row, range(H.num_tile_rows)))
+        else:
+            for r in range(H.num_tile_rows):
+                write_row(r)
+    return True
+
+
+def convert_mda_recording_to_tiled(recording_directory, save_path, **kwargs):
+    # Convert a recording directory with raw.mda (local or kachery) to a directory with raw.tiles,
+    # keeping the data type of raw.mda. The keyword arguments are passed to TiledRecordingExtractor.write_recording.
+    from ..mdaextractors import MdaRecordingExtractor
+    recording = MdaRecordingExtractor(recording_directory=recording_directory, lazy_hash=True)
+    params = ka.load_object(recording_directory + '/params.json')
+    TiledRecordingExtractor.write_recording(recording, save_path, params=params, **kwargs)
@@ -0,0 +1,264 @@
+import numpy as np
+import os
+import json
+import struct
+import threading
+import zlib
+import kachery as ka
+
+# A tiled timeseries file (.tiles) stores a 2d array (channels x frames) in tiles of
+# tile_channels x tile_frames, each of which may be compressed, so that a read only
+# needs to load and decompress the tiles that overlap the requested frames and channels.
+#
+# Layout:
+#   magic (8 bytes) | header size (uint32) | header (json) | index | tiles
+#
+# The index has (offset, size) (uint64) for each tile, with the tiles ordered by the
+# frames and then by the channels. A tile holds the entries of its channels one channel
+# after the other. Before compression, the integer types may be delta encoded along
+# the frames (lossless, with wrap-around), and the bytes are shuffled so that the bytes
+# of the same significance are together (as in blosc).
+
+_MAGIC = b'SFTILES1'
+
+
+class TiledHeader:
+    def __init__(self, *, num_channels, num_frames, dt, tile_channels, tile_frames, compression, delta):
+        if compression not in [None, 'zlib', 'blosc']:
+            raise Exception('Unexpected compression: {}'.format(compression))
+        self.num_channels = int(num_channels)
+        self.num_frames = int(num_frames)
+        self.dt = dt
+        self.tile_channels = max(1, min(int(tile_channels), max(self.num_channels, 1)))
+        self.tile_frames = max(1, int(tile_frames))
+        self.compression = compression
+        # delta encoding is only lossless for the integer types
+        self.delta = bool(delta) and (np.dtype(dt).kind in ['i', 'u'])
+        self.num_tile_rows = (self.num_frames + self.tile_frames - 1) // self.tile_frames
+        self.num_tile_cols = (self.num_channels + self.tile_channels - 1) // self.tile_channels
+        self.index_offset = 0
+        self.data_offset = 0
+
+    def to_json(self):
+        return dict(
+            num_channels=self.num_channels,
+            num_frames=self.num_frames,
+            dtype=self.dt,
+            tile_channels=self.tile_channels,
+            tile_frames=self.tile_frames,
+            compression=self.compression,
+            delta=self.delta
+        )
+
+    @staticmethod
+    def from_json(obj):
+        return TiledHeader(
+            num_channels=obj['num_channels'],
+            num_frames=obj['num_frames'],
+            dt=obj['dtype'],
+            tile_channels=obj['tile_channels'],
+            tile_frames=obj['tile_frames'],
+            compression=obj['compression'],
+            delta=obj['delta']
+        )
+
+    def num_tiles(self):
+        return self.num_tile_rows * self.num_tile_cols
+
+    def tile_shape(self, r, c):
+        # (channels, frames) of tile (r, c)
+        return (
+            min(self.tile_channels, self.num_channels - c * self.tile_channels),
+            min(self.tile_frames, self.num_frames - r * self.tile_frames)
+        )
+
+
+class DiskReadTiles:
+    def __init__(self, path):
+        self._path = path
+        self._local_path = None
+        if (not _is_url(path)) and os.path.isfile(path):
+            self._local_path = path
+        bytes0 = self._read_bytes(0, len(_MAGIC) + 4)
+        if (bytes0 is None) or (len(bytes0) < len(_MAGIC) + 4) or (bytes0[:len(_MAGIC)] != _MAGIC):
+            raise Exception('Not a tiled timeseries file: {}'.format(path))
+        header_size = struct.unpack('<I', bytes0[len(_MAGIC):])[0]
+        H = TiledHeader.from_json(json.loads(self._read_bytes(len(_MAGIC) + 4, len(_MAGIC) + 4 + header_size).decode('utf-8')))
+        H.index_offset = len(_MAGIC) + 4 + header_size
+        H.data_offset = H.index_offset + H.num_tiles() * 16
+        self._header = H
+        self._index = np.frombuffer(self._read_bytes(H.index_offset, H.data_offset), dtype='<u8').reshape((H.num_tiles(), 2))
+
+    def header(self):
+        return self._header
+
+    def N1(self):
+        return self._header.num_channels
+
+    def N2(self):
+        return self._header.num_frames
+
+    def dt(self):
+        return self._header.dt
+
+    def readChunkChannels(self, channels, i2, N2):
+        # Rows `channels` of columns i2 to i2 + N2, only loading the tiles that overlap
+        H = self._header
+        channels = np.array(channels, dtype=int).ravel()
+        ret = np.zeros((len(channels), N2), dtype=H.dt)
+        if (len(channels) == 0) or (N2 == 0):
+            return ret
+        r1 = i2 // H.tile_frames
+        r2 = (i2 + N2 - 1) // H.tile_frames + 1
+        cols = np.unique(channels // H.tile_channels)
+        for r in range(r1, r2):
+            # the tiles of one row are adjacent in the file (when written in order), so read them together
+            tile_inds = [r * H.num_tile_cols + c for c in cols]
+            tiles = self._read_tiles(tile_inds)
+            f1 = r * H.tile_frames
+            a = max(i2, f1)
+            b = min(i2 + N2, f1 + H.tile_frames)
+            for c, tile in zip(cols, tiles):
+                ii = np.nonzero(channels // H.tile_channels == c)[0]
+                ret[ii, a - i2:b - i2] = tile[channels[ii] - c * H.tile_channels, a - f1:b - f1]
+        return ret
+
+    def _read_tiles(self, tile_inds):
+        H = self._header
+        ret = []
+        # group the tiles into contiguous ranges of bytes
+        i = 0
+        while i < len(tile_inds):
+            j = i + 1
+            while (j < len(tile_inds)) and (self._index[tile_inds[j], 0] == self._index[tile_inds[j - 1], 0] + self._index[tile_inds[j - 1], 1]):
+                j = j + 1
+            start = int(self._index[tile_inds[i], 0])
+            end = int(self._index[tile_inds[j - 1], 0] + self._index[tile_inds[j - 1], 1])
+            bytes0 = self._read_bytes(start, end)
+            for k in range(i, j):
+                offset, size = int(self._index[tile_inds[k], 0]), int(self._index[tile_inds[k], 1])
+                r, c = divmod(tile_inds[k], H.num_tile_cols)
+                if size == 0:
+                    # a written tile is never empty, this entry of the index was left at (0, 0)
+                    raise Exception('Tile not written (tile row {}, tile column {}) in tiled timeseries file: {}'.format(r, c, self._path))
+                ret.append(_decode_tile(bytes0[offset - start:offset - start + size], H, H.tile_shape(r, c)))
+            i = j
+        return ret
+
+    def _read_bytes(self, start, end):
+        if self._local_path is not None:
+            with open(self._local_path, 'rb') as f:
+                f.seek(start)
+                return f.read(end - start)
+        return ka.load_bytes(self._path, start=int(start), end=int(end))
+
+
+class DiskWriteTiles:
+    def __init__(self, path, *, num_channels, num_frames, dt='int16', tile_channels=16, tile_frames=10000, compression='zlib', delta=True):
+        # The rows of tiles (see writeTileRow) may be written in any order, and from several threads
+        self._path = path
+        H = TiledHeader(
+            num_channels=num_channels, num_frames=num_frames, dt=dt, tile_channels=tile_channels,
+            tile_frames=tile_frames, compression=compression, delta=delta
+        )
+        header_bytes = json.dumps(H.to_json()).encode('utf-8')
+        H.index_offset = len(_MAGIC) + 4 + len(header_bytes)
+        H.data_offset = H.index_offset + H.num_tiles() * 16
+        self._header = H
+        self._index = np.zeros((H.num_tiles(), 2), dtype='<u8')
+        self._end = H.data_offset
+        self._lock = threading.Lock()
+        with open(path, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(struct.pack('<I', len(header_bytes)))
+            f.write(header_bytes)
+            f.write(self._index.tobytes())
+        self._fd = os.open(path, os.O_WRONLY)
+
+    def header(self):
+        return self._header
+
+    def writeTileRow(self, X, r):
+        # X is all of the channels for the frames of tile row r
+        H = self._header
+        f1 = r * H.tile_frames
+        expected_shape = (H.num_channels, min(H.tile_frames, H.num_frames - f1))
+        if tuple(X.shape) != expected_shape:
+            raise Exception('Unexpected shape for tile row {}: {} <> {}'.format(r, X.shape, expected_shape))
+        for c in range(H.num_tile_cols):
+            bytes0 = _encode_tile(X[c * H.tile_channels:(c + 1) * H.tile_channels, :], H)
+            with self._lock:
+                offset = self._end
+                self._end = self._end + len(bytes0)
+            _pwrite_all(self._fd, bytes0, offset)
+            self._index[r * H.num_tile_cols + c, :] = (offset, len(bytes0))
+
+    def close(self):
+        # Raises if some of the rows of tiles were not written, rather than leaving a file
+        # that fails when those frames are read
+        self._close(check=True)
+
+    def _close(self, *, check):
+        if self._fd is None:
+            return
+        _pwrite_all(self._fd, self._index.tobytes(), self._header.index_offset)
+        os.close(self._fd)
+        self._fd = None
+        if check:
+            H = self._header
+            missing_rows = [r for r in range(H.num_tile_rows) if np.any(self._index[r * H.num_tile_cols:(r + 1) * H.num_tile_cols, 1] == 0)]
+            if len(missing_rows) > 0:
+                raise Exception('Tile rows not written ({} of {}, first: {}) in tiled timeseries file: {}'.format(len(missing_rows), H.num_tile_rows, missing_rows[0], self._path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # do not hide the exception that interrupted the writing
+        self._close(check=(exc_type is None))
+
+
+def _encode_tile(X, H):
+    X = np.ascontiguousarray(X, dtype=H.dt)
+    if H.delta:
+        D = X.copy()
+        # integer overflow wraps, and the cumsum in _decode_tile wraps back
+        D[:, 1:] = X[:, 1:] - X[:, :-1]
+        X = D
+    if H.compression is None:
+        return X.tobytes()
+    if H.compression == 'blosc':
+        import blosc
+        return blosc.compress(X.tobytes(), typesize=X.itemsize, shuffle=blosc.SHUFFLE, cname='zstd')
+    shuffled = X.view(np.uint8).reshape((-1, X.itemsize)).T.tobytes()
+    return zlib.compress(shuffled, 1)
+
+
+def _decode_tile(bytes0, H, shape):
+    itemsize = np.dtype(H.dt).itemsize
+    if H.compression is None:
+        X = np.frombuffer(bytes0, dtype=H.dt)
+    elif H.compression == 'blosc':
+        import blosc
+        X = np.frombuffer(blosc.decompress(bytes0), dtype=H.dt)
+    else:
+        shuffled = np.frombuffer(zlib.decompress(bytes0), dtype=np.uint8)
+        X = shuffled.reshape((itemsize, -1)).T.copy().view(H.dt).ravel()
+    X = X.reshape(shape)
+    if H.delta:
+        X = np.cumsum(X, axis=1, dtype=H.dt)
+    return X
+
+
+def _pwrite_all(fd, bytes0, offset):
+    bytes0 = memoryview(bytes0)
+    while len(bytes0) > 0:
+        num_written = os.pwrite(fd, bytes0, offset)
+        bytes0 = bytes0[num_written:]
+        offset = offset + num_written
+
+
+def _is_url(path):
+    path = path or ''
+    return path.startswith('http://') or path.startswith('https://') or path.startswith(
+        'kbucket://') or path.startswith('sha1://') or path.startswith('sha1dir://')
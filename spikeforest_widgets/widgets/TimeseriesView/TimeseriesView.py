@@ -5,7 +5,7 @@ import numpy as np
 import io
 import base64
 import time
-from spikeforest2_utils import AutoRecordingExtractor, writemda32
+from spikeforest2_utils import AutoRecordingExtractor, writemda32, sampled_digest
 import logging
 logger = logging.getLogger('reactopya')
 
@@ -174,7 +174,7 @@ class _DownsampledRecordingExtractor(se.RecordingExtractor):
                 else:
                     self._recording_hash = self._recording.hash()
             else:
-                self._recording_hash = _samplehash(self._recording)
+                self._recording_hash = sampled_digest(self._recording)
         return ka.get_object_hash(dict(
             name='downsampled-recording-extractor',
             version=2,
@@ -240,23 +240,3 @@ class _DownsampledRecordingExtractor(se.RecordingExtractor):
     def write_recording(recording, save_path):
         EfficientAccessRecordingExtractor(
             recording=recording, _dest_path=save_path)
-
-def _samplehash(recording):
-    # from mountaintools import client as mt
-    obj = {
-        'channels': tuple(recording.get_channel_ids()),
-        'frames': recording.get_num_frames(),
-        'data': _samplehash_helper(recording)
-    }
-    return ka.get_object_hash(obj)
-
-
-def _samplehash_helper(recording):
-    rng = np.random.RandomState(37)
-    n_samples = min(recording.get_num_frames() // 1000, 100)
-    inds = rng.randint(low=0, high=recording.get_num_frames(), size=n_samples)
-    h = 0
-    for i in inds:
-        t = recording.get_traces(start_frame=i, end_frame=i + 100)
-        h = hash((hash(bytes(t)), hash(h)))
-    return h
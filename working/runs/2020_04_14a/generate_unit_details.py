@@ -185,17 +185,21 @@ def main():
             mt.saveObject(collection='spikeforest', key=key, object=unit_details, upload_to='spikeforest.public')
 
 
-@hither.function(name='filter_recording', version='0.1.0')
+@hither.function(name='filter_recording', version='0.1.1')
 @hither.output_file('timeseries_out') # timeseries out
+@hither.resources(num_cores=4)
 @hither.container(default='docker://magland/spikeforest2:0.1.1')
 @hither.local_module('../../../spikeforest2_utils')
 def filter_recording(recording_directory, timeseries_out):
     from spikeforest2_utils import AutoRecordingExtractor
-    from spikeforest2_utils import writemda32
-    import spiketoolkit as st
+    from spikeforest2_utils import write_timeseries_blocks
+    from spikeforest2_utils import bandpass_filter
     rx = AutoRecordingExtractor(recording_directory)
-    rx2 = st.preprocessing.bandpass_filter(recording=rx, freq_min=300, freq_max=6000, freq_wid=1000)
-    if not writemda32(rx2.get_traces(), timeseries_out):
+    rx2 = bandpass_filter(recording=rx, freq_min=300, freq_max=6000, freq_wid=1000)
+    # The chunks are filtered in parallel threads (one per core given to the job) and written
+    # in order as they are filtered (see FilterRecording.iterChunks)
+    num_threads = int(os.environ.get('NUM_WORKERS', '') or 4)
+    if not write_timeseries_blocks(rx2, timeseries_out, num_threads=num_threads):
         raise Exception('Unable to write output file.')
 
 
@@ -23,6 +23,9 @@ def main():
     parser.add_argument('--force-run', help='Force rerunning of all spike sorting', action='store_true')
     parser.add_argument('--force-run-all', help='Force rerunning of all spike sorting and other processing', action='store_true')
     parser.add_argument('--parallel', help='Optional number of parallel jobs', required=False, default='0')    
+    parser.add_argument('--num-cores', help='Optional number of cpu cores to pack the parallel jobs onto', required=False, default=None)
+    parser.add_argument('--ram-gb', help='Optional RAM (GB) to pack the parallel jobs onto', required=False, default=None)
+    parser.add_argument('--num-gpus', help='Optional number of GPUs to pack the parallel jobs onto', required=False, default=None)
     parser.add_argument('--slurm', help='Path to slurm config file', required=False, default=None)
     parser.add_argument('--cache', help='The cache database to use', required=False, default=None)
     parser.add_argument('--rerun-failing', help='Rerun sorting jobs that previously failed', action='store_true')
@@ -64,8 +67,15 @@ def main():
         if studyset['name'] in studyset_names:
             study_sets.append(studyset)
     
-    if int(args.parallel) > 0:
-        job_handler = hither.ParallelJobHandler(int(args.parallel))
+    if (int(args.parallel) > 0) or (args.num_cores is not None) or (args.ram_gb is not None) or (args.num_gpus is not None):
+        # One handler that packs the jobs onto the capacity, using the resources declared by
+        # the functions (@hither.resources)
+        job_handler = hither.ParallelJobHandler(
+            int(args.parallel) if int(args.parallel) > 0 else None,
+            num_cores=int(args.num_cores) if args.num_cores is not None else None,
+            ram_gb=float(args.ram_gb) if args.ram_gb is not None else None,
+            num_gpus=int(args.num_gpus) if args.num_gpus is not None else None
+        )
         job_handler_gpu = job_handler
         job_handler_ks = job_handler
     elif args.slurm:
@@ -159,14 +169,14 @@ def main():
                         raise Exception(f'No such sorting algorithm: {algorithm}')
                     Sorter = getattr(sorters, algorithm)
 
-                    if algorithm in ['ironclust', 'tridesclous']:
-                        gpu = True
-                        jh = job_handler_gpu
-                    elif algorithm in ['kilosort', 'kilosort2']:
-                        gpu = True
+                    # the gpu and high-memory sorters declare their resources (@hither.resources)
+                    sorter_resources = getattr(Sorter, '_hither_resources', dict())
+                    gpu = sorter_resources.get('num_gpus', 0) > 0
+                    if gpu and (sorter_resources.get('ram_gb', 0) >= 16):
                         jh = job_handler_ks
+                    elif gpu:
+                        jh = job_handler_gpu
                     else:
-                        gpu = False
                         jh = job_handler
                     with hither.config(gpu=gpu, force_run=force_run, exception_on_fail=False, cache_failing=cache_failing, rerun_failing=rerun_failing, job_handler=jh, job_timeout=job_timeout):
                         sorting_result = Sorter.run(
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import os
+import json
+import pickle
+import tempfile
+from copy import deepcopy
+import hither_sf as hither
+
+@hither.function('print_text', '0.1.0')
+def print_text(text):
+    print(text)
+    return text
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = dict(backend='sqlite', path=os.path.join(tmpdir, 'hither_cache.db'))
+        with hither.config(container=None, cache=cache):
+            result1 = print_text.run(text='test_cached_runtime_info')
+        with hither.config(container=None, cache=cache):
+            result2 = print_text.run(text='test_cached_runtime_info')
+    runtime_info1 = result1.runtime_info
+    runtime_info2 = result2.runtime_info
+    # result2 is the cached result, whose console output is loaded from kachery on first access
+    assert result2.retval == 'test_cached_runtime_info'
+    console_out = json.loads(json.dumps(runtime_info1['console_out']))
+    assert 'test_cached_runtime_info' in json.dumps(console_out)
+
+    # Every way of reading the runtime_info of the cached result sees the console output
+    assert json.loads(json.dumps(runtime_info2))['console_out'] == console_out
+    assert json.loads(json.dumps(runtime_info2, indent=4))['console_out'] == console_out
+    for x in [
+        dict(runtime_info2),
+        {**runtime_info2},
+        runtime_info2.copy(),
+        deepcopy(runtime_info2),
+        pickle.loads(pickle.dumps(runtime_info2)),
+        dict(runtime_info2.items()),
+        dict(zip(runtime_info2.keys(), runtime_info2.values()))
+    ]:
+        assert json.loads(json.dumps(x['console_out'])) == console_out
+    assert runtime_info2['elapsed_sec'] == runtime_info1['elapsed_sec']
+
+    print('Passed.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+import os
+import time
+import hither_sf as hither
+
+@hither.function('report_gpu_slots', '0.1.0')
+@hither.output_file('json_out')
+def report_gpu_slots(delay, json_out):
+    import json
+    timer = time.time()
+    time.sleep(delay)
+    with open(json_out, 'w') as f:
+        json.dump(dict(
+            cuda_visible_devices=os.environ.get('CUDA_VISIBLE_DEVICES', None),
+            start_time=timer,
+            end_time=time.time()
+        ), f)
+
+def main():
+    import json
+    # Two simulated GPU slots -- at most two gpu jobs run at once
+    job_handler = hither.ParallelJobHandler(num_cores=8, ram_gb=16, num_gpus=2)
+    results = []
+    with hither.config(job_handler=job_handler, gpu=True), hither.job_queue():
+        for _ in range(6):
+            results.append(report_gpu_slots.run(delay=1, json_out=hither.File()))
+    
+    objs = []
+    for result in results:
+        assert result.success
+        with open(result.outputs.json_out._path, 'r') as f:
+            objs.append(json.load(f))
+    for obj in objs:
+        print(obj)
+        assert obj['cuda_visible_devices'] in ['0', '1']
+        num_simultaneous = len([obj2 for obj2 in objs if obj2['start_time'] < obj['end_time'] and obj2['end_time'] > obj['start_time']])
+        assert num_simultaneous <= 2
+
+    print('Passed.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import os
+import time
+import hither_sf as hither
+
+@hither.function('sleep_and_write', '0.1.0')
+@hither.output_file('txt_out')
+def sleep_and_write(text, delay, txt_out):
+    time.sleep(delay)
+    with open(txt_out, 'w') as f:
+        f.write(text)
+
+def main():
+    # Without slurm, the batch workers run on the local computer
+    working_dir = os.path.join(os.getenv('HOME'), 'tmp_test_slurm_autoscale')
+    log_path = os.path.join(working_dir, 'hither.log')
+    if not os.path.exists(working_dir):
+        os.mkdir(working_dir)
+    if os.path.exists(log_path):
+        os.remove(log_path)
+    job_handler = hither.SlurmJobHandler(
+        working_dir=working_dir, use_slurm=False, num_workers_per_batch=4, max_simultaneous_batches=3,
+        autoscale=True, autoscale_target_sec=3
+    )
+    timer = time.time()
+    results = []
+    with hither.config(job_handler=job_handler, container=None, cache=None, log_path=log_path), hither.job_queue():
+        for i in range(24):
+            results.append(sleep_and_write.run(text=str(i), delay=1, txt_out=hither.File()))
+    print('{:.2f} sec'.format(time.time() - timer))
+    for i, result in enumerate(results):
+        assert result.success
+        with open(result.outputs.txt_out._path, 'r') as f:
+            assert f.read() == str(i)
+
+    with open(log_path, 'r') as f:
+        decisions = [line.strip() for line in f if 'Slurm autoscale:' in line]
+    for decision in decisions:
+        print(decision)
+    # the first batch is sized from the runtime estimates, and more are added once the jobs are observed to take longer
+    assert len([d for d in decisions if 'starting batch' in d]) >= 2
+
+    print('Passed.')
+
+if __name__ == '__main__':
+    main()
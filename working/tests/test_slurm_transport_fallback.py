@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+import os
+import time
+import hither_sf as hither
+from hither_sf._slurmjobhandler import _JobServer
+
+@hither.function('write_text', '0.1.0')
+@hither.output_file('txt_out')
+def write_text(text, delay, txt_out):
+    time.sleep(delay)
+    with open(txt_out, 'w') as f:
+        f.write(text)
+
+def main():
+    # The workers are given an address where nothing is listening, so they
+    # fall back to the file transport
+    _JobServer.address = lambda self: '127.0.0.1:1'
+    working_dir = os.path.join(os.getenv('HOME'), 'tmp_test_slurm_transport_fallback')
+    job_handler = hither.SlurmJobHandler(working_dir=working_dir, use_slurm=False, num_workers_per_batch=3, transport='socket')
+    results = []
+    with hither.config(job_handler=job_handler, container=None, cache=None), hither.job_queue():
+        for i in range(6):
+            results.append(write_text.run(text=str(i), delay=0.5, txt_out=hither.File()))
+    for i, result in enumerate(results):
+        assert result.success
+        with open(result.outputs.txt_out._path, 'r') as f:
+            assert f.read() == str(i)
+
+    print('Passed.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import os
+import time
+import hither_sf as hither
+
+# The local runner stands in for docker/singularity: the job server runs directly on the host
+os.environ['HITHER_WARM_CONTAINERS'] = 'TRUE'
+os.environ['HITHER_WARM_CONTAINER_RUNNER'] = 'local'
+
+@hither.function('report_server_pid', '0.1.0')
+@hither.output_file('txt_out')
+def report_server_pid(delay, txt_out):
+    # Each job runs in a forked child of the session server
+    time.sleep(delay)
+    with open(txt_out, 'w') as f:
+        f.write(str(os.getppid()))
+    return os.getpid()
+
+def main():
+    pids = []
+    server_pids = []
+    with hither.config(container='docker://python:3.7', cache=None, show_console=False):
+        for _ in range(3):
+            result = report_server_pid.run(delay=0, txt_out=hither.File())
+            assert result.success
+            pids.append(result.retval)
+            with open(result.outputs.txt_out._path, 'r') as f:
+                server_pids.append(f.read())
+        with hither.config(job_timeout=1, exception_on_fail=False):
+            result = report_server_pid.run(delay=10, txt_out=hither.File())
+            assert result.success is False
+            assert result.runtime_info['timed_out'] is True
+        # the session survives a job that timed out
+        result = report_server_pid.run(delay=0, txt_out=hither.File())
+        assert result.success
+        with open(result.outputs.txt_out._path, 'r') as f:
+            server_pids.append(f.read())
+
+    print(pids, server_pids)
+    assert len(set(pids)) == len(pids)
+    assert len(set(server_pids)) == 1
+
+    print('Passed.')
+
+if __name__ == '__main__':
+    main()